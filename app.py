@@ -2,58 +2,71 @@
 """
 Aplikacja Logistyki Budowlanej — Optymalizacja Dojazdów Mechaników
 ==================================================================
-Jednoplikowa aplikacja Streamlit do analizy kosztów i czasu dojazdu
-mechaników na budowy. Gotowa do kompilacji: pyinstaller --onefile app.py
+Aplikacja Streamlit do analizy kosztów i czasu dojazdu mechaników na budowy
+(interfejs; obliczenia w mappa_core). Gotowa do kompilacji: pyinstaller --onefile app.py
 
 Uruchomienie:  streamlit run app.py
+Raporty wsadowe bez UI:  python mappa_cli.py --help
 
 Struktura plików:
   MAPPA/
-    app.py                           <- ta aplikacja
+    app.py                           <- ta aplikacja (UI)
+    mappa_core.py                    <- silnik analizy bez Streamlit (dane, routing, koszty, raporty)
+    mappa_cli.py                     <- tryb wsadowy: raporty CSV dla wielu celów
+    mappa_api.py                     <- lokalne API HTTP (asyncio): ranking, macierz, stan cache
     requirements.txt
     MAPPA_Dane/
       Dane_MAPPA.xlsx                <- plik z danymi (MECHANICY, BUDOWY, WARSZTATY)
-    cache_mechanicy.csv              <- auto-generowany cache geokodowania
+    cache_mechanicy.sqlite           <- auto-generowany cache geokodowania
+    cache_mechanicy.csv              <- (opcjonalnie) stary cache — importowany do SQLite
+    cache_trasy.sqlite               <- auto-generowany cache tras OSRM
+    macierz_kosztow.parquet          <- macierz kosztów mechanicy × budowy (tryb wsadowy)
+    MAPPA_Raporty/                   <- raporty CSV (raport_<CEL>_<data>.csv)
+    osrm_mock.py                     <- lokalna atrapa OSRM (testy / benchmarki bez sieci)
+    assets/graf_drogowy/             <- graf drogowy CSR z wyciągu OSM (build_road_graph)
+    assets/kody_pocztowe.tsv.gz      <- indeks: kod pocztowy → centroid (build_postal_index)
 """
 
 # ── Importy ──────────────────────────────────────────────────────────────────
 import os
-import io
-import csv
-import math
 import time
 import base64
+import threading
 import warnings
+from collections import OrderedDict
+from datetime import time as dt_time
 
+import numpy as np
 import pandas as pd
-import requests
 import streamlit as st
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster, MarkerCluster
 from streamlit_folium import st_folium
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError
 import plotly.express as px
 
+import mappa_core
+from mappa_core import (
+    ANALYSIS_BUDGET_S, COST_MATRIX_LABELS, COST_MATRIX_PATH, FALLBACK_DETOUR, FALLBACK_SPEED_KMH,
+    MINUTY_MASZYNA_DUZA, MINUTY_MASZYNA_MALA, PREFILTER_RADIUS_KM, PREFILTER_TOP_K,
+    analyze_destination, assignment_from_matrix, best_per_site, check_osrm_available,
+    compute_cost_matrix, cost_matrix_key, decode_polyline, fallback_model, geocode_status,
+    get_routing_backend, get_routing_health, invalidate_sheets,
+    parse_budowy, parse_maszyny, parse_warsztaty, plan_daily_tours, read_cost_matrix,
+    report_csv, report_filename, route_cache_evict, route_cache_stats,
+    save_cost_matrix, service_minutes, sync_sheet,
+)
+
 warnings.filterwarnings("ignore")
 
 # ── Stałe ────────────────────────────────────────────────────────────────────
 APP_TITLE = "MAPPA — Kalkulator dojazdów mechaników"
 APP_ICON = "🏗️"
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-CACHE_PATH = os.path.join(BASE_DIR, "cache_mechanicy.csv")
-OSRM_BASE = "http://router.project-osrm.org/route/v1/driving"
-NOMINATIM_USER_AGENT = "logistyka_budowlana_app_v1"
-STAWKA_RBH_MECHANIKA = 150  # PLN za godzinę
-STAWKA_SAMOCHODU = 45       # PLN za godzinę
-
-# ── Google Sheets ─────────────────────────────────────────────────────────────
-GSHEET_ID = "1yLzRB0v3Um6W4owIQt9-MfL320AxLVl7oY-lfPv7Kug"
 APP_PASSWORD = "BE_13!WE"
-
-def gsheet_csv_url(sheet_name: str) -> str:
-    """URL do pobrania arkusza Google Sheets jako CSV."""
-    return f"https://docs.google.com/spreadsheets/d/{GSHEET_ID}/gviz/tq?tqx=out:csv&sheet={sheet_name}"
+MAP_VECTOR_THRESHOLD = 500   # powyżej tylu punktów mapa domyślnie w trybie wektorowym (GeoJSON)
+MAP_CACHE_MAX = 8            # ile wariantów mapy bazowej (dane × styl × warstwy) trzymać w pamięci
+SHARED_HEALTH_TTL_S = 60     # stan routingu wspólny dla sesji — ponowne sprawdzenie co tyle s
+SHARED_RESULTS_TTL_S = 900   # wynik analizy wspólny dla sesji — ważny tyle s (te same dane i parametry)
+SHARED_RESULTS_MAX = 32      # ile ostatnich analiz trzymać dla wszystkich sesji
 
 # ── Konfiguracja strony ─────────────────────────────────────────────────────
 st.set_page_config(
@@ -181,405 +194,130 @@ st.markdown("""
 # ══════════════════════════════════════════════════════════════════════════════
 
 
+# ── Dane z cache Streamlit (silnik: mappa_core) ────────────────────────────
+def show_messages(df: pd.DataFrame) -> pd.DataFrame:
+    """Pokaż komunikaty silnika z df.attrs["komunikaty"] (st.error / st.warning)."""
+    for level, text in df.attrs.get("komunikaty", []):
+        getattr(st, level)(text)
+    return df
 
-# ── Cache geokodowania ───────────────────────────────────────────────────────
-def load_geocode_cache() -> dict:
-    """Wczytaj cache adresów → współrzędnych z CSV."""
-    cache = {}
-    if os.path.exists(CACHE_PATH):
-        try:
-            with open(CACHE_PATH, "r", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    cache[row["adres"]] = (float(row["lat"]), float(row["lon"]))
-        except Exception:
-            pass
-    return cache
 
+@st.cache_data(show_spinner=False, max_entries=4)
+def _parse_budowy(fingerprint: str, _content: bytes) -> pd.DataFrame:
+    """parse_budowy z cache wg odcisku treści arkusza."""
+    return parse_budowy(fingerprint, _content)
 
-def save_geocode_cache(cache: dict) -> None:
-    """Zapisz cache do CSV (nadpisz całość)."""
-    try:
-        with open(CACHE_PATH, "w", encoding="utf-8", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=["adres", "lat", "lon"])
-            writer.writeheader()
-            for adres, (lat, lon) in cache.items():
-                writer.writerow({"adres": adres, "lat": lat, "lon": lon})
-    except Exception:
-        pass
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _parse_warsztaty(fingerprint: str, _content: bytes) -> pd.DataFrame:
+    return parse_warsztaty(fingerprint, _content)
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _parse_maszyny(fingerprint: str, _content: bytes) -> pd.DataFrame:
+    return parse_maszyny(fingerprint, _content)
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def _read_cost_matrix(path: str, mtime: float) -> pd.DataFrame:
+    return read_cost_matrix(path, mtime)
 
 
-def geocode_address(address: str, geolocator, cache: dict) -> tuple:
-    """Geokoduj adres; najpierw sprawdź cache."""
-    if address in cache:
-        return cache[address]
-    try:
-        time.sleep(1.1)  # Nominatim rate-limit: 1 req/s
-        location = geolocator.geocode(address, timeout=10)
-        if location:
-            coords = (location.latitude, location.longitude)
-            cache[address] = coords
-            return coords
-    except (GeocoderTimedOut, GeocoderServiceError):
-        pass
-    return (None, None)
-
-
-# ── Ładowanie danych ─────────────────────────────────────────────────────────
-@st.cache_data(show_spinner=False, ttl=300)
 def load_budowy() -> pd.DataFrame:
-    """Wczytaj arkusz BUDOWY z Google Sheets — parsuj kolumnę WSPÓŁRZĘDNE."""
-    try:
-        url = gsheet_csv_url("BUDOWY")
-        df = pd.read_csv(url)
-    except Exception as e:
-        st.error(f"❌ Nie można wczytać arkusza BUDOWY: {e}")
-        return pd.DataFrame()
-
-    # Szukaj kolumny współrzędnych (obsługa polskich znaków / wariantów)
-    coord_col = None
-    for c in df.columns:
-        cu = str(c).upper().strip()
-        if "WSPÓŁRZĘDNE" in cu or "WSPOLRZEDNE" in cu or "WSPOL" in cu or "COORD" in cu:
-            coord_col = c
-            break
-    if coord_col is None:
-        coord_col = df.columns[-1] if len(df.columns) >= 3 else None
-
-    if coord_col is None:
-        st.error("❌ Nie znaleziono kolumny ze współrzędnymi w arkuszu BUDOWY.")
-        return pd.DataFrame()
-
-    rows = []
-    skipped = []
-    for idx, (_, row) in enumerate(df.iterrows()):
-        try:
-            raw = str(row[coord_col]).strip()
-            parts = raw.split(",")
-            lat = float(parts[0].strip())
-            lon = float(parts[1].strip())
-            rows.append({
-                "nazwa": str(row.get("NAZWA", "")).strip(),
-                "kost": str(row.get("KOST", "")).strip(),
-                "lat": lat,
-                "lon": lon,
-            })
-        except Exception:
-            name = str(row.get("NAZWA", f"wiersz {idx+1}")).strip()
-            skipped.append(name)
-            continue
-    if skipped:
-        st.warning(f"⚠️ Pominięto {len(skipped)} budów z błędnymi współrzędnymi: {', '.join(skipped)}")
-    return pd.DataFrame(rows)
+    return show_messages(mappa_core.load_budowy(parse=_parse_budowy))
 
 
-@st.cache_data(show_spinner=False, ttl=300)
 def load_warsztaty() -> pd.DataFrame:
-    """Wczytaj arkusz WARSZTATY z Google Sheets."""
-    try:
-        url = gsheet_csv_url("WARSZTATY")
-        df = pd.read_csv(url)
-    except Exception:
-        return pd.DataFrame()
-
-    coord_col = None
-    name_col = None
-    for c in df.columns:
-        cu = str(c).upper().strip()
-        if "WSPÓŁRZĘDNE" in cu or "WSPOLRZEDNE" in cu or "WSPOL" in cu or "COORD" in cu:
-            coord_col = c
-        if "NAZWA" in cu or "NAME" in cu:
-            name_col = c
-
-    if coord_col is None or name_col is None:
-        cols = list(df.columns)
-        if len(cols) >= 2:
-            if name_col is None:
-                name_col = cols[0]
-            if coord_col is None:
-                coord_col = cols[-1]
-        else:
-            return pd.DataFrame()
-
-    rows = []
-    skipped = []
-    for idx, (_, row) in enumerate(df.iterrows()):
-        try:
-            raw = str(row[coord_col]).strip()
-            parts = raw.split(",")
-            lat = float(parts[0].strip())
-            lon = float(parts[1].strip())
-            rows.append({
-                "nazwa": str(row[name_col]).strip(),
-                "lat": lat,
-                "lon": lon,
-            })
-        except Exception:
-            name = str(row.get(name_col, f"wiersz {idx+1}")).strip()
-            skipped.append(name)
-            continue
-    if skipped:
-        st.warning(f"⚠️ Pominięto {len(skipped)} warsztatów z błędnymi współrzędnymi: {', '.join(skipped)}")
-    return pd.DataFrame(rows)
+    return show_messages(mappa_core.load_warsztaty(parse=_parse_warsztaty))
 
 
-# ── Ładowanie maszyn ─────────────────────────────────────────────────────────
-@st.cache_data(show_spinner=False, ttl=300)
 def load_maszyny(sheet_name: str) -> pd.DataFrame:
-    """Wczytaj listę maszyn z Google Sheets. Zwraca DataFrame z kolumnami KOST, nazwa_kost, ilosc."""
-    try:
-        url = gsheet_csv_url(sheet_name)
-        df = pd.read_csv(url)
-    except Exception:
-        return pd.DataFrame(columns=["KOST", "nazwa_kost", "ilosc"])
-
-    cols = list(df.columns)
-
-    # Szukaj kolumny KOST — najpierw dokładne dopasowanie, potem zawiera
-    kost_col = None
-    for c in cols:
-        if str(c).strip().upper() == "KOST":
-            kost_col = c
-            break
-    if kost_col is None:
-        for c in cols:
-            if "KOST" in str(c).upper() and "NAZWA" not in str(c).upper():
-                kost_col = c
-                break
-
-    # Szukaj kolumny "Ostatnie: Nazwa KOST" (lub warianty)
-    nazwa_kost_col = None
-    for c in cols:
-        cu = str(c).upper().strip()
-        if "NAZWA" in cu and "KOST" in cu:
-            nazwa_kost_col = c
-            break
-
-    # Szukaj kolumny z liczbą — "LICZBA" lub "INW"
-    count_col = None
-    for c in cols:
-        cu = str(c).upper()
-        if "LICZBA" in cu or "INW" in cu:
-            count_col = c
-            break
-
-    # Fallback: B=indeks 1, D=indeks 3
-    if kost_col is None and len(cols) >= 2:
-        kost_col = cols[1]
-    if count_col is None and len(cols) >= 4:
-        count_col = cols[3]
-
-    if kost_col is None or count_col is None:
-        return pd.DataFrame(columns=["KOST", "nazwa_kost", "ilosc"])
-
-    # Zbierz kolumny do wyniku
-    use_cols = [kost_col, count_col]
-    out_names = ["KOST", "ilosc"]
-    if nazwa_kost_col:
-        use_cols = [kost_col, nazwa_kost_col, count_col]
-        out_names = ["KOST", "nazwa_kost", "ilosc"]
-
-    result = df[use_cols].copy()
-    result.columns = out_names
-
-    result["KOST"] = result["KOST"].astype(str).str.strip()
-    # Normalizacja: "1250.0" → "1250" (pandas parsuje czysto-liczbowe kolumny jako float)
-    result["KOST"] = result["KOST"].str.replace(r'^(\d+)\.0$', r'\1', regex=True)
-
-    if "nazwa_kost" not in result.columns:
-        result["nazwa_kost"] = ""
-    else:
-        result["nazwa_kost"] = result["nazwa_kost"].astype(str).str.strip()
-        result.loc[result["nazwa_kost"] == "nan", "nazwa_kost"] = ""
-
-    # NIE filtruj pustych KOST — zostawiamy je, żeby potem uzupełnić cross-referencją
-    result["ilosc"] = pd.to_numeric(result["ilosc"], errors="coerce").fillna(0).astype(int)
-    # Filtruj wiersze, które mają zarówno pusty KOST jak i pustą nazwę
-    result = result[~((result["KOST"].isin(["", "nan"])) & (result["nazwa_kost"] == ""))]
-    return result
-
-
-
-def count_machines_for_budowa(kost_str, maszyny_male_df, maszyny_duze_df):
-    """Zlicz maszyny małe i duże dla budowy wg KOST (może być kilka po przecinku)."""
-    if not kost_str or str(kost_str).strip() in ("", "nan", "None"):
-        return 0, 0
-    import re
-    kosty = [k.strip().upper() for k in str(kost_str).split(",")]
-    # Normalizacja: "1250.0" → "1250" (na wypadek gdyby budowy też miały float KOST)
-    kosty = [re.sub(r'^(\d+)\.0$', r'\1', k) for k in kosty]
-    male = 0
-    duze = 0
-    if not maszyny_male_df.empty:
-        male = int(maszyny_male_df[maszyny_male_df["KOST"].str.upper().isin(kosty)]["ilosc"].sum())
-    if not maszyny_duze_df.empty:
-        duze = int(maszyny_duze_df[maszyny_duze_df["KOST"].str.upper().isin(kosty)]["ilosc"].sum())
-    return male, duze
-
-
-def load_mechanicy() -> pd.DataFrame:
-    """Wczytaj arkusz MECHANICY z Google Sheets — geokoduj z cache."""
-    try:
-        url = gsheet_csv_url("MECHANICY")
-        df = pd.read_csv(url)
-    except Exception as e:
-        st.error(f"❌ Nie można wczytać arkusza MECHANICY: {e}")
-        return pd.DataFrame()
-
-    cache = load_geocode_cache()
-    geolocator = Nominatim(user_agent=NOMINATIM_USER_AGENT)
-    new_geocoded = 0
-    skipped_list = []  # A3: śledzenie pominiętych
-
-    rows = []
-    progress = st.progress(0, text="🔄 Geokodowanie mechaników…")
-    total = len(df)
-
-    for idx, (_, row) in enumerate(df.iterrows()):
-        try:
-            imie = str(row.get("Imię", "")).strip()
-            nazwisko = str(row.get("Nazwisko", "")).strip()
-            kod = str(row.get("Kod pocztowy", "")).strip()
-            miasto = str(row.get("Miasto", "")).strip()
-            warsztat = str(row.get("Warsztat", "")).strip()
-
-            # Sprawdź opcjonalną kolumnę WSPÓŁRZĘDNE (np. "50.123, 19.456")
-            coords_raw = ""
-            for col_name in df.columns:
-                cn = str(col_name).upper().strip()
-                if "SP" in cn and "RZ" in cn:  # WSPÓŁRZĘDNE / WSPOLRZEDNE
-                    coords_raw = row.get(col_name, "")
-                    break
-            coords_str = str(coords_raw).strip() if pd.notna(coords_raw) else ""
-            lat, lon = None, None
-
-            if coords_str and coords_str.lower() != "nan":
-                try:
-                    parts = coords_str.split(",")
-                    if len(parts) == 2:
-                        lat = float(parts[0].strip())
-                        lon = float(parts[1].strip())
-                except (ValueError, IndexError):
-                    lat, lon = None, None
-
-            # Jeśli brak współrzędnych — geokoduj po adresie
-            if lat is None or lon is None:
-                # A5: Ulica — użyj pd.notna() zamiast porównania z "nan"
-                ulica_raw = row.get("Ulica", "")
-                ulica = str(ulica_raw).strip() if pd.notna(ulica_raw) else ""
-
-                # A5: Budowanie adresu — z pd.notna() zamiast string check
-                addr_parts = []
-                for p in [ulica, kod, miasto]:
-                    if pd.notna(p) and str(p).strip() and str(p).strip().lower() != "nan":
-                        addr_parts.append(str(p).strip())
-                adres = " ".join(addr_parts)
-
-                if not adres:
-                    skipped_list.append(f"{imie} {nazwisko} (brak adresu i współrzędnych)")
-                    continue
-
-                was_cached = adres in cache
-                lat, lon = geocode_address(adres, geolocator, cache)
-
-                if not was_cached and lat is not None:
-                    new_geocoded += 1
-            else:
-                adres = coords_str  # Współrzędne jako "adres" w danych
-
-            if lat is not None and lon is not None:
-                rows.append({
-                    "imie": imie,
-                    "nazwisko": nazwisko,
-                    "mechanik": f"{imie} {nazwisko}",
-                    "adres": adres,
-                    "warsztat": warsztat,
-                    "lat": lat,
-                    "lon": lon,
-                })
-            else:
-                skipped_list.append(f"{imie} {nazwisko} (geokodowanie nieudane)")
-        except Exception as e:
-            skipped_list.append(f"wiersz {idx+1} ({e})")
-            continue
-
-        progress.progress((idx + 1) / total if total > 0 else 1.0,
-                          text=f"🔄 Geokodowanie: {idx+1}/{total}")
-
-    progress.empty()
-
-    # A3: Pokaż ostrzeżenie o pominiętych mechanikach
-    if skipped_list:
-        st.warning(f"⚠️ Pominięto {len(skipped_list)} mechaników: {', '.join(skipped_list[:5])}"
-                   + (f" i {len(skipped_list)-5} więcej…" if len(skipped_list) > 5 else ""))
-
-    if new_geocoded > 0:
-        save_geocode_cache(cache)
-
-    return pd.DataFrame(rows)
-
-
-# ── Haversine ────────────────────────────────────────────────────────────────
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Odległość w linii prostej (km) — wzór Haversine."""
-    R = 6371.0
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = (math.sin(dlat / 2) ** 2 +
-         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-         math.sin(dlon / 2) ** 2)
-    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-
-# ── C7: Sprawdzenie dostępności OSRM ─────────────────────────────────────────
-def check_osrm_available() -> bool:
-    """Testowe zapytanie do OSRM — sprawdza czy serwer odpowiada."""
-    url = f"{OSRM_BASE}/19.945,50.065;20.0,50.0?overview=false"
-    for _ in range(2):  # 2 próby
-        try:
-            resp = requests.get(url, timeout=8)
-            if resp.status_code == 200 and resp.json().get("code") == "Ok":
-                return True
-        except Exception:
-            pass
-    return False
-
-
-# ── OSRM Routing (z geometrią trasy) ────────────────────────────────────────
-def get_osrm_route(lat1: float, lon1: float, lat2: float, lon2: float,
-                   use_fallback: bool = False):
-    """Pobierz dystans (km), czas (min) i geometrię trasy z OSRM.
-    A4: Retry 1× przy timeout. Jeśli use_fallback=True, użyj Haversine.
-    Zwraca: (distance_km, duration_min, list_of_[lat,lon])"""
-    if not use_fallback:
-        max_retries = 2  # A4: 1 próba dodatkowa
-        for attempt in range(max_retries):
-            try:
-                url = (f"{OSRM_BASE}/{lon1},{lat1};{lon2},{lat2}"
-                       f"?overview=full&geometries=geojson")
-                resp = requests.get(url, timeout=10)
-                data = resp.json()
-                if data.get("code") == "Ok" and data.get("routes"):
-                    route = data["routes"][0]
-                    distance_km = round(route["distance"] / 1000, 1)
-                    duration_min = round(route["duration"] / 60, 1)
-                    coords = route["geometry"]["coordinates"]
-                    polyline = [[c[1], c[0]] for c in coords]
-                    return distance_km, duration_min, polyline
-            except requests.exceptions.Timeout:
-                if attempt < max_retries - 1:
-                    time.sleep(0.5)  # krótka pauza przed retry
-                    continue
-            except Exception:
-                break  # inne błędy — nie retry'uj
-    # Fallback: Haversine (linia prosta × 1.3 jako przybliżenie drogowe)
-    dist = round(haversine_km(lat1, lon1, lat2, lon2) * 1.3, 1)
-    dur = round(dist, 1)  # minuty ≈ km przy ~60 km/h (dist_km / 60 * 60 = dist_km)
-    polyline = [[lat1, lon1], [lat2, lon2]]
-    return dist, dur, polyline
+    return mappa_core.load_maszyny(sheet_name, parse=_parse_maszyny)
+
+
+def load_cost_matrix(path: str = COST_MATRIX_PATH):
+    return mappa_core.load_cost_matrix(path, read=_read_cost_matrix)
+
 
+@st.cache_data(show_spinner=False, max_entries=4)
+def enrich_budowy(fingerprints: tuple, _budowy_df: pd.DataFrame,
+                  _maszyny_male_df: pd.DataFrame, _maszyny_duze_df: pd.DataFrame) -> tuple:
+    """Liczba maszyn per budowa — liczona ponownie tylko gdy zmieni się któryś
+    z arkuszy (fingerprints = odciski BUDOWY, MALE, DUZE)."""
+    return mappa_core.enrich_budowy(_budowy_df, _maszyny_male_df, _maszyny_duze_df)
 
 
+compare_sites_nearest = st.cache_data(show_spinner=False)(mappa_core.compare_sites_nearest)
+
+
+# ── Stan wspólny dla wszystkich sesji (jeden proces) ───────────────────────
+@st.cache_resource
+def shared_store() -> dict:
+    """Jeden obiekt na proces (st.cache_resource): mechanicy, stan routingu
+    i ostatnie analizy — nowa karta przeglądarki nie liczy ich od nowa.
+    Obiekty współdzielone — sesje ich nie modyfikują."""
+    return {
+        "mechanicy": None,
+        "mechanicy_lock": threading.Lock(),
+        "routing": (float("-inf"), False),   # (czas sprawdzenia, dostępny)
+        "routing_lock": threading.Lock(),
+        "analizy": OrderedDict(),            # klucz → (czas, result_df, routes_for_map)
+        "analizy_lock": threading.Lock(),
+    }
+
+
+def shared_mechanicy(fingerprint) -> pd.DataFrame:
+    """Mechanicy wspólni dla sesji — wczytywani ponownie tylko po zmianie arkusza
+    (odcisk), po nieudanym wczytaniu albo gdy geokodowanie w tle dostarczyło
+    współrzędne oczekujących adresów."""
+    store = shared_store()
+    with store["mechanicy_lock"]:
+        df = store["mechanicy"]
+        if (df is None or df.attrs.get("fingerprint") is None
+                or (fingerprint and df.attrs["fingerprint"] != fingerprint)
+                or any(geocode_status(adres) != "pending" for _, adres in df.attrs.get("pending", []))):
+            df = mappa_core.load_mechanicy()
+            store["mechanicy"] = df
+    return df
+
+
+def shared_routing_available() -> bool:
+    """Dostępność routingu — sprawdzana raz na SHARED_HEALTH_TTL_S dla całego procesu."""
+    store = shared_store()
+    with store["routing_lock"]:
+        checked_at, ok = store["routing"]
+        if time.monotonic() - checked_at >= SHARED_HEALTH_TTL_S:
+            ok = check_osrm_available()
+            store["routing"] = (time.monotonic(), ok)
+    return ok
+
+
+def shared_analysis_get(key: tuple):
+    """(wiek_s, result_df, routes_for_map) wcześniejszej analizy z tym kluczem lub None."""
+    store = shared_store()
+    with store["analizy_lock"]:
+        hit = store["analizy"].get(key)
+        if hit is None or time.monotonic() - hit[0] >= SHARED_RESULTS_TTL_S:
+            return None
+        store["analizy"].move_to_end(key)
+    return time.monotonic() - hit[0], hit[1].copy(), hit[2]
+
+
+def shared_analysis_put(key: tuple, result_df: pd.DataFrame, routes_for_map: list) -> None:
+    store = shared_store()
+    with store["analizy_lock"]:
+        store["analizy"][key] = (time.monotonic(), result_df.copy(), routes_for_map)
+        while len(store["analizy"]) > SHARED_RESULTS_MAX:
+            store["analizy"].popitem(last=False)
+
+
+def shared_invalidate() -> None:
+    """„Odśwież dane”: ponowne sprawdzenie routingu i nowe analizy (dla wszystkich sesji)."""
+    store = shared_store()
+    with store["routing_lock"]:
+        store["routing"] = (float("-inf"), False)
+    with store["analizy_lock"]:
+        store["analizy"].clear()
 
 
 # ── Kolory tras ──────────────────────────────────────────────────────────────
@@ -631,26 +369,135 @@ TILE_PROVIDERS = {
 def offset_polyline(coords, offset_meters, route_index):
     """Przesuń polilinię w bok o offset_meters × route_index.
     Daje efekt 'wielokolorowej' trasy zamiast nakładania się."""
-    if not coords or len(coords) < 2 or route_index == 0:
+    if coords is None or len(coords) < 2 or route_index == 0:
         return coords
-    import math
+    pts = np.asarray(coords, dtype=float)
     # Przelicznik: 1 stopień ≈ 111 000 m
     offset_deg = (offset_meters * route_index) / 111000.0
-    result = []
-    for j in range(len(coords)):
-        lat, lon = coords[j]
-        if j < len(coords) - 1:
-            dlat = coords[j + 1][0] - lat
-            dlon = coords[j + 1][1] - lon
-        else:
-            dlat = lat - coords[j - 1][0]
-            dlon = lon - coords[j - 1][1]
-        length = math.sqrt(dlat ** 2 + dlon ** 2) or 1e-10
-        # Wektor prostopadły (w prawo)
-        perp_lat = -dlon / length
-        perp_lon = dlat / length
-        result.append([lat + perp_lat * offset_deg, lon + perp_lon * offset_deg])
-    return result
+    # Kierunek odcinka do następnego punktu (ostatni punkt — od poprzedniego)
+    d = np.diff(pts, axis=0)
+    d = np.vstack([d, d[-1:]])
+    length = np.hypot(d[:, 0], d[:, 1])
+    length[length == 0] = 1e-10
+    # Wektor prostopadły (w prawo)
+    perp = np.column_stack([-d[:, 1], d[:, 0]]) / length[:, None]
+    return (pts + perp * offset_deg).tolist()
+
+
+# ── Dane markerów (popupy/tooltipy) — liczone wektorowo, cache wg danych ───
+@st.cache_data(show_spinner=False, max_entries=16)
+def budowy_marker_data(budowy_df: pd.DataFrame) -> pd.DataFrame:
+    """lat, lon, nazwa, popup, tooltip dla warstwy budów."""
+    if budowy_df is None or budowy_df.empty:
+        return pd.DataFrame(columns=["lat", "lon", "nazwa", "popup", "tooltip"])
+    n = len(budowy_df)
+    m_male = pd.to_numeric(budowy_df.get("maszyny_male", pd.Series(0, index=budowy_df.index)),
+                           errors="coerce").fillna(0).astype(int).astype(str)
+    m_duze = pd.to_numeric(budowy_df.get("maszyny_duze", pd.Series(0, index=budowy_df.index)),
+                           errors="coerce").fillna(0).astype(int).astype(str)
+    nazwa = budowy_df["nazwa"].astype(str)
+    popup = (
+        "<div style='min-width:180px'>"
+        "<b style='color:#c0392b; font-size:1.05em'>🏢 " + nazwa + "</b><br>"
+        "<span style='color:#555'>KOST: <b>" + budowy_df["kost"].astype(str) + "</b></span>"
+        "<br><span style='color:#555'>🔩 Duże: <b>" + m_duze + "</b></span>"
+        "<br><span style='color:#555'>🔧 Małe: <b>" + m_male + "</b></span>"
+        "</div>"
+    )
+    return pd.DataFrame({
+        "lat": budowy_df["lat"].to_numpy(), "lon": budowy_df["lon"].to_numpy(),
+        "nazwa": nazwa.to_numpy(), "popup": popup.to_numpy(),
+        "tooltip": (nazwa + " | D:" + m_duze + " M:" + m_male).to_numpy(),
+    }, index=range(n))
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def warsztaty_marker_data(warsztaty_df: pd.DataFrame, ws_counts: dict) -> pd.DataFrame:
+    """lat, lon, popup, tooltip dla warstwy warsztatów (ws_counts: warsztat → liczba mechaników)."""
+    if warsztaty_df is None or warsztaty_df.empty:
+        return pd.DataFrame(columns=["lat", "lon", "popup", "tooltip"])
+    nazwa = warsztaty_df["nazwa"].astype(str)
+    n_mech = nazwa.map(ws_counts).fillna(0).astype(int).astype(str)
+    popup = (
+        "<div style='min-width:160px'>"
+        "<b style='color:#2980b9; font-size:1.05em'>🔧 " + nazwa + "</b><br>"
+        "<span style='color:#555'>👷 Mechaników: <b>" + n_mech + "</b></span><br>"
+        "<span style='color:#777; font-size:0.85em'>Warsztat stały</span>"
+        "</div>"
+    )
+    return pd.DataFrame({
+        "lat": warsztaty_df["lat"].to_numpy(), "lon": warsztaty_df["lon"].to_numpy(),
+        "popup": popup.to_numpy(),
+        "tooltip": (nazwa + " (" + n_mech + " mech.)").to_numpy(),
+    })
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def mechanicy_marker_data(mechanicy_df: pd.DataFrame) -> pd.DataFrame:
+    """lat, lon, popup, tooltip dla warstwy mechaników."""
+    if mechanicy_df is None or mechanicy_df.empty:
+        return pd.DataFrame(columns=["lat", "lon", "popup", "tooltip"])
+    mech = mechanicy_df["mechanik"].astype(str)
+    ws = mechanicy_df["warsztat"].astype(str)
+    popup = (
+        "<div style='min-width:180px'>"
+        "<b style='color:#27ae60; font-size:1.05em'>👷 " + mech + "</b><br>"
+        "<span style='color:#555'>Warsztat: <b>" + ws + "</b></span><br>"
+        "<span style='color:#777; font-size:0.85em'>" + mechanicy_df["adres"].astype(str) + "</span>"
+        "</div>"
+    )
+    return pd.DataFrame({
+        "lat": mechanicy_df["lat"].to_numpy(), "lon": mechanicy_df["lon"].to_numpy(),
+        "popup": popup.to_numpy(),
+        "tooltip": (mech + " (" + ws + ")").to_numpy(),
+    })
+
+
+# ── Warstwy wektorowe (jeden GeoJSON / callback na warstwę) ──────────────────
+# Zamiast tysięcy folium.Marker (każdy z własnym Popup/Icon w HTML) cała warstwa
+# to jedna kolekcja punktów z popupem/tooltipem we właściwościach.
+_FAST_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 6, color: '#1e7e34', weight: 1,
+        fillColor: '#27ae60', fillOpacity: 0.9
+    });
+    marker.bindPopup(
+        "<div style='min-width:180px'>" +
+        "<b style='color:#27ae60; font-size:1.05em'>👷 " + row[2] + "</b><br>" +
+        "<span style='color:#555'>Warsztat: <b>" + row[3] + "</b></span><br>" +
+        "<span style='color:#777; font-size:0.85em'>" + row[4] + "</span></div>",
+        {maxWidth: 280});
+    marker.bindTooltip(row[2] + " (" + row[3] + ")");
+    return marker;
+}
+"""
+
+def points_geojson(markers: pd.DataFrame) -> dict:
+    """FeatureCollection punktów z kolumn lat/lon/popup/tooltip."""
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [round(float(lon), 5), round(float(lat), 5)]},
+                "properties": {"popup": popup, "tooltip": tooltip},
+            }
+            for lat, lon, popup, tooltip in zip(
+                markers["lat"], markers["lon"], markers["popup"], markers["tooltip"])
+        ],
+    }
+
+
+def vector_points_layer(markers: pd.DataFrame, fill_color: str, radius: int = 7) -> folium.GeoJson:
+    """Jedna warstwa GeoJSON z CircleMarkerami (popup/tooltip z właściwości)."""
+    return folium.GeoJson(
+        points_geojson(markers),
+        marker=folium.CircleMarker(radius=radius, color="#333", weight=1,
+                                   fill=True, fill_color=fill_color, fill_opacity=0.9),
+        popup=folium.GeoJsonPopup(fields=["popup"], labels=False),
+        tooltip=folium.GeoJsonTooltip(fields=["tooltip"], labels=False),
+    )
 
 
 # ── Mapa Folium ──────────────────────────────────────────────────────────────
@@ -659,8 +506,12 @@ def build_map(mechanicy_df, budowy_df, warsztaty_df,
               tile_key="🌍 OpenStreetMap", use_clusters=True,
               show_budowy=True, show_warsztaty=True,
               show_mechanicy=True, show_trasy=True,
-              all_mechanicy_df=None):
-    """Zbuduj mapę Folium z warstwami i opcjonalnymi trasami."""
+              all_mechanicy_df=None, vector_layers=False):
+    """Zbuduj mapę Folium z warstwami statycznymi (budowy, warsztaty, mechanicy)
+    i opcjonalnie z trasami. W aplikacji trasy są osobną, dynamiczną warstwą
+    (build_routes_layer → st_folium(feature_group_to_add=...)), więc nowa analiza
+    nie zmienia mapy bazowej. vector_layers=True — warstwy punktów jako GeoJSON
+    / FastMarkerCluster zamiast pojedynczych markerów (duże zbiory)."""
     all_lats, all_lons = [], []
     for df in [mechanicy_df, budowy_df, warsztaty_df]:
         if df is not None and not df.empty:
@@ -685,28 +536,22 @@ def build_map(mechanicy_df, budowy_df, warsztaty_df,
 
     # ── Warstwa: Budowy (czerwone) ───────────────────────────────────────
     fg_budowy = folium.FeatureGroup(name="🏢 Budowy", show=show_budowy)
-    if budowy_df is not None and not budowy_df.empty:
-        for _, row in budowy_df.iterrows():
-            m_male = row.get("maszyny_male", 0)
-            m_duze = row.get("maszyny_duze", 0)
-            m_male = int(m_male) if pd.notna(m_male) else 0
-            m_duze = int(m_duze) if pd.notna(m_duze) else 0
-            popup_html = (
-                f"<div style='min-width:180px'>"
-                f"<b style='color:#c0392b; font-size:1.05em'>🏢 {row['nazwa']}</b><br>"
-                f"<span style='color:#555'>KOST: <b>{row['kost']}</b></span>"
-                f"<br><span style='color:#555'>🔩 Duże: <b>{m_duze}</b></span>"
-                f"<br><span style='color:#555'>🔧 Małe: <b>{m_male}</b></span>"
-                f"</div>"
-            )
-            tooltip_text = f"{row['nazwa']} | D:{m_duze} M:{m_male}"
-            icon_color = "darkred" if (selected_budowa and row["nazwa"] == selected_budowa) else "red"
-            folium.Marker(
-                location=[row["lat"], row["lon"]],
-                popup=folium.Popup(popup_html, max_width=280),
-                tooltip=tooltip_text,
-                icon=folium.Icon(color=icon_color, icon="industry", prefix="fa"),
-            ).add_to(fg_budowy)
+    bud = budowy_marker_data(budowy_df)
+    if vector_layers and not bud.empty:
+        # Wybrana budowa zostaje zwykłym markerem, reszta — jedna warstwa GeoJSON
+        is_sel = (bud["nazwa"] == selected_budowa).to_numpy() if selected_budowa else np.zeros(len(bud), bool)
+        if (~is_sel).any():
+            vector_points_layer(bud[~is_sel], "#e74c3c").add_to(fg_budowy)
+        bud = bud[is_sel]
+    for lat, lon, nazwa, popup_html, tooltip_text in zip(
+            bud["lat"], bud["lon"], bud["nazwa"], bud["popup"], bud["tooltip"]):
+        icon_color = "darkred" if (selected_budowa and nazwa == selected_budowa) else "red"
+        folium.Marker(
+            location=[lat, lon],
+            popup=folium.Popup(popup_html, max_width=280),
+            tooltip=tooltip_text,
+            icon=folium.Icon(color=icon_color, icon="industry", prefix="fa"),
+        ).add_to(fg_budowy)
     fg_budowy.add_to(m)
 
     # ── Warstwa: Warsztaty (niebieskie) ──────────────────────────────────
@@ -717,91 +562,213 @@ def build_map(mechanicy_df, budowy_df, warsztaty_df,
         ws_counts = {}
         if mech_src is not None and not mech_src.empty and "warsztat" in mech_src.columns:
             ws_counts = mech_src["warsztat"].value_counts().to_dict()
-        for _, row in warsztaty_df.iterrows():
-            n_mech = ws_counts.get(row["nazwa"], 0)
-            popup_html = (
-                f"<div style='min-width:160px'>"
-                f"<b style='color:#2980b9; font-size:1.05em'>🔧 {row['nazwa']}</b><br>"
-                f"<span style='color:#555'>👷 Mechaników: <b>{n_mech}</b></span><br>"
-                f"<span style='color:#777; font-size:0.85em'>Warsztat stały</span>"
-                f"</div>"
-            )
-            folium.Marker(
-                location=[row["lat"], row["lon"]],
-                popup=folium.Popup(popup_html, max_width=250),
-                tooltip=f"{row['nazwa']} ({n_mech} mech.)",
-                icon=folium.Icon(color="blue", icon="wrench", prefix="fa"),
-            ).add_to(fg_warsztaty)
+        ws = warsztaty_marker_data(warsztaty_df, ws_counts)
+        if vector_layers:
+            vector_points_layer(ws, "#2980b9", radius=8).add_to(fg_warsztaty)
+        else:
+            for lat, lon, popup_html, tooltip_text in zip(ws["lat"], ws["lon"], ws["popup"], ws["tooltip"]):
+                folium.Marker(
+                    location=[lat, lon],
+                    popup=folium.Popup(popup_html, max_width=250),
+                    tooltip=tooltip_text,
+                    icon=folium.Icon(color="blue", icon="wrench", prefix="fa"),
+                ).add_to(fg_warsztaty)
     fg_warsztaty.add_to(m)
 
     # ── Warstwa: Mechanicy (zielone) — C3: z klastrowaniem ────────────────
     fg_mechanicy = folium.FeatureGroup(name="👷 Mechanicy", show=show_mechanicy)
-    if mechanicy_df is not None and not mechanicy_df.empty:
+    if mechanicy_df is not None and not mechanicy_df.empty and vector_layers:
+        if use_clusters:
+            # Markery (i HTML popupu) tworzone w przeglądarce z surowych pól
+            # [lat, lon, mechanik, warsztat, adres] — bez powielania szablonu HTML
+            raw = pd.DataFrame({
+                "lat": mechanicy_df["lat"].astype(float).round(5),
+                "lon": mechanicy_df["lon"].astype(float).round(5),
+                "mechanik": mechanicy_df["mechanik"].astype(str),
+                "warsztat": mechanicy_df["warsztat"].astype(str),
+                "adres": mechanicy_df["adres"].astype(str),
+            })
+            FastMarkerCluster(
+                data=raw.values.tolist(),
+                callback=_FAST_MARKER_CALLBACK,
+            ).add_to(fg_mechanicy)
+        else:
+            vector_points_layer(mechanicy_marker_data(mechanicy_df), "#27ae60", radius=6).add_to(fg_mechanicy)
+    elif mechanicy_df is not None and not mechanicy_df.empty:
         # C3: Użyj MarkerCluster jeśli włączone
         marker_target = MarkerCluster().add_to(fg_mechanicy) if use_clusters else fg_mechanicy
-        for _, row in mechanicy_df.iterrows():
-            popup_html = (
-                f"<div style='min-width:180px'>"
-                f"<b style='color:#27ae60; font-size:1.05em'>👷 {row['mechanik']}</b><br>"
-                f"<span style='color:#555'>Warsztat: <b>{row['warsztat']}</b></span><br>"
-                f"<span style='color:#777; font-size:0.85em'>{row['adres']}</span>"
-                f"</div>"
-            )
+        mech = mechanicy_marker_data(mechanicy_df)
+        for lat, lon, popup_html, tooltip_text in zip(mech["lat"], mech["lon"], mech["popup"], mech["tooltip"]):
             folium.Marker(
-                location=[row["lat"], row["lon"]],
+                location=[lat, lon],
                 popup=folium.Popup(popup_html, max_width=280),
-                tooltip=f"{row['mechanik']} ({row['warsztat']})",
+                tooltip=tooltip_text,
                 icon=folium.Icon(color="green", icon="user", prefix="fa"),
             ).add_to(marker_target)
     fg_mechanicy.add_to(m)
 
     # ── Warstwa: Trasy (kolorowe polilinie) ──────────────────────────────
     if routes:
-        fg_trasy = folium.FeatureGroup(name="🛣️ Trasy dojazdowe", show=show_trasy)
-        for i, route_info in enumerate(routes):
-            polyline = route_info.get("polyline")
-            label = route_info.get("label", "")
-            dist = route_info.get("dist", "")
-            dur = route_info.get("dur", "")
-            is_ws = route_info.get("is_workshop", False)
-            color = "#f97316" if is_ws else get_route_color(i)
-            is_best = route_info.get("is_best", False)
-            rank = f"#{i+1}"
-            best_star = " ⭐" if is_best else ""
-            ws_tag = " 🔧" if is_ws else ""
-
-            weight = 7 if is_best else 4
-            opacity = 0.9 if is_best else 0.75
-            dash_array = "10 6" if is_ws else None
-
-            if polyline and len(polyline) > 1:
-                # Przesuń trasę w bok aby nie nakładały się
-                display_polyline = offset_polyline(polyline, 30, i)
-                folium.PolyLine(
-                    locations=display_polyline,
-                    color=color,
-                    weight=weight,
-                    opacity=opacity,
-                    dash_array=dash_array,
-                    tooltip=f"{rank} {label} — {dist} km, {dur} min{best_star}{ws_tag}",
-                ).add_to(fg_trasy)
-
-                # Kolorowy CircleMarker na początku trasy (skaluje się z zoomem)
-                folium.CircleMarker(
-                    location=polyline[0],
-                    radius=7,
-                    color="#333",
-                    weight=1,
-                    fill=True,
-                    fill_color=color,
-                    fill_opacity=0.9,
-                    tooltip=f"{rank} {label} — {dist} km, {dur} min{best_star}",
-                ).add_to(fg_trasy)
-        fg_trasy.add_to(m)
+        build_routes_layer(routes, show=show_trasy).add_to(m)
 
     return m
 
 
+@st.cache_resource(show_spinner=False, max_entries=MAP_CACHE_MAX)
+def static_map(fingerprints: tuple, tile_key: str, vector_layers: bool,
+               show_budowy: bool, show_warsztaty: bool, show_mechanicy: bool,
+               _mechanicy_df, _budowy_df, _warsztaty_df, _all_mechanicy_df) -> dict:
+    """Mapa bazowa z warstwami statycznymi (budowy, warsztaty, mechanicy) —
+    budowana i renderowana raz na zestaw danych (fingerprints = odciski arkuszy
+    + filtry mechaników) i opcji, wspólna dla wszystkich reruns i sesji.
+    Zwraca {"map", "lock", "kb"}: st_folium dokłada do mapy warstwy dynamiczne,
+    więc rysowanie idzie pod blokadą; kb — rozmiar strony HTML mapy bazowej."""
+    fmap = build_map(
+        _mechanicy_df, _budowy_df, _warsztaty_df,
+        tile_key=tile_key, use_clusters=True,
+        show_budowy=show_budowy, show_warsztaty=show_warsztaty, show_mechanicy=show_mechanicy,
+        all_mechanicy_df=_all_mechanicy_df, vector_layers=vector_layers,
+    )
+    kb = len(fmap.get_root().render().encode("utf-8")) / 1024
+    return {"map": fmap, "lock": threading.Lock(), "kb": kb}
+
+
+def build_selection_layer(budowy_df: pd.DataFrame, selected_budowa) -> folium.FeatureGroup:
+    """Warstwa dynamiczna: wyróżniony marker wybranej budowy (nad mapą bazową)."""
+    fg = folium.FeatureGroup(name="📍 Wybrana budowa")
+    bud = budowy_marker_data(budowy_df)
+    bud = bud[bud["nazwa"] == selected_budowa]
+    for lat, lon, popup_html, tooltip_text in zip(bud["lat"], bud["lon"], bud["popup"], bud["tooltip"]):
+        folium.Marker(
+            location=[lat, lon],
+            popup=folium.Popup(popup_html, max_width=280),
+            tooltip=tooltip_text,
+            icon=folium.Icon(color="darkred", icon="industry", prefix="fa"),
+        ).add_to(fg)
+    return fg
+
+
+def build_assignment_layer(assign_df: pd.DataFrame) -> folium.FeatureGroup:
+    """Warstwa przydziału: linia mechanik → budowa dla każdej pary."""
+    fg = folium.FeatureGroup(name="🧩 Przydział mechaników")
+    for k, (mech, bud, dist, suma, m_lat, m_lon, b_lat, b_lon) in enumerate(zip(
+            assign_df["Mechanik"], assign_df["Budowa"], assign_df["Dystans (km)"],
+            assign_df["SUMA kosztów (PLN)"], assign_df["_mech_lat"], assign_df["_mech_lon"],
+            assign_df["_bud_lat"], assign_df["_bud_lon"])):
+        color = get_route_color(k)
+        tip = f"{mech} → {bud} — {dist} km, {suma:.2f} PLN"
+        folium.PolyLine(
+            locations=[[m_lat, m_lon], [b_lat, b_lon]],
+            color=color, weight=3, opacity=0.85, dash_array="6 6", tooltip=tip,
+        ).add_to(fg)
+        folium.CircleMarker(
+            location=[m_lat, m_lon], radius=6, color="#333", weight=1,
+            fill=True, fill_color=color, fill_opacity=0.9, tooltip=tip,
+        ).add_to(fg)
+    return fg
+
+
+def build_tours_layer(tour_routes) -> folium.FeatureGroup:
+    """Warstwa tras dziennych: polilinia przez kolejne budowy + numery przystanków."""
+    fg = folium.FeatureGroup(name="🚐 Trasy dzienne")
+    for k, tr in enumerate(tour_routes):
+        color = get_route_color(k)
+        polyline = decode_polyline(tr["polyline"]) if tr.get("polyline") else tr["stops"]
+        folium.PolyLine(
+            locations=polyline, color=color, weight=4, opacity=0.85,
+            tooltip=f"{tr['label']}: " + " → ".join(tr["names"]),
+        ).add_to(fg)
+        for n, ((lat, lon), name) in enumerate(zip(tr["stops"][1:-1], tr["names"][1:-1]), start=1):
+            folium.Marker(
+                location=[lat, lon],
+                tooltip=f"{tr['label']} — {n}. {name}",
+                icon=folium.DivIcon(html=(
+                    f'<div style="background:{color};color:#fff;border:1px solid #333;'
+                    f'border-radius:50%;width:20px;height:20px;line-height:18px;'
+                    f'text-align:center;font-size:11px;font-weight:bold">{n}</div>'
+                ), icon_size=(20, 20), icon_anchor=(10, 10)),
+            ).add_to(fg)
+    return fg
+
+
+def build_routes_layer(routes, show: bool = True) -> folium.FeatureGroup:
+    """Warstwa tras (kolorowe polilinie + znacznik startu) — lekka, budowana
+    przy każdej zmianie wyników niezależnie od mapy bazowej."""
+    fg_trasy = folium.FeatureGroup(name="🛣️ Trasy dojazdowe", show=show)
+    for i, route_info in enumerate(routes or []):
+        polyline = route_info.get("polyline")
+        if isinstance(polyline, str):
+            polyline = decode_polyline(polyline)
+        label = route_info.get("label", "")
+        dist = route_info.get("dist", "")
+        dur = route_info.get("dur", "")
+        is_ws = route_info.get("is_workshop", False)
+        color = "#f97316" if is_ws else get_route_color(i)
+        is_best = route_info.get("is_best", False)
+        rank = f"#{i+1}"
+        best_star = " ⭐" if is_best else ""
+        ws_tag = " 🔧" if is_ws else ""
+
+        weight = 7 if is_best else 4
+        opacity = 0.9 if is_best else 0.75
+        dash_array = "10 6" if is_ws else None
+
+        if polyline and len(polyline) > 1:
+            # Przesuń trasę w bok aby nie nakładały się
+            display_polyline = offset_polyline(polyline, 30, i)
+            folium.PolyLine(
+                locations=display_polyline,
+                color=color,
+                weight=weight,
+                opacity=opacity,
+                dash_array=dash_array,
+                tooltip=f"{rank} {label} — {dist} km, {dur} min{best_star}{ws_tag}",
+            ).add_to(fg_trasy)
+
+            # Kolorowy CircleMarker na początku trasy (skaluje się z zoomem)
+            folium.CircleMarker(
+                location=polyline[0],
+                radius=7,
+                color="#333",
+                weight=1,
+                fill=True,
+                fill_color=color,
+                fill_opacity=0.9,
+                tooltip=f"{rank} {label} — {dist} km, {dur} min{best_star}",
+            ).add_to(fg_trasy)
+    return fg_trasy
+
+
+# ── Wykres porównawczy (fragment — zmiana metryki nie przelicza całej strony) ──
+@st.fragment
+def _chart_panel(chart_df: pd.DataFrame, chart_budowa: str, dark_mode: bool):
+    chart_metric = st.radio(
+        "Metryka wykresu:",
+        ["Dystans (km)", "Czas (min)", "Koszt paliwa (PLN)"],
+        horizontal=True,
+        key="chart_metric",
+    )
+    fig = px.bar(
+        chart_df.sort_values(chart_metric),
+        x="Mechanik",
+        y=chart_metric,
+        color="Warsztat",
+        text_auto=True,
+        title=f"{chart_metric} — dojazd na {chart_budowa}",
+        color_discrete_sequence=px.colors.qualitative.Set2,
+    )
+    fig.update_layout(
+        xaxis_tickangle=-45,
+        height=400,
+        margin=dict(t=40, b=80),
+        template="plotly_dark" if dark_mode else "plotly",
+        paper_bgcolor="rgba(0,0,0,0)" if dark_mode else "#ffffff",
+        plot_bgcolor="rgba(0,0,0,0)" if dark_mode else "#f8fafc",
+        font_color="#e2e8f0" if dark_mode else "#1e293b",
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 #  APLIKACJA GŁÓWNA
 # ══════════════════════════════════════════════════════════════════════════════
@@ -1104,54 +1071,14 @@ def main():
         warsztaty_df = load_warsztaty()
 
     with st.spinner("📂 Wczytywanie list maszyn…"):
-        maszyny_male_df = load_maszyny("LISTA_MASZYN_MALE").copy()
-        maszyny_duze_df = load_maszyny("LISTA_MASZYN_DUZE").copy()
-
-    # ── Cross-referencja: uzupełnij puste KOST w DUZE na podstawie MALE ──
-    # DUZE sheet ma wiele wierszy z pustym KOST ale z "Ostatnie: Nazwa KOST"
-    # np. "S1 ODC1A BIERUŃ-OŚWI" → w MALE ten sam rekord ma KOST = "HTSA"
-    if not maszyny_male_df.empty and not maszyny_duze_df.empty:
-        if "nazwa_kost" in maszyny_male_df.columns and "nazwa_kost" in maszyny_duze_df.columns:
-            # Buduj mapowanie: nazwa_kost → KOST (z MALE, gdzie KOST nie jest pusty)
-            male_valid = maszyny_male_df[
-                (maszyny_male_df["KOST"].notna()) &
-                (~maszyny_male_df["KOST"].isin(["", "nan"])) &
-                (maszyny_male_df["nazwa_kost"] != "")
-            ]
-            nazwa_to_kost = dict(zip(
-                male_valid["nazwa_kost"].str.upper(),
-                male_valid["KOST"]
-            ))
-
-            # Uzupełnij puste KOST w DUZE
-            mask_empty = maszyny_duze_df["KOST"].isin(["", "nan"])
-            filled = 0
-            for idx in maszyny_duze_df[mask_empty].index:
-                nk = str(maszyny_duze_df.at[idx, "nazwa_kost"]).upper()
-                if nk in nazwa_to_kost:
-                    maszyny_duze_df.at[idx, "KOST"] = nazwa_to_kost[nk]
-                    filled += 1
-
-    # Teraz filtruj wiersze z pustym KOST (nie da się zmatchować)
-    if not maszyny_male_df.empty:
-        maszyny_male_df = maszyny_male_df[
-            maszyny_male_df["KOST"].notna() &
-            (~maszyny_male_df["KOST"].isin(["", "nan"]))
-        ].copy()
-    if not maszyny_duze_df.empty:
-        maszyny_duze_df = maszyny_duze_df[
-            maszyny_duze_df["KOST"].notna() &
-            (~maszyny_duze_df["KOST"].isin(["", "nan"]))
-        ].copy()
+        maszyny_male_df = load_maszyny("LISTA_MASZYN_MALE")
+        maszyny_duze_df = load_maszyny("LISTA_MASZYN_DUZE")
 
-    # Wzbogać budowy o liczbę maszyn
-    if not budowy_df.empty and (not maszyny_male_df.empty or not maszyny_duze_df.empty):
-        budowy_df[["maszyny_male", "maszyny_duze"]] = budowy_df["kost"].apply(
-            lambda k: pd.Series(count_machines_for_budowa(k, maszyny_male_df, maszyny_duze_df))
-        )
-    else:
-        budowy_df["maszyny_male"] = None
-        budowy_df["maszyny_duze"] = None
+    # Liczba maszyn per budowa — przeliczana tylko po zmianie któregoś arkusza
+    budowy_fingerprints = tuple(d.attrs.get("fingerprint") for d in (budowy_df, maszyny_male_df, maszyny_duze_df))
+    budowy_df, maszyny_male_df, maszyny_duze_df = enrich_budowy(
+        budowy_fingerprints, budowy_df, maszyny_male_df, maszyny_duze_df,
+    )
 
     # DEBUG — do usunięcia po naprawie
     with st.expander("🔍 DEBUG maszyny", expanded=False):
@@ -1165,11 +1092,27 @@ def main():
         if not budowy_df.empty:
             st.dataframe(budowy_df[["nazwa", "kost", "maszyny_male", "maszyny_duze"]])
 
-    if "mechanicy_df" not in st.session_state:
-        with st.spinner("📂 Wczytywanie i geokodowanie mechaników…"):
-            st.session_state["mechanicy_df"] = load_mechanicy()
-
-    mechanicy_df = st.session_state["mechanicy_df"]
+    # Mechanicy: wspólni dla sesji, przeładowani tylko gdy arkusz się zmienił (odcisk treści)
+    try:
+        mech_fp = sync_sheet("MECHANICY")[0]
+    except Exception:
+        mech_fp = None
+    with st.spinner("📂 Wczytywanie mechaników…"):
+        mechanicy_df = show_messages(shared_mechanicy(mech_fp))
+    pending = mechanicy_df.attrs.get("pending", [])
+
+    if pending:
+        pend_col, pend_btn_col = st.columns([5, 1])
+        with pend_col:
+            st.info(
+                f"⏳ Geokodowanie w tle: {len(pending)} mechaników czeka na lokalizację "
+                f"({', '.join(name for name, _ in pending[:5])}"
+                + (f" i {len(pending)-5} więcej" if len(pending) > 5 else "")
+                + ") — pojawią się na mapie po odświeżeniu."
+            )
+        with pend_btn_col:
+            if st.button("🔄 Sprawdź", key="geocode_pending_refresh"):
+                st.rerun()
 
     if mechanicy_df.empty and budowy_df.empty:
         st.warning("⚠️ Brak danych do wyświetlenia. Sprawdź arkusz Google Sheets.")
@@ -1295,6 +1238,20 @@ def main():
 
         st.markdown("---")
 
+        # ⚡ Tryb szybki — po drogach liczeni tylko najbliżsi kandydaci
+        fast_mode = st.checkbox(
+            "⚡ Tryb szybki (pre-filtr w linii prostej)", value=True, key="fast_mode",
+            help="Po drogach liczeni są tylko najbliżsi kandydaci; pozostali "
+                 "dostają dystans szacunkowy (Haversine) oznaczony w tabeli.",
+        )
+        if fast_mode:
+            prefilter_k = st.number_input("Najbliższych kandydatów", min_value=1, max_value=500,
+                                          value=PREFILTER_TOP_K, step=5, key="prefilter_k")
+            prefilter_radius = st.number_input("+ wszyscy w promieniu (km)", min_value=0, max_value=500,
+                                               value=PREFILTER_RADIUS_KM, step=10, key="prefilter_radius")
+
+        st.markdown("---")
+
         # 🔍 Analizuj dojazdy
         analyze_clicked = st.button(
             "🔍 Analizuj dojazdy",
@@ -1305,10 +1262,11 @@ def main():
 
         # 🔄 Odśwież dane (na dole)
         if st.button("🔄 Odśwież dane", use_container_width=True,
-                     help="Wyczyść cache i wczytaj dane ponownie z Excela."):
-            st.cache_data.clear()
+                     help="Sprawdź zmiany w arkuszach — niezmienione nie są parsowane ponownie."):
+            invalidate_sheets()
+            shared_invalidate()
             for key in list(st.session_state.keys()):
-                if key.startswith(("mechanicy_df", "osrm_available", "saved_", "analysis_")):
+                if key.startswith(("saved_", "analysis_")):
                     del st.session_state[key]
             st.rerun()
 
@@ -1387,108 +1345,70 @@ def main():
 
     st.markdown("")
 
-    # ── C7: Sprawdź dostępność OSRM (tylko raz na sesję, nie przy odświeżaniu danych)
-    if "osrm_available" not in st.session_state:
-        with st.spinner("🌐 Sprawdzanie połączenia OSRM…"):
-            st.session_state["osrm_available"] = check_osrm_available()
-    osrm_down = not st.session_state["osrm_available"]
-    if osrm_down:
+    # ── C7: Dostępność OSRM — wspólna dla sesji, odświeżana co SHARED_HEALTH_TTL_S
+    with st.spinner("🌐 Sprawdzanie połączenia OSRM…"):
+        osrm_down = not shared_routing_available()
+    if osrm_down and get_routing_backend().offline:
+        st.info(
+            "ℹ️ Routing offline (MAPPA_ROUTING=haversine) — trasy szacowane z linii "
+            "prostej (model kalibrowany na trasach z cache)."
+        )
+    elif osrm_down:
         st.warning(
-            "⚠️ Serwer OSRM niedostępny — trasy obliczane w linii prostej "
-            "(Haversine × 1.3). Wyniki mogą być niedokładne."
+            f"⚠️ Serwer OSRM niedostępny ({get_routing_backend().name}) — trasy szacowane "
+            "z linii prostej (model kalibrowany na trasach z cache). Wyniki mogą być niedokładne."
         )
+    else:
+        # Bezpiecznik: OSRM odpowiadał przy sprawdzeniu, ale zapytania w trakcie pracy zawodzą
+        health = get_routing_health().status()
+        if health["bezpiecznik"] != "zamknięty":
+            st.warning(
+                f"⚠️ Routing niestabilny — {health['bledy_z_rzedu']} błędów z rzędu, bezpiecznik "
+                f"{health['bezpiecznik']}: trasy szacowane w linii prostej do czasu powrotu serwera."
+            )
 
     # ── Routing OSRM — TYLKO po kliknięciu Analizuj ──────────────────────
     # ℹ️ Czas trasy pochodzi z OSRM (OpenStreetMap) — nie uwzględnia korków.
     # Dane drogowe aktualizowane co kilka tygodni. Dokładność ±5-15% vs Google Maps.
     if analyze_clicked and dest_name and dest_lat is not None and not analysis_mechanicy.empty:
-        results = []
-
-        # Zbierz warsztaty do analizy
-        ws_to_analyze = warsztaty_df if warsztaty_df is not None and not warsztaty_df.empty else pd.DataFrame()
-        total = len(analysis_mechanicy) + len(ws_to_analyze)
-
-        progress_bar = st.progress(0, text="🛣️ Obliczanie tras OSRM…")
-        idx = 0
-
-        # Mechanicy
-        for _, mech in analysis_mechanicy.iterrows():
-            origin_lat, origin_lon = mech["lat"], mech["lon"]
-            dist_km, dur_min, polyline = get_osrm_route(
-                origin_lat, origin_lon, dest_lat, dest_lon,
-                use_fallback=osrm_down,
-            )
-            if dist_km is not None:
-                koszt = round(dist_km * koszt_za_km, 2)
-                h_ceil = math.ceil(dur_min / 15) * 0.25  # zaokr. w górę do 0.25h (15 min)
-                koszt_rbh = round(h_ceil * STAWKA_RBH_MECHANIKA, 2)
-                koszt_sam = round(h_ceil * STAWKA_SAMOCHODU, 2)
-                results.append({
-                    "Mechanik": mech["mechanik"],
-                    "Warsztat": mech["warsztat"],
-                    "Dystans (km)": dist_km,
-                    "Czas (min)": dur_min,
-                    "Koszt paliwa (PLN)": koszt,
-                    f"Rbh mechanika [{STAWKA_RBH_MECHANIKA:.0f} PLN/h]": koszt_rbh,
-                    f"Koszt samochodu [{STAWKA_SAMOCHODU:.0f} PLN/h]": koszt_sam,
-                    "SUMA kosztów (PLN)": round(koszt + koszt_rbh + koszt_sam, 2),
-                    "_polyline": polyline,
-                    "_is_workshop": False,
-                })
-            idx += 1
-            progress_bar.progress(idx / total, text=f"🛣️ Trasa {idx}/{total}")
-
-        # Warsztaty
-        for _, ws in ws_to_analyze.iterrows():
-            origin_lat, origin_lon = ws["lat"], ws["lon"]
-            dist_km, dur_min, polyline = get_osrm_route(
-                origin_lat, origin_lon, dest_lat, dest_lon,
-                use_fallback=osrm_down,
+        top_k = int(prefilter_k) if fast_mode else PREFILTER_TOP_K
+        radius_km = float(prefilter_radius) if fast_mode else PREFILTER_RADIUS_KM
+        # Ta sama analiza (cel, koszt, tryb, mechanicy, dane) z innej sesji — bez liczenia
+        analysis_key = (
+            round(float(dest_lat), 5), round(float(dest_lon), 5), koszt_za_km,
+            fast_mode, top_k, radius_km, osrm_down,
+            mechanicy_df.attrs.get("fingerprint"), len(pending),
+            warsztaty_df.attrs.get("fingerprint") if warsztaty_df is not None else None,
+            tuple(analysis_mechanicy["mechanik"]),
+        )
+        shared = shared_analysis_get(analysis_key)
+        if shared is not None:
+            shared_age, result_df, routes_for_map = shared
+            cache_stats = None
+        else:
+            shared_age = None
+            stats_before = route_cache_stats()
+            progress_bar = st.progress(0, text="🛣️ Obliczanie macierzy dojazdów OSRM…")
+            result_df, routes_for_map = analyze_destination(
+                analysis_mechanicy, warsztaty_df, dest_lat, dest_lon, koszt_za_km,
+                use_fallback=osrm_down, fast_mode=fast_mode, top_k=top_k, radius_km=radius_km,
+                on_progress=lambda done, tot: progress_bar.progress(
+                    done / tot, text=f"🗺️ Geometria trasy {done}/{tot}"),
             )
-            if dist_km is not None:
-                koszt = round(dist_km * koszt_za_km, 2)
-                h_ceil = math.ceil(dur_min / 15) * 0.25  # zaokr. w górę do 0.25h (15 min)
-                koszt_rbh = round(h_ceil * STAWKA_RBH_MECHANIKA, 2)
-                koszt_sam = round(h_ceil * STAWKA_SAMOCHODU, 2)
-                results.append({
-                    "Mechanik": f"🔧 {ws['nazwa']}",
-                    "Warsztat": ws["nazwa"],
-                    "Dystans (km)": dist_km,
-                    "Czas (min)": dur_min,
-                    "Koszt paliwa (PLN)": koszt,
-                    f"Rbh mechanika [{STAWKA_RBH_MECHANIKA:.0f} PLN/h]": koszt_rbh,
-                    f"Koszt samochodu [{STAWKA_SAMOCHODU:.0f} PLN/h]": koszt_sam,
-                    "SUMA kosztów (PLN)": round(koszt + koszt_rbh + koszt_sam, 2),
-                    "_polyline": polyline,
-                    "_is_workshop": True,
-                })
-            idx += 1
-            progress_bar.progress(idx / total, text=f"🛣️ Trasa {idx}/{total} (warsztaty)")
-
-        progress_bar.empty()
-
-        if results:
-            result_df = pd.DataFrame(results).sort_values(
-                "Dystans (km)"
-            ).reset_index(drop=True)
-
-            routes_for_map = []
-            for i, (_, row) in enumerate(result_df.iterrows()):
-                if row["_polyline"]:
-                    routes_for_map.append({
-                        "polyline": row["_polyline"],
-                        "label": row["Mechanik"],
-                        "dist": row["Dystans (km)"],
-                        "dur": row["Czas (min)"],
-                        "is_best": i == 0,
-                        "is_workshop": row.get("_is_workshop", False),
-                    })
+            progress_bar.empty()
+            stats_after = route_cache_stats()
+            cache_stats = {k: stats_after[k] - stats_before[k] for k in ("hit", "miss")}
+            if not result_df.empty:
+                shared_analysis_put(analysis_key, result_df, routes_for_map)
 
+        if not result_df.empty:
             # Zapisz wyniki do session_state
             st.session_state["analysis_results"] = result_df
             st.session_state["analysis_routes"] = routes_for_map
             st.session_state["analysis_target"] = dest_name
             st.session_state["analysis_koszt_za_km"] = koszt_za_km
+            st.session_state["analysis_cache_stats"] = cache_stats
+            st.session_state["analysis_shared_age"] = shared_age
         else:
             # Brak wyników — wyczyść
             st.session_state.pop("analysis_results", None)
@@ -1502,7 +1422,10 @@ def main():
     # ── Layout: Mapa + Tabela ────────────────────────────────────────────
     col_map, col_table = st.columns([2, 3])
 
-    with col_map:
+    # Mapa jako fragment: zmiana stylu / warstw przelicza tylko mapę,
+    # a widżety spoza fragmentu nie przebudowują jej ponad potrzebę.
+    @st.fragment
+    def _map_panel():
         # Nagłówek mapy + wybór stylu + filtry warstw
         map_hdr_col, map_tile_col = st.columns([1, 2])
         with map_hdr_col:
@@ -1526,21 +1449,54 @@ def main():
             show_mechanicy = st.checkbox("👷 Mechanicy", value=True, key="lf_mechanicy")
         with lf4:
             show_trasy = st.checkbox("🛣️ Trasy", value=True, key="lf_trasy")
+        n_points = len(filtered_mechanicy) + len(budowy_df) + len(warsztaty_df)
+        vector_layers = st.toggle(
+            "⚡ Tryb wektorowy (GeoJSON)",
+            value=n_points > MAP_VECTOR_THRESHOLD,
+            key="map_vector_layers",
+            help="Każda warstwa punktów jako jedna kolekcja GeoJSON zamiast "
+                 "pojedynczych markerów — mniejsza strona i szybsze rysowanie "
+                 "przy tysiącach punktów.",
+        )
 
-        fmap = build_map(
-            filtered_mechanicy, budowy_df, warsztaty_df,
-            selected_budowa=selected_budowa,
-            routes=routes_for_map,
-            tile_key=tile_key,
-            use_clusters=True,
-            show_budowy=show_budowy,
-            show_warsztaty=show_warsztaty,
-            show_mechanicy=show_mechanicy,
-            show_trasy=show_trasy,
-            all_mechanicy_df=mechanicy_df,
+        t_start = time.perf_counter()
+        # Mapa bazowa z cache — przebudowa tylko po zmianie danych, filtrów lub opcji
+        base = static_map(
+            (mechanicy_df.attrs.get("fingerprint"), len(pending), budowy_fingerprints,
+             warsztaty_df.attrs.get("fingerprint") if warsztaty_df is not None else None,
+             tuple(selected_warsztaty or ()), tuple(selected_mechanicy or ())),
+            tile_key, vector_layers, show_budowy, show_warsztaty, show_mechanicy,
+            filtered_mechanicy, budowy_df, warsztaty_df, mechanicy_df,
+        )
+        fmap = base["map"]
+        # Wybrana budowa, trasy, przydział — warstwy dynamiczne (mapa bazowa bez zmian)
+        extra_layers = []
+        if selected_budowa and show_budowy:
+            extra_layers.append(build_selection_layer(budowy_df, selected_budowa))
+        if routes_for_map and show_trasy:
+            extra_layers.append(build_routes_layer(routes_for_map))
+        assign_df = st.session_state.get("assignment")
+        if assign_df is not None and not assign_df.empty:
+            extra_layers.append(build_assignment_layer(assign_df))
+        if st.session_state.get("tour_routes"):
+            extra_layers.append(build_tours_layer(st.session_state["tour_routes"]))
+        t_built = time.perf_counter()
+        # Mapa bazowa wyrenderowana już w static_map. st_folium dopina warstwy
+        # dynamiczne do (wspólnego) obiektu mapy — po narysowaniu są odpinane.
+        with base["lock"]:
+            try:
+                st_folium(fmap, use_container_width=True, height=650, returned_objects=[],
+                          feature_group_to_add=extra_layers or None, render=False)
+            finally:
+                for layer in extra_layers:
+                    fmap._children.pop(layer.get_name(), None)
+        t_done = time.perf_counter()
+        st.caption(
+            f"⏱️ Mapa: budowa {(t_built - t_start) * 1000:.0f} ms, "
+            f"render {(t_done - t_built) * 1000:.0f} ms · "
+            f"📦 mapa bazowa ~{base['kb']:,.0f} KB ({'wektorowo' if vector_layers else 'markery'}, "
+            f"{n_points} pkt; bez warstw tras)"
         )
-        # Kliknięcie na budowę → automatycznie ustawia cel
-        st_folium(fmap, use_container_width=True, height=650, returned_objects=[])
 
         # Legenda tras (pod mapą)
         if routes_for_map:
@@ -1564,11 +1520,14 @@ def main():
                 unsafe_allow_html=True,
             )
 
+    with col_map:
+        _map_panel()
+
     with col_table:
         st.markdown("### 📊 Analiza Dojazdów")
 
         if result_df is not None and not result_df.empty:
-            display_df = result_df.drop(columns=["_polyline", "_is_workshop", "Warsztat"], errors="ignore")
+            display_df = result_df.drop(columns=["_polyline", "_is_workshop", "_lat", "_lon", "Warsztat"], errors="ignore")
             ws_flags = result_df["_is_workshop"].tolist() if "_is_workshop" in result_df.columns else None
 
             # Najlepszy wynik
@@ -1584,6 +1543,39 @@ def main():
                 unsafe_allow_html=True,
             )
 
+            cache_stats = st.session_state.get("analysis_cache_stats")
+            shared_age = st.session_state.get("analysis_shared_age")
+            if shared_age is not None:
+                age = f"{shared_age:.0f} s" if shared_age < 120 else f"{shared_age / 60:.0f} min"
+                st.caption(f"♻️ Wynik wspólny dla sesji — policzony {age} temu "
+                           f"dla tych samych danych i parametrów.")
+            elif cache_stats:
+                st.caption(
+                    f"💾 Cache tras: {cache_stats['hit']} trafień, "
+                    f"{cache_stats['miss']} pobranych z OSRM"
+                )
+            if "Źródło" in result_df.columns:
+                n_est = int((result_df["Źródło"] == "szacunek").sum())
+                if n_est:
+                    st.caption(f"≈ {n_est} pozycji oszacowano z linii prostej "
+                               f"(Źródło = szacunek) — poza zakresem trybu szybkiego lub bez OSRM.")
+                    model = fallback_model()
+                    ev = model.evaluation
+                    if ev:
+                        st.caption(
+                            f"📐 Szacunek kalibrowany na {model.n_routes} trasach z cache. Błąd na "
+                            f"{ev['trasy_testowe']} odłożonych trasach (mediana): dystans "
+                            f"{ev['dystans_blad_mediana_pct']}% (× {FALLBACK_DETOUR}: "
+                            f"{ev['dystans_bazowy_mediana_pct']}%), czas {ev['czas_blad_mediana_pct']}% "
+                            f"({FALLBACK_SPEED_KMH:.0f} km/h: {ev['czas_bazowy_mediana_pct']}%)."
+                        )
+                    else:
+                        st.caption(f"📐 Szacunek bez kalibracji (za mało tras w cache): linia prosta "
+                                   f"× {FALLBACK_DETOUR}, {FALLBACK_SPEED_KMH:.0f} km/h.")
+            if result_df.attrs.get("budzet_wyczerpany"):
+                st.caption(f"⏱️ Wyczerpano limit czasu analizy ({ANALYSIS_BUDGET_S:.0f} s) — "
+                           "pozostałe trasy oszacowano zamiast czekać na serwer.")
+
             # Tabela z podświetleniem najlepszego
             fmt_df = display_df.copy()
             fmt_df["Dystans (km)"] = fmt_df["Dystans (km)"].apply(lambda x: f"{x:.1f}")
@@ -1594,12 +1586,11 @@ def main():
             st.markdown(_render_table(fmt_df, highlight_row=0, workshop_flags=ws_flags), unsafe_allow_html=True)
 
             # Eksport CSV
-            csv_data = display_df.to_csv(index=False, sep=";", decimal=",")
             target_name = analysis_target or selected_budowa or "analiza"
             st.download_button(
                 label="📥 Pobierz Raport (.csv)",
-                data=csv_data.encode("utf-8-sig"),
-                file_name=f"raport_{target_name.replace(' ', '_')}.csv",
+                data=report_csv(result_df),
+                file_name=report_filename(target_name),
                 mime="text/csv",
                 use_container_width=True,
             )
@@ -1610,7 +1601,7 @@ def main():
             st.markdown("---")
             st.markdown("#### 🔧 Podział wg warsztatów")
             # Warsztat jest w result_df (nie w display_df bo usunięty)
-            ws_df = result_df.drop(columns=["_polyline", "_is_workshop"], errors="ignore")
+            ws_df = result_df.drop(columns=["_polyline", "_is_workshop", "_lat", "_lon"], errors="ignore")
             suma_col = [c for c in ws_df.columns if "SUMA" in str(c)]
             agg_dict = {
                 "Mechaników": ("Mechanik", "count"),
@@ -1636,55 +1627,155 @@ def main():
         chart_budowa = analysis_target or selected_budowa or ""
         st.markdown("---")
         st.markdown("### 📊 Wykres porównawczy")
-        chart_df = result_df.drop(columns=["_polyline", "_is_workshop"], errors="ignore").copy()
-        chart_metric = st.radio(
-            "Metryka wykresu:",
-            ["Dystans (km)", "Czas (min)", "Koszt paliwa (PLN)"],
-            horizontal=True,
-            key="chart_metric",
-        )
-        fig = px.bar(
-            chart_df.sort_values(chart_metric),
-            x="Mechanik",
-            y=chart_metric,
-            color="Warsztat",
-            text_auto=True,
-            title=f"{chart_metric} — dojazd na {chart_budowa}",
-            color_discrete_sequence=px.colors.qualitative.Set2,
-        )
-        fig.update_layout(
-            xaxis_tickangle=-45,
-            height=400,
-            margin=dict(t=40, b=80),
-            template="plotly_dark" if dark_mode else "plotly",
-            paper_bgcolor="rgba(0,0,0,0)" if dark_mode else "#ffffff",
-            plot_bgcolor="rgba(0,0,0,0)" if dark_mode else "#f8fafc",
-            font_color="#e2e8f0" if dark_mode else "#1e293b",
-        )
-        st.plotly_chart(fig, use_container_width=True)
+        chart_df = result_df.drop(columns=["_polyline", "_is_workshop", "_lat", "_lon"], errors="ignore").copy()
+        _chart_panel(chart_df, chart_budowa, dark_mode)
 
     # ── C2: Porównanie wielu budów ───────────────────────────────────
     if not budowy_df.empty and not analysis_mechanicy.empty:
         with st.expander("🔁 Porównanie wielu budów — najlepszy mechanik dla każdej"):
-            comparison_rows = []
-            for _, bud in budowy_df.iterrows():
-                best_dist = float("inf")
-                best_name = ""
-                best_warsz = ""
-                for _, mech in analysis_mechanicy.iterrows():
-                    d = haversine_km(mech["lat"], mech["lon"], bud["lat"], bud["lon"])
-                    if d < best_dist:
-                        best_dist = d
-                        best_name = mech["mechanik"]
-                        best_warsz = mech["warsztat"]
-                comparison_rows.append({
-                    "Budowa": bud["nazwa"],
-                    "Najlepszy mechanik": best_name,
-                    "Warsztat": best_warsz,
-                    "Dystans (km, linia prosta)": round(best_dist, 1),
-                })
-            comp_df = pd.DataFrame(comparison_rows)
-            st.markdown(_render_table(comp_df), unsafe_allow_html=True)
+            matrix_key = cost_matrix_key(analysis_mechanicy, budowy_df, koszt_za_km)
+            matrix_df = load_cost_matrix()
+            matrix_ok = matrix_df is not None and matrix_df.attrs.get("klucz") == matrix_key
+            mx_col1, mx_col2 = st.columns([3, 2])
+            with mx_col1:
+                if matrix_ok:
+                    st.caption(
+                        f"🧮 Macierz kosztów po drogach: {matrix_df['mechanik'].nunique()} mech. × "
+                        f"{matrix_df['budowa'].nunique()} budów, z {matrix_df.attrs.get('utworzono', '?')}"
+                    )
+                else:
+                    st.caption("📏 Linia prosta (Haversine) — macierz kosztów po drogach "
+                               "nieaktualna lub nie została jeszcze policzona.")
+            with mx_col2:
+                if st.button("🧮 Przelicz macierz kosztów (drogi)", use_container_width=True):
+                    mx_progress = st.progress(0, text="🧮 Macierz kosztów…")
+                    matrix_df = compute_cost_matrix(
+                        analysis_mechanicy, budowy_df, koszt_za_km, use_fallback=osrm_down,
+                        on_progress=lambda done, tot: mx_progress.progress(
+                            done / tot, text=f"🧮 Macierz kosztów: blok {done}/{tot}"),
+                    )
+                    save_cost_matrix(matrix_df)
+                    st.session_state.pop("assignment", None)
+                    route_cache_evict()
+                    mx_progress.empty()
+                    matrix_ok = True
+            if matrix_ok:
+                st.markdown(_render_table(best_per_site(matrix_df)), unsafe_allow_html=True)
+                site_pick = st.selectbox(
+                    "Ranking mechaników dla budowy:",
+                    options=sorted(matrix_df["budowa"].astype(str).unique()),
+                    key="matrix_site",
+                )
+                site_df = (matrix_df[matrix_df["budowa"] == site_pick]
+                           .sort_values("suma").head(20)
+                           .drop(columns=["budowa"])
+                           .rename(columns=COST_MATRIX_LABELS))
+                st.markdown(_render_table(site_df), unsafe_allow_html=True)
+
+                # Optymalny przydział — jeden mechanik nie „wygrywa” kilku budów naraz
+                st.markdown("#### 🧩 Optymalny przydział (min. łączna SUMA kosztów)")
+                as_col1, as_col2, as_col3 = st.columns([2, 2, 2])
+                with as_col1:
+                    max_sites = st.number_input("Maks. budów na mechanika", min_value=1,
+                                                max_value=10, value=1, key="assign_max_sites")
+                with as_col2:
+                    ws_quota = st.number_input("Limit przydziałów na warsztat (0 = brak)",
+                                               min_value=0, value=0, key="assign_ws_quota")
+                with as_col3:
+                    st.markdown("")
+                    assign_clicked = st.button("🧩 Przydziel", use_container_width=True)
+                if assign_clicked:
+                    t_assign = time.perf_counter()
+                    st.session_state["assignment"] = assignment_from_matrix(
+                        matrix_df, analysis_mechanicy, budowy_df,
+                        max_sites_per_mech=int(max_sites), workshop_quota=int(ws_quota),
+                    )
+                    st.session_state["assignment_ms"] = (time.perf_counter() - t_assign) * 1000
+                    st.rerun()  # mapa (wyżej na stronie) rysuje nowy przydział
+                assign_df = st.session_state.get("assignment")
+                if assign_df is not None and not assign_df.empty:
+                    greedy_total = best_per_site(matrix_df)["SUMA kosztów (PLN)"].sum()
+                    st.caption(
+                        f"Obsadzone budowy: {len(assign_df)}/{matrix_df['budowa'].nunique()} · "
+                        f"łącznie {assign_df['SUMA kosztów (PLN)'].sum():,.2f} PLN "
+                        f"(zachłannie, z powtórzeniami mechaników: {greedy_total:,.2f} PLN) · "
+                        f"⏱️ {st.session_state.get('assignment_ms', 0):.0f} ms"
+                    )
+                    st.markdown(
+                        _render_table(assign_df.drop(columns=[c for c in assign_df.columns
+                                                              if c.startswith("_")])),
+                        unsafe_allow_html=True,
+                    )
+                    if st.button("✖ Usuń przydział z mapy", key="assign_clear"):
+                        st.session_state.pop("assignment", None)
+                        st.rerun()
+            else:
+                comp_df = compare_sites_nearest(
+                    budowy_df[["nazwa", "lat", "lon"]],
+                    analysis_mechanicy[["mechanik", "warsztat", "lat", "lon"]],
+                )
+                st.markdown(_render_table(comp_df), unsafe_allow_html=True)
+
+    # ── Trasy dzienne: kilka budów na mechanika ──────────────────────
+    if not budowy_df.empty and not analysis_mechanicy.empty:
+        with st.expander("🚐 Trasy dzienne — kilka budów na mechanika"):
+            service = service_minutes(
+                budowy_df.get("maszyny_male", pd.Series(0, index=budowy_df.index)),
+                budowy_df.get("maszyny_duze", pd.Series(0, index=budowy_df.index)),
+            )
+            tr_col1, tr_col2 = st.columns(2)
+            with tr_col1:
+                tour_mechs = st.multiselect(
+                    "Mechanicy",
+                    options=analysis_mechanicy["mechanik"].tolist(),
+                    default=analysis_mechanicy["mechanik"].head(3).tolist(),
+                    key="tour_mechs",
+                )
+            with tr_col2:
+                tour_sites = st.multiselect(
+                    f"Budowy (obsługa: {MINUTY_MASZYNA_MALA} min/mała, {MINUTY_MASZYNA_DUZA} min/duża maszyna)",
+                    options=budowy_df["nazwa"].tolist(),
+                    default=budowy_df.loc[service > 0, "nazwa"].tolist(),
+                    key="tour_sites",
+                )
+            tw1, tw2, tw3, tw4 = st.columns(4)
+            with tw1:
+                t_day = st.time_input("Wyjazd z domu", value=dt_time(7, 0), key="tour_day_start")
+            with tw2:
+                t_open = st.time_input("Budowy od", value=dt_time(7, 0), key="tour_win_start")
+            with tw3:
+                t_close = st.time_input("Budowy do", value=dt_time(15, 0), key="tour_win_end")
+            with tw4:
+                shift_h = st.number_input("Maks. zmiana (h)", min_value=1.0, max_value=16.0,
+                                          value=10.0, step=0.5, key="tour_shift")
+            if st.button("🚐 Zaplanuj trasy", disabled=not (tour_mechs and tour_sites)):
+                with st.spinner("🚐 Planowanie tras dziennych…"):
+                    tours_df, tour_routes, unassigned = plan_daily_tours(
+                        analysis_mechanicy[analysis_mechanicy["mechanik"].isin(tour_mechs)],
+                        budowy_df[budowy_df["nazwa"].isin(tour_sites)],
+                        koszt_za_km,
+                        day_start=t_day.hour * 60 + t_day.minute,
+                        window_start=t_open.hour * 60 + t_open.minute,
+                        window_end=t_close.hour * 60 + t_close.minute,
+                        shift_max=shift_h * 60,
+                        use_fallback=osrm_down,
+                    )
+                st.session_state["tours"] = tours_df
+                st.session_state["tour_routes"] = tour_routes
+                st.session_state["tours_unassigned"] = unassigned
+                st.rerun()  # mapa (wyżej na stronie) rysuje nowe trasy
+            tours_df = st.session_state.get("tours")
+            if tours_df is not None and not tours_df.empty:
+                st.caption(f"Łącznie: {tours_df['SUMA kosztów (PLN)'].sum():,.2f} PLN · "
+                           f"{tours_df['Dystans (km)'].sum():,.1f} km")
+                st.markdown(_render_table(tours_df), unsafe_allow_html=True)
+            if st.session_state.get("tours_unassigned"):
+                st.warning("⚠️ Nie zmieściły się w oknie / zmianie: "
+                           + ", ".join(st.session_state["tours_unassigned"]))
+            if tours_df is not None and st.button("✖ Usuń trasy dzienne z mapy", key="tours_clear"):
+                for key in ("tours", "tour_routes", "tours_unassigned"):
+                    st.session_state.pop(key, None)
+                st.rerun()
 
     # ── Stopka centralna ──────────────────────────────────────────────────
     st.markdown(
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+MAPPA — lokalne API HTTP (asyncio)
+==================================
+„Najlepszy mechanik dla budowy X” dla innych systemów (dyspozytornia, ERP)
+— ten sam silnik co w aplikacji (mappa_core), bez Streamlit. Jeden proces,
+wspólne ciepłe cache dla wszystkich klientów:
+  - dane (arkusze / pliki CSV) parsowane tylko po zmianie treści (odcisk),
+  - wyniki analiz w pamięci (API_RESULT_TTL_S) + cache tras SQLite,
+  - identyczne zapytania w toku są scalane — liczone raz, wynik dla wszystkich.
+Obliczenia (routing, koszty) w puli wątków; pętla asyncio tylko obsługuje
+połączenia. Bez nowych zależności — serwer na asyncio z biblioteki standardowej.
+
+Uruchomienie:  python mappa_api.py --port 8600 [--mechanicy m.csv --budowy b.csv]
+
+Endpointy (GET, odpowiedzi JSON):
+  /ranking?budowa=NAZWA             ranking mechaników i warsztatów dla budowy
+  /ranking?lat=50.1&lon=19.9        … lub dla dowolnego punktu
+      &top=10 &cena_paliwa=6.5 &spalanie=10 &szybki=1 &warsztat=W (wiele razy)
+  /macierz?budowa=A&budowa=B        najtańszy mechanik per budowa (bez budowa — wszystkie)
+      &pelna=1                      + wszystkie pary mechanik × budowa
+  /cache                            stan cache (trasy, wyniki, zapytania w toku, dane)
+  /health                           backend routingu, dostępność, bezpiecznik i opóźnienia
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+import mappa_core as core
+
+API_RESULT_TTL_S = 300        # jak długo wynik analizy jest aktualny (dane bez zmian)
+API_RESULT_MAX_ENTRIES = 256  # powyżej — usuwane najdawniej używane
+API_HEALTH_TTL_S = 60         # co ile sprawdzać dostępność routingu
+API_WORKERS = 4               # równoległych obliczeń (każde ma też własną pulę zapytań OSRM)
+CENA_PALIWA = 6.50            # PLN/litr — domyślnie jak w aplikacji
+SPALANIE = 10.0               # l/100 km
+SHEET_PARSERS = {
+    "BUDOWY": core.parse_budowy,
+    "MECHANICY": core.parse_mechanicy,
+    "WARSZTATY": core.parse_warsztaty,
+}
+
+
+class ApiError(Exception):
+    """Błąd zapytania → odpowiedź HTTP z kodem status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _param(query: dict, name: str, default=None, cast=str):
+    raw = query.get(name, [None])[0]
+    if raw is None or raw == "":
+        return default
+    try:
+        return cast(raw)
+    except ValueError:
+        raise ApiError(400, f"Nieprawidłowy parametr {name}: {raw!r}")
+
+
+def _records(df) -> list:
+    """DataFrame → lista słowników zgodnych z JSON (bez typów numpy)."""
+    return json.loads(df.to_json(orient="records", force_ascii=False))
+
+
+class AnalysisService:
+    """Stan współdzielony przez wszystkie zapytania: dane, wyniki, zapytania w toku."""
+
+    def __init__(self, files: dict = None, workers: int = API_WORKERS):
+        self.files = files or {}          # arkusz → plik CSV zamiast Google Sheets
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._tables = {}                 # arkusz → (odcisk, DataFrame)
+        self._tables_lock = threading.Lock()
+        self._results = OrderedDict()     # klucz → (czas, wynik); tylko wątek pętli
+        self._inflight = {}               # klucz → asyncio.Future
+        self.stats = {"obliczone": 0, "z_cache": 0, "scalone": 0}
+
+    # ── Dane ────────────────────────────────────────────────────────────────
+    def _source(self, sheet: str) -> tuple:
+        path = self.files.get(sheet)
+        if path is None:
+            return core.sync_sheet(sheet)
+        with open(path, "rb") as f:
+            content = f.read()
+        return hashlib.sha1(content).hexdigest(), content
+
+    def table(self, sheet: str):
+        """Arkusz jako DataFrame — parsowany ponownie tylko po zmianie treści
+        (albo gdy geokodowanie w tle dostarczyło brakujące współrzędne)."""
+        fingerprint, content = self._source(sheet)
+        with self._tables_lock:
+            cached = self._tables.get(sheet)
+            if cached and cached[0] == fingerprint:
+                pending = cached[1].attrs.get("pending", [])
+                if not any(core.geocode_status(adres) != "pending" for _, adres in pending):
+                    return cached[1]
+            df = SHEET_PARSERS[sheet](fingerprint, content)
+            for _, text in df.attrs.get("komunikaty", []):
+                print(f"[{sheet}] {text}", file=sys.stderr)
+            self._tables[sheet] = (fingerprint, df)
+            return df
+
+    def data(self) -> tuple:
+        """(mechanicy_df, warsztaty_df, budowy_df) — wywoływać w puli wątków.
+        Warsztaty są opcjonalne (jak w aplikacji): błąd odczytu = brak warsztatów."""
+        out = []
+        for sheet in ("MECHANICY", "WARSZTATY", "BUDOWY"):
+            try:
+                out.append(self.table(sheet))
+            except Exception as e:
+                if sheet != "WARSZTATY":
+                    raise ApiError(503, f"Nie można wczytać arkusza {sheet}: {e}")
+                out.append(pd.DataFrame())
+        return tuple(out)
+
+    # ── Scalanie zapytań i cache wyników ───────────────────────────────────
+    async def coalesced(self, key: tuple, fn, *args, ttl: float = API_RESULT_TTL_S):
+        """Wynik fn(*args) liczony w puli wątków — raz na klucz: świeży wynik
+        z pamięci, a równoczesne identyczne zapytania czekają na to samo obliczenie."""
+        hit = self._results.get(key)
+        if hit and time.monotonic() - hit[0] < ttl:
+            self._results.move_to_end(key)
+            self.stats["z_cache"] += 1
+            return hit[1]
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["scalone"] += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        self._inflight[key] = future
+        try:
+            result = await asyncio.shield(future)
+        finally:
+            self._inflight.pop(key, None)
+        self.stats["obliczone"] += 1
+        self._results[key] = (time.monotonic(), result)
+        while len(self._results) > API_RESULT_MAX_ENTRIES:
+            self._results.popitem(last=False)
+        return result
+
+    async def routing_ok(self) -> bool:
+        return await self.coalesced(("zdrowie",), core.check_osrm_available, ttl=API_HEALTH_TTL_S)
+
+    # ── Endpointy ───────────────────────────────────────────────────────────
+    async def health(self, query: dict) -> dict:
+        ok = await self.routing_ok()
+        return {"backend": core.get_routing_backend().name, "dostepny": ok,
+                "szacunek": not ok, "zapytania": core.get_routing_health().status(),
+                "model_szacunku": core.fallback_model().evaluation}
+
+    async def ranking(self, query: dict) -> dict:
+        mechanicy_df, warsztaty_df, budowy_df = await self._data()
+        budowa = _param(query, "budowa")
+        if budowa is not None:
+            match = budowy_df[budowy_df["nazwa"] == budowa] if not budowy_df.empty else budowy_df
+            if match.empty:
+                raise ApiError(404, f"Nie znaleziono budowy: {budowa}")
+            dest_lat, dest_lon = float(match.iloc[0]["lat"]), float(match.iloc[0]["lon"])
+        else:
+            dest_lat, dest_lon = _param(query, "lat", cast=float), _param(query, "lon", cast=float)
+            if dest_lat is None or dest_lon is None:
+                raise ApiError(400, "Podaj budowa=NAZWA albo lat= i lon=")
+        warsztaty = tuple(sorted(query.get("warsztat", [])))
+        if warsztaty:
+            mechanicy_df = mechanicy_df[mechanicy_df["warsztat"].isin(warsztaty)]
+        if mechanicy_df.empty:
+            raise ApiError(404, "Brak mechaników do analizy")
+        koszt_za_km = round(_param(query, "cena_paliwa", CENA_PALIWA, float)
+                            * _param(query, "spalanie", SPALANIE, float) / 100, 4)
+        fast_mode = _param(query, "szybki", 0, int) == 1
+        top = _param(query, "top", 10, int)
+        use_fallback = not await self.routing_ok()
+
+        key = ("ranking", round(dest_lat, core.ROUTE_CACHE_DECIMALS), round(dest_lon, core.ROUTE_CACHE_DECIMALS),
+               koszt_za_km, fast_mode, warsztaty, use_fallback, self._fingerprints())
+        result_df = await self.coalesced(
+            key, self._analyze, mechanicy_df, warsztaty_df, dest_lat, dest_lon,
+            koszt_za_km, use_fallback, fast_mode,
+        )
+        return {
+            "cel": {"budowa": budowa, "lat": dest_lat, "lon": dest_lon},
+            "koszt_za_km": koszt_za_km,
+            "liczba": len(result_df),
+            "ranking": _records(core.report_frame(result_df).head(top)),
+        }
+
+    @staticmethod
+    def _analyze(mechanicy_df, warsztaty_df, dest_lat, dest_lon, koszt_za_km, use_fallback, fast_mode):
+        result_df, _ = core.analyze_destination(
+            mechanicy_df, warsztaty_df, dest_lat, dest_lon, koszt_za_km,
+            use_fallback=use_fallback, fast_mode=fast_mode, geometry_top_n=0,
+        )
+        return result_df
+
+    async def matrix(self, query: dict) -> dict:
+        mechanicy_df, _, budowy_df = await self._data()
+        budowy = tuple(sorted(query.get("budowa", [])))
+        if budowy and not budowy_df.empty:
+            missing = sorted(set(budowy) - set(budowy_df["nazwa"]))
+            if missing:
+                raise ApiError(404, f"Nie znaleziono budów: {', '.join(missing)}")
+            budowy_df = budowy_df[budowy_df["nazwa"].isin(budowy)]
+        if budowy_df.empty or mechanicy_df.empty:
+            raise ApiError(404, "Brak budów lub mechaników do analizy")
+        koszt_za_km = round(_param(query, "cena_paliwa", CENA_PALIWA, float)
+                            * _param(query, "spalanie", SPALANIE, float) / 100, 4)
+        use_fallback = not await self.routing_ok()
+
+        key = ("macierz", budowy, koszt_za_km, use_fallback, self._fingerprints())
+        matrix_df = await self.coalesced(key, core.compute_cost_matrix,
+                                         mechanicy_df, budowy_df, koszt_za_km, use_fallback)
+        body = {
+            "koszt_za_km": koszt_za_km,
+            "ksztalt": matrix_df.attrs.get("ksztalt"),
+            "najlepsi": _records(core.best_per_site(matrix_df)),
+        }
+        if _param(query, "pelna", 0, int) == 1:
+            body["pary"] = _records(matrix_df.assign(budowa=matrix_df["budowa"].astype(str)))
+        return body
+
+    async def cache_status(self, query: dict) -> dict:
+        with self._tables_lock:
+            tables = dict(self._tables)
+        return {
+            "trasy": core.route_cache_stats(),
+            "api": dict(self.stats, wyniki=len(self._results), w_toku=len(self._inflight)),
+            "dane": {sheet: {"odcisk": fp, "wiersze": len(df)}
+                     for sheet, (fp, df) in tables.items()},
+        }
+
+    async def _data(self) -> tuple:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.data)
+
+    def _fingerprints(self) -> tuple:
+        """Odciski danych — część klucza wyniku (zmiana arkusza = nowe obliczenie)."""
+        with self._tables_lock:
+            return tuple((sheet, fp, len(df.attrs.get("pending", [])))
+                         for sheet, (fp, df) in sorted(self._tables.items()))
+
+
+# ── Serwer HTTP (asyncio, HTTP/1.1 keep-alive) ──────────────────────────────
+class ApiServer:
+    def __init__(self, service: AnalysisService):
+        self.service = service
+        self.routes = {
+            "/ranking": service.ranking,
+            "/macierz": service.matrix,
+            "/cache": service.cache_status,
+            "/health": service.health,
+        }
+
+    async def dispatch(self, method: str, target: str) -> tuple:
+        url = urlsplit(target)
+        handler = self.routes.get(url.path.rstrip("/") or "/")
+        try:
+            if handler is None:
+                raise ApiError(404, f"Nieznany endpoint: {url.path}")
+            if method != "GET":
+                raise ApiError(405, "Obsługiwane tylko GET")
+            return 200, await handler(parse_qs(url.query))
+        except ApiError as e:
+            return e.status, {"blad": str(e)}
+        except Exception as e:
+            return 500, {"blad": f"{type(e).__name__}: {e}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, target, version = line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    raw = await reader.readline()
+                    if raw in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = raw.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip().lower()
+                if int(headers.get("content-length", 0) or 0):
+                    await reader.readexactly(int(headers["content-length"]))
+                connection = headers.get("connection", "")
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+                status, body = await self.dispatch(method, target)
+                payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        addr = server.sockets[0].getsockname()
+        print(f"MAPPA API: http://{addr[0]}:{addr[1]} (routing: {core.get_routing_backend().name})")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MAPPA — lokalne API HTTP (ranking, macierz, cache)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--budowy", metavar="CSV", help="zamiast arkusza BUDOWY")
+    parser.add_argument("--mechanicy", metavar="CSV", help="zamiast arkusza MECHANICY")
+    parser.add_argument("--warsztaty", metavar="CSV", help="zamiast arkusza WARSZTATY")
+    parser.add_argument("--watki", type=int, default=API_WORKERS, help="równoległych obliczeń")
+    args = parser.parse_args()
+    files = {sheet: path for sheet, path in (("BUDOWY", args.budowy), ("MECHANICY", args.mechanicy),
+                                             ("WARSZTATY", args.warsztaty)) if path}
+    try:
+        asyncio.run(ApiServer(AnalysisService(files, args.watki)).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+MAPPA — raporty wsadowe bez interfejsu
+======================================
+Analiza dojazdów mechaników (i warsztatów) do wielu celów naraz — ten sam
+silnik co w aplikacji (mappa_core), bez Streamlit. Dla każdego celu jeden
+raport CSV w formacie MAPPA_Raporty: raport_<CEL>_<RRRR-MM-DD_GG-MM>.csv.
+
+Dane domyślnie z Google Sheets (BUDOWY, MECHANICY, WARSZTATY); każdy arkusz
+można zastąpić plikiem CSV o tych samych kolumnach.
+
+Przykłady:
+  python mappa_cli.py                                  # wszystkie budowy z arkusza
+  python mappa_cli.py --budowa "BUDOWA MIKOŁÓW" --szybki
+  python mappa_cli.py --cele cele.csv --mechanicy mechanicy.csv --katalog raporty/
+"""
+
+import argparse
+import hashlib
+import sys
+import time
+from datetime import datetime
+
+import mappa_core as core
+
+
+def _read_csv_file(path: str, parse):
+    """Plik CSV w formacie arkusza → DataFrame przez parser arkusza."""
+    with open(path, "rb") as f:
+        content = f.read()
+    return parse(hashlib.sha1(content).hexdigest(), content)
+
+
+def _report_messages(df, label: str):
+    """Komunikaty silnika (df.attrs["komunikaty"]) na stderr; True, gdy był błąd."""
+    failed = False
+    for level, text in df.attrs.get("komunikaty", []):
+        print(f"[{label}] {text}", file=sys.stderr)
+        failed |= level == "error"
+    return failed
+
+
+def _wait_for_geocoding(mechanicy_df, load, timeout_s: float):
+    """Poczekaj (max timeout_s) na geokodowanie w tle i wczytaj mechaników ponownie."""
+    deadline = time.monotonic() + timeout_s
+    pending = mechanicy_df.attrs.get("pending", [])
+    while pending and time.monotonic() < deadline:
+        time.sleep(1.0)
+        if all(core.geocode_status(adres) != "pending" for _, adres in pending):
+            break
+    return load() if pending else mechanicy_df
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="MAPPA — raporty dojazdów dla wielu celów (bez UI)")
+    parser.add_argument("--cele", metavar="CSV",
+                        help="cele w formacie arkusza BUDOWY (NAZWA, WSPÓŁRZĘDNE); domyślnie arkusz BUDOWY")
+    parser.add_argument("--budowa", action="append", default=[], metavar="NAZWA",
+                        help="tylko wskazane cele (można podać wiele razy)")
+    parser.add_argument("--mechanicy", metavar="CSV", help="zamiast arkusza MECHANICY")
+    parser.add_argument("--warsztaty", metavar="CSV", help="zamiast arkusza WARSZTATY")
+    parser.add_argument("--bez-warsztatow", action="store_true", help="tylko mechanicy jako punkty startowe")
+    parser.add_argument("--cena-paliwa", type=float, default=6.50, help="PLN/litr (domyślnie 6.50)")
+    parser.add_argument("--spalanie", type=float, default=10.0, help="l/100 km (domyślnie 10.0)")
+    parser.add_argument("--szybki", action="store_true",
+                        help="po drogach tylko najbliżsi kandydaci, reszta w linii prostej")
+    parser.add_argument("--top-k", type=int, default=core.PREFILTER_TOP_K)
+    parser.add_argument("--promien-km", type=float, default=core.PREFILTER_RADIUS_KM)
+    parser.add_argument("--czekaj-geokodowanie", type=float, default=0.0, metavar="S",
+                        help="ile sekund czekać na geokodowanie nowych adresów (domyślnie 0 — pomiń)")
+    parser.add_argument("--katalog", default=core.REPORTS_DIR, help="katalog raportów (domyślnie MAPPA_Raporty)")
+    args = parser.parse_args(argv)
+
+    # Dane
+    if args.cele:
+        cele_df = _read_csv_file(args.cele, core.parse_budowy)
+    else:
+        cele_df = core.load_budowy()
+
+    def load_mech():
+        if args.mechanicy:
+            return _read_csv_file(args.mechanicy, core.parse_mechanicy)
+        return core.load_mechanicy()
+
+    mechanicy_df = load_mech()
+    if args.czekaj_geokodowanie > 0:
+        mechanicy_df = _wait_for_geocoding(mechanicy_df, load_mech, args.czekaj_geokodowanie)
+    if args.bez_warsztatow:
+        warsztaty_df = None
+    elif args.warsztaty:
+        warsztaty_df = _read_csv_file(args.warsztaty, core.parse_warsztaty)
+    else:
+        warsztaty_df = core.load_warsztaty()
+
+    if _report_messages(cele_df, "cele") | _report_messages(mechanicy_df, "mechanicy"):
+        return 1
+    if warsztaty_df is not None:
+        _report_messages(warsztaty_df, "warsztaty")
+    pending = mechanicy_df.attrs.get("pending", [])
+    if pending:
+        print(f"[mechanicy] ⏳ {len(pending)} adresów bez lokalizacji — pominięci "
+              f"(--czekaj-geokodowanie, aby poczekać)", file=sys.stderr)
+
+    if args.budowa:
+        missing = sorted(set(args.budowa) - set(cele_df["nazwa"]))
+        if missing:
+            print(f"Nie znaleziono celów: {', '.join(missing)}", file=sys.stderr)
+        cele_df = cele_df[cele_df["nazwa"].isin(args.budowa)]
+    if cele_df.empty or mechanicy_df.empty:
+        print("Brak celów lub mechaników do analizy.", file=sys.stderr)
+        return 1
+
+    koszt_za_km = round(args.cena_paliwa * args.spalanie / 100, 4) if args.spalanie > 0 else 0
+    use_fallback = not core.check_osrm_available()
+    if use_fallback:
+        ev = core.fallback_model().evaluation
+        print(f"⚠️ Routing niedostępny ({core.get_routing_backend().name}) — dystanse szacowane "
+              "z linii prostej" + (f" (model z cache tras, błąd dystansu ~{ev['dystans_blad_mediana_pct']}%)."
+                                   if ev else " (× 1.3, bez kalibracji)."), file=sys.stderr)
+
+    when = datetime.now()
+    for nazwa, lat, lon in zip(cele_df["nazwa"], cele_df["lat"], cele_df["lon"]):
+        t0 = time.perf_counter()
+        result_df, _ = core.analyze_destination(
+            mechanicy_df, warsztaty_df, lat, lon, koszt_za_km,
+            use_fallback=use_fallback, fast_mode=args.szybki,
+            top_k=args.top_k, radius_km=args.promien_km, geometry_top_n=0,
+        )
+        path = core.write_report(result_df, nazwa, args.katalog, when=when)
+        best = result_df.iloc[0]
+        print(f"{nazwa}: {best['Mechanik']} — {best['Dystans (km)']:.1f} km, "
+              f"{best['SUMA kosztów (PLN)']:.2f} PLN ({time.perf_counter() - t0:.1f} s) → {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2837 @@
+# -*- coding: utf-8 -*-
+"""
+MAPPA — silnik analizy bez interfejsu
+=====================================
+Dane (arkusze, geokodowanie), routing (OSRM / graf offline / Haversine),
+koszty, macierz kosztów, przydział, trasy dzienne i raporty CSV — bez
+importu Streamlit. Używany przez app.py (UI) i mappa_cli.py (tryb wsadowy).
+
+Komunikaty dla użytkownika (błędy arkuszy, odrzucone wiersze) nie są
+wyświetlane tutaj — trafiają do df.attrs["komunikaty"] jako (poziom, tekst),
+poziom = "error" | "warning"; UI pokazuje je przez st.error / st.warning.
+"""
+
+# ── Importy ──────────────────────────────────────────────────────────────────
+import os
+import io
+import csv
+import gzip
+import hashlib
+import math
+import re
+import sqlite3
+import time
+import heapq
+import json
+import queue
+import threading
+import warnings
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.optimize import linear_sum_assignment, linprog
+import requests
+from requests.adapters import HTTPAdapter
+from geopy.geocoders import Nominatim
+from geopy.exc import GeocoderTimedOut, GeocoderServiceError
+
+warnings.filterwarnings("ignore")
+
+# ── Stałe ────────────────────────────────────────────────────────────────────
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_PATH = os.path.join(BASE_DIR, "cache_mechanicy.csv")  # stary format — tylko import
+GEOCODE_DB_PATH = os.path.join(BASE_DIR, "cache_mechanicy.sqlite")
+ROUTE_CACHE_PATH = os.path.join(BASE_DIR, "cache_trasy.sqlite")
+COST_MATRIX_PATH = os.path.join(BASE_DIR, "macierz_kosztow.parquet")
+REPORTS_DIR = os.path.join(BASE_DIR, "MAPPA_Raporty")  # raporty CSV z analiz
+ROUTE_CACHE_TTL_DAYS = 30          # po tylu dniach trasa jest pobierana ponownie
+ROUTE_CACHE_MAX_ENTRIES = 50000    # powyżej — usuwane najdawniej używane
+ROUTE_CACHE_DECIMALS = 4           # kwantyzacja współrzędnych klucza (~10 m)
+# Backend routingu — konfiguracja per wdrożenie (zmienne środowiskowe):
+#   MAPPA_ROUTING = "osrm-demo" (publiczny serwer demo, domyślnie)
+#                 | "osrm"      (własny osrm-backend, np. Docker — adres w MAPPA_OSRM_URL)
+#                 | "graf"      (offline, graf drogowy z wyciągu OSM — ROAD_GRAPH_DIR)
+#                 | "haversine" (offline, tylko szacunek z linii prostej — FallbackModel)
+ROUTING_BACKEND = os.environ.get("MAPPA_ROUTING", "osrm-demo")
+OSRM_DEMO_URL = "http://router.project-osrm.org"
+OSRM_URL = os.environ.get("MAPPA_OSRM_URL", "http://localhost:5000")
+OSRM_PROFILE = os.environ.get("MAPPA_OSRM_PROFILE", "driving")
+OSRM_TIMEOUT = float(os.environ.get("MAPPA_OSRM_TIMEOUT", 15))  # s — pojedyncze zapytanie /table
+OSRM_TABLE_MAX_COORDS = int(os.environ.get("MAPPA_OSRM_TABLE_MAX", 100))  # max-table-size serwera
+# Offline: graf drogowy (MAPPA_ROUTING="graf" lub automatycznie, gdy OSRM nie odpowiada)
+ROAD_GRAPH_DIR = os.environ.get("MAPPA_GRAF", os.path.join(BASE_DIR, "assets", "graf_drogowy"))
+# km/h wg typu drogi (highway=*) — gdy brak maxspeed; inne typy nie trafiają do grafu
+PREDKOSCI_DROG = {
+    "motorway": 120, "motorway_link": 60, "trunk": 100, "trunk_link": 50,
+    "primary": 80, "primary_link": 50, "secondary": 70, "secondary_link": 40,
+    "tertiary": 60, "tertiary_link": 40, "unclassified": 50, "residential": 30,
+    "living_street": 10, "service": 20, "road": 40,
+}
+ROAD_SNAP_SPEED_KMH = 20     # dojazd od punktu do najbliższego węzła grafu (poza drogą)
+MAP_ROUTES_TOP_N = 15        # ile najlepszych tras rysować na mapie (pełna geometria)
+ROUTE_SIMPLIFY_ZOOM = 14     # uproszczenie geometrii tras: bez widocznej straty do tego zoomu
+MINUTY_MASZYNA_MALA = 20     # trasy dzienne: czas obsługi jednej małej maszyny (min)
+MINUTY_MASZYNA_DUZA = 45     # trasy dzienne: czas obsługi jednej dużej maszyny (min)
+ASSIGN_CANDIDATES_K = 40     # przydział z limitami: ilu najtańszych kandydatów na budowę/mechanika (1. próba)
+PREFILTER_TOP_K = 25         # tryb szybki: ilu najbliższych (linia prosta) liczyć po drogach
+PREFILTER_RADIUS_KM = 40     # tryb szybki: + wszyscy w tym promieniu od celu
+OSRM_MAX_IN_FLIGHT = int(os.environ.get("MAPPA_OSRM_MAX_IN_FLIGHT", 8))  # maks. równoległych zapytań
+OSRM_REQUEST_DEADLINE = float(os.environ.get("MAPPA_OSRM_DEADLINE", 10))  # s — limit na jedną trasę (z retry)
+FALLBACK_DETOUR = 1.3           # szacunek bez kalibracji: linia prosta × tyle…
+FALLBACK_SPEED_KMH = 60.0       # … przy tej prędkości
+FALLBACK_BANDS_KM = (5, 15, 40, 100)  # kalibracja: przedziały odległości w linii prostej (km)
+FALLBACK_REGION_DEG = 0.5       # kalibracja: siatka regionów (stopnie) wg środka odcinka
+FALLBACK_SHRINK = 30            # region z małą liczbą tras — poprawka ściągana do 0
+FALLBACK_MIN_ROUTES = 50        # mniej tras w cache — szacunek bez kalibracji
+FALLBACK_HOLDOUT = 0.2          # część tras odłożona do pomiaru trafności
+FALLBACK_MODEL_TTL_S = 3600     # co ile uczyć model ponownie (cache rośnie)
+ANALYSIS_BUDGET_S = float(os.environ.get("MAPPA_ANALYSIS_BUDGET", 30))  # s — łączny limit routingu jednej analizy
+ROUTING_TIMEOUT_MIN_S = 1.0     # adaptacyjny timeout: nie krótszy niż…
+ROUTING_TIMEOUT_P95_FACTOR = 3  # … p95 opóźnień × tyle (maks. OSRM_TIMEOUT / OSRM_REQUEST_DEADLINE)
+ROUTING_LATENCY_WINDOW = 200    # ile ostatnich zapytań w percentylach opóźnień
+ROUTING_LATENCY_MIN_SAMPLES = 20  # poniżej — timeout domyślny (za mało danych)
+BREAKER_FAILURES = 5            # tyle błędów z rzędu → bezpiecznik otwarty (od razu szacunek)
+BREAKER_COOLDOWN_S = 30         # po tylu s jedno zapytanie próbne (półotwarty)
+NOMINATIM_USER_AGENT = "logistyka_budowlana_app_v1"
+GEOCODE_RETRIES = 4             # timeout / błąd Nominatim: tyle ponowień…
+GEOCODE_RETRY_BASE_S = 30       # … co 30 s, 60 s, 120 s, 240 s
+GEOCODE_FAILED_TTL_S = 6 * 3600  # adres nieudany — po tym czasie próbowany ponownie
+POSTAL_INDEX_PATH = os.path.join(BASE_DIR, "assets", "kody_pocztowe.tsv.gz")
+# Kiedy używać centroidu kodu pocztowego zamiast Nominatim:
+#   "bez_ulicy" — tylko gdy brak ulicy (dokładność i tak do poziomu miejscowości)
+#   "zawsze"    — zawsze, także gdy ulica jest podana (szybciej, mniej dokładnie)
+#   "nigdy"     — wyłączone, zawsze Nominatim
+POSTAL_INDEX_POLICY = "bez_ulicy"
+STAWKA_RBH_MECHANIKA = 150  # PLN za godzinę
+STAWKA_SAMOCHODU = 45       # PLN za godzinę
+
+# ── Google Sheets ─────────────────────────────────────────────────────────────
+GSHEET_ID = "1yLzRB0v3Um6W4owIQt9-MfL320AxLVl7oY-lfPv7Kug"
+
+SHEET_SYNC_INTERVAL_S = 30  # min. odstęp między sprawdzeniami zmian arkusza
+
+def gsheet_csv_url(sheet_name: str) -> str:
+    """URL do pobrania arkusza Google Sheets jako CSV."""
+    return f"https://docs.google.com/spreadsheets/d/{GSHEET_ID}/gviz/tq?tqx=out:csv&sheet={sheet_name}"
+
+# ── Cache geokodowania (SQLite, WAL) ────────────────────────────────────────
+_geocode_local = threading.local()
+
+
+def _geocode_conn() -> sqlite3.Connection:
+    """Połączenie SQLite per wątek. WAL pozwala wielu sesjom Streamlit czytać
+    i dopisywać równocześnie bez nadpisywania cudzych wyników.
+    Przy pierwszym użyciu pustej bazy importuje stary cache CSV (CACHE_PATH)."""
+    conn = getattr(_geocode_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(GEOCODE_DB_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode_cache ("
+            " adres TEXT PRIMARY KEY,"
+            " lat REAL NOT NULL,"
+            " lon REAL NOT NULL,"
+            " source TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        conn.commit()
+        _geocode_local.conn = conn
+        if conn.execute("SELECT 1 FROM geocode_cache LIMIT 1").fetchone() is None:
+            try:
+                import_geocode_csv(CACHE_PATH)
+            except (OSError, UnicodeDecodeError, csv.Error):
+                pass  # uszkodzony stary plik — baza startuje pusta
+    return conn
+
+
+def geocode_cache_get(adres: str):
+    """Zwróć (lat, lon) z cache albo None."""
+    row = _geocode_conn().execute(
+        "SELECT lat, lon FROM geocode_cache WHERE adres = ?", (adres,)
+    ).fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def geocode_cache_get_many(addresses) -> dict:
+    """Zwróć {adres: (lat, lon)} dla adresów obecnych w cache (jedno zapytanie na 500)."""
+    addresses = list(addresses)
+    found = {}
+    conn = _geocode_conn()
+    for start in range(0, len(addresses), 500):  # limit zmiennych SQLite
+        batch = addresses[start:start + 500]
+        rows = conn.execute(
+            f"SELECT adres, lat, lon FROM geocode_cache WHERE adres IN ({','.join('?' * len(batch))})",
+            batch,
+        ).fetchall()
+        found.update({adres: (lat, lon) for adres, lat, lon in rows})
+    return found
+
+
+def geocode_cache_put(adres: str, lat: float, lon: float, source: str) -> None:
+    """Zapisz (upsert) pojedynczy wynik geokodowania — bez przepisywania całego cache."""
+    conn = _geocode_conn()
+    conn.execute(
+        "INSERT INTO geocode_cache (adres, lat, lon, source, updated_at) VALUES (?, ?, ?, ?, ?)"
+        " ON CONFLICT(adres) DO UPDATE SET"
+        "  lat = excluded.lat, lon = excluded.lon,"
+        "  source = excluded.source, updated_at = excluded.updated_at",
+        (adres, lat, lon, source, time.time()),
+    )
+    conn.commit()
+
+
+def import_geocode_csv(path: str) -> tuple:
+    """Migracja starego cache CSV (adres, lat, lon) do SQLite.
+    Istniejące wpisy nie są nadpisywane. Zwraca (zaimportowane, pominięte)."""
+    if not os.path.exists(path):
+        return 0, 0
+    rows = []
+    skipped = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            try:
+                rows.append((row["adres"], float(row["lat"]), float(row["lon"])))
+            except (KeyError, TypeError, ValueError):
+                skipped += 1
+    conn = _geocode_conn()
+    now = time.time()
+    before = conn.total_changes
+    conn.executemany(
+        "INSERT OR IGNORE INTO geocode_cache (adres, lat, lon, source, updated_at)"
+        " VALUES (?, ?, ?, 'csv', ?)",
+        [(adres, lat, lon, now) for adres, lat, lon in rows],
+    )
+    conn.commit()
+    return conn.total_changes - before, skipped
+
+
+def geocode_address(address: str, geolocator, raise_errors: bool = False) -> tuple:
+    """Geokoduj adres; najpierw sprawdź cache. Nowy wynik zapisywany od razu.
+    raise_errors=True — timeout / błąd serwera jako wyjątek (a nie „nie znaleziono”)."""
+    cached = geocode_cache_get(address)
+    if cached:
+        return cached
+    try:
+        time.sleep(1.1)  # Nominatim rate-limit: 1 req/s
+        location = geolocator.geocode(address, timeout=10)
+        if location:
+            coords = (location.latitude, location.longitude)
+            geocode_cache_put(address, coords[0], coords[1], "nominatim")
+            return coords
+    except (GeocoderTimedOut, GeocoderServiceError):
+        if raise_errors:
+            raise
+    return (None, None)
+
+
+# ── Indeks kodów pocztowych (offline, centroidy) ───────────────────────────
+_postal_index = None
+_postal_index_lock = threading.Lock()
+_POSTAL_RE = re.compile(r"^\s*(\d{2})\s*-?\s*(\d{3})\s*$")
+
+
+def normalize_postal_code(kod) -> str:
+    """'32020' / '32-020' / ' 32 - 020 ' → '32-020'; niepoprawny → ''."""
+    m = _POSTAL_RE.match(str(kod)) if kod is not None else None
+    return f"{m.group(1)}-{m.group(2)}" if m else ""
+
+
+def _load_postal_index() -> dict:
+    """Wczytaj indeks (raz na proces, przy pierwszym użyciu). Format pliku:
+    gzip TSV bez nagłówka: kod<TAB>lat<TAB>lon. Brak pliku → pusty indeks."""
+    global _postal_index
+    if _postal_index is None:
+        with _postal_index_lock:
+            if _postal_index is None:
+                index = {}
+                if os.path.exists(POSTAL_INDEX_PATH):
+                    with gzip.open(POSTAL_INDEX_PATH, "rt", encoding="utf-8") as f:
+                        for line in f:
+                            parts = line.rstrip("\n").split("\t")
+                            if len(parts) == 3:
+                                index[parts[0]] = (float(parts[1]), float(parts[2]))
+                _postal_index = index
+    return _postal_index
+
+
+def postal_code_lookup(kod):
+    """Centroid (lat, lon) dla kodu pocztowego albo None — O(1), bez sieci."""
+    kod = normalize_postal_code(kod)
+    return _load_postal_index().get(kod) if kod else None
+
+
+def build_postal_index(src_path: str, out_path: str = POSTAL_INDEX_PATH) -> int:
+    """Zbuduj indeks z pliku GeoNames PL.txt (download.geonames.org/export/zip/PL.zip).
+    Kilka miejscowości pod jednym kodem → średnia współrzędnych (centroid).
+    Uruchomienie: python -c "import mappa_core; mappa_core.build_postal_index('PL.txt')"
+    Zwraca liczbę kodów w indeksie."""
+    sums = {}
+    with open(src_path, "r", encoding="utf-8") as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) < 11:
+                continue
+            kod = normalize_postal_code(cols[1])
+            try:
+                lat, lon = float(cols[9]), float(cols[10])
+            except ValueError:
+                continue
+            if kod:
+                acc = sums.setdefault(kod, [0.0, 0.0, 0])
+                acc[0] += lat
+                acc[1] += lon
+                acc[2] += 1
+    with gzip.open(out_path, "wt", encoding="utf-8") as f:
+        for kod in sorted(sums):
+            lat_sum, lon_sum, n = sums[kod]
+            f.write(f"{kod}\t{lat_sum / n:.5f}\t{lon_sum / n:.5f}\n")
+    return len(sums)
+
+
+# ── Geokodowanie w tle (kolejka + 1 wątek, limit Nominatim 1 req/s) ────────
+_geocode_queue = queue.Queue()
+_geocode_pending = set()   # adresy w kolejce, w trakcie geokodowania lub czekające na ponowienie
+_geocode_failed = {}       # adres → time.monotonic() porażki (ważne GEOCODE_FAILED_TTL_S)
+_geocode_attempts = {}     # adres → liczba nieudanych prób (timeout / błąd serwera)
+_geocode_state_lock = threading.Lock()
+_geocode_worker = None
+
+
+def _geocode_retry(adres: str) -> bool:
+    """Błąd przejściowy (timeout, błąd serwera) — zaplanuj ponowienie z rosnącym odstępem.
+    False, gdy wyczerpano GEOCODE_RETRIES prób."""
+    with _geocode_state_lock:
+        attempt = _geocode_attempts.get(adres, 0) + 1
+        _geocode_attempts[adres] = attempt
+    if attempt > GEOCODE_RETRIES:
+        return False
+    timer = threading.Timer(GEOCODE_RETRY_BASE_S * 2 ** (attempt - 1), _geocode_queue.put, (adres,))
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+def _geocode_worker_loop() -> None:
+    """Pobieraj adresy z kolejki i geokoduj po jednym — geocode_address pilnuje
+    limitu 1 req/s i od razu zapisuje wynik do cache SQLite. Jako nieudane
+    oznaczane są tylko adresy, których Nominatim nie znalazł (lub po wyczerpaniu
+    ponowień) — i tylko na GEOCODE_FAILED_TTL_S."""
+    geolocator = Nominatim(user_agent=NOMINATIM_USER_AGENT)
+    while True:
+        adres = _geocode_queue.get()
+        failed = retrying = False
+        try:
+            lat, _ = geocode_address(adres, geolocator, raise_errors=True)
+            failed = lat is None
+        except (GeocoderTimedOut, GeocoderServiceError):
+            retrying = _geocode_retry(adres)
+            failed = not retrying
+        except Exception:
+            failed = True
+        finally:
+            with _geocode_state_lock:
+                if failed:
+                    _geocode_failed[adres] = time.monotonic()
+                if not retrying:
+                    _geocode_pending.discard(adres)
+                    _geocode_attempts.pop(adres, None)
+            _geocode_queue.task_done()
+
+
+def _geocode_failed_recently(adres: str) -> bool:
+    """Czy adres jest oznaczony jako nieudany (i oznaczenie nie wygasło). Wymaga blokady."""
+    failed_at = _geocode_failed.get(adres)
+    if failed_at is None:
+        return False
+    if time.monotonic() - failed_at >= GEOCODE_FAILED_TTL_S:
+        del _geocode_failed[adres]
+        return False
+    return True
+
+
+def clear_geocode_failures() -> None:
+    """Zapomnij nieudane geokodowania — przy następnym wczytaniu adresy wrócą do kolejki."""
+    with _geocode_state_lock:
+        _geocode_failed.clear()
+
+
+def enqueue_geocode(addresses) -> None:
+    """Dodaj adresy do kolejki geokodowania w tle (bez duplikatów)."""
+    global _geocode_worker
+    with _geocode_state_lock:
+        if _geocode_worker is None or not _geocode_worker.is_alive():
+            _geocode_worker = threading.Thread(target=_geocode_worker_loop,
+                                               name="mappa-geocoder", daemon=True)
+            _geocode_worker.start()
+        for adres in addresses:
+            if adres not in _geocode_pending and not _geocode_failed_recently(adres):
+                _geocode_pending.add(adres)
+                _geocode_queue.put(adres)
+
+
+def geocode_status(adres: str) -> str:
+    """Stan adresu w geokodowaniu w tle: 'pending', 'failed' albo 'done'."""
+    with _geocode_state_lock:
+        if adres in _geocode_pending:
+            return "pending"
+        if _geocode_failed_recently(adres):
+            return "failed"
+    return "done"
+
+
+# ── Parsowanie arkuszy (operacje na całych kolumnach) ──────────────────────
+COORD_COL_NEEDLES = ("WSPÓŁRZĘDNE", "WSPOLRZEDNE", "WSPÓŁ", "WSPOL", "COORD")
+NAME_COL_NEEDLES = ("NAZWA", "NAME")
+
+
+def find_column(df: pd.DataFrame, needles, exclude=()):
+    """Pierwsza kolumna, której nazwa (UPPER, strip) zawiera któryś z needles
+    i nie zawiera żadnego z exclude. Brak → None."""
+    for c in df.columns:
+        cu = str(c).upper().strip()
+        if any(n in cu for n in needles) and not any(x in cu for x in exclude):
+            return c
+    return None
+
+
+def text_column(df: pd.DataFrame, col) -> pd.Series:
+    """Kolumna jako tekst po strip(); brak kolumny → pusta."""
+    if col is None or col not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[col].astype(str).str.strip()
+
+
+def parse_coord_column(values: pd.Series, strict: bool = False) -> pd.DataFrame:
+    """Kolumna 'lat, lon' → DataFrame lat/lon (float64, NaN gdy nie da się sparsować).
+    strict=True wymaga dokładnie dwóch części (bez dodatkowych pól po przecinku)."""
+    text = values.astype("string").str.strip()
+    parts = text.str.split(",", n=2, expand=True).reindex(columns=[0, 1, 2])
+    lat = pd.to_numeric(parts[0].str.strip(), errors="coerce").astype("float64")
+    lon = pd.to_numeric(parts[1].str.strip(), errors="coerce").astype("float64")
+    if strict:
+        extra = parts[2].notna()
+        lat = lat.mask(extra)
+        lon = lon.mask(extra)
+    return pd.DataFrame({"lat": lat, "lon": lon}, index=values.index)
+
+
+def rejected_rows(names: pd.Series, mask: pd.Series, reason: str) -> list:
+    """Lista odrzuconych wierszy: [{"wiersz": nr (od 1), "nazwa": ..., "powod": ...}]."""
+    positions = np.flatnonzero(mask.to_numpy())
+    names_arr = names.to_numpy()
+    out = []
+    for pos in positions:
+        name = str(names_arr[pos]).strip()
+        out.append({
+            "wiersz": int(pos) + 1,
+            "nazwa": name if name and name.lower() != "nan" else f"wiersz {pos + 1}",
+            "powod": reason,
+        })
+    return out
+
+
+def _rejected_names(rejected: list) -> str:
+    return ", ".join(r["nazwa"] for r in rejected)
+
+
+# ── Synchronizacja arkuszy (odcisk treści zamiast ślepego TTL) ─────────────
+_sheet_state = {}  # arkusz → {"etag", "fingerprint", "content", "checked_at"}
+_sheet_state_lock = threading.Lock()
+
+
+def sync_sheet(sheet_name: str, force: bool = False) -> tuple:
+    """Pobierz CSV arkusza i zwróć (odcisk SHA-1 treści, treść).
+    Częściej niż co SHEET_SYNC_INTERVAL_S zwraca ostatni wynik bez sieci;
+    jeśli serwer podał ETag, wysyła If-None-Match (304 → bez pobierania).
+    Parsowanie jest cache'owane wg odcisku, więc niezmieniony arkusz nie jest
+    parsowany ponownie."""
+    with _sheet_state_lock:
+        state = dict(_sheet_state.get(sheet_name, {}))
+    now = time.monotonic()
+    if (not force and state.get("content") is not None
+            and now - state["checked_at"] < SHEET_SYNC_INTERVAL_S):
+        return state["fingerprint"], state["content"]
+
+    headers = {"If-None-Match": state["etag"]} if state.get("etag") and state.get("content") else {}
+    resp = get_http_session().get(gsheet_csv_url(sheet_name), headers=headers, timeout=30)
+    if resp.status_code == 304:
+        state["checked_at"] = now
+    else:
+        resp.raise_for_status()
+        content = resp.content
+        state = {
+            "etag": resp.headers.get("ETag"),
+            "fingerprint": hashlib.sha1(content).hexdigest(),
+            "content": content,
+            "checked_at": now,
+        }
+    with _sheet_state_lock:
+        _sheet_state[sheet_name] = state
+    return state["fingerprint"], state["content"]
+
+
+def invalidate_sheets() -> None:
+    """Wymuś sprawdzenie wszystkich arkuszy przy najbliższym wczytaniu
+    (i ponowne geokodowanie adresów, które wcześniej się nie udały)."""
+    with _sheet_state_lock:
+        for state in _sheet_state.values():
+            state["checked_at"] = float("-inf")
+    clear_geocode_failures()
+
+
+def read_sheet_csv(content: bytes) -> pd.DataFrame:
+    """Treść CSV arkusza → DataFrame."""
+    return pd.read_csv(io.BytesIO(content))
+
+
+# ── Ładowanie danych ─────────────────────────────────────────────────────────
+def add_message(df: pd.DataFrame, level: str, text: str) -> pd.DataFrame:
+    """Dopisz komunikat dla użytkownika do df.attrs["komunikaty"] (level: "error" | "warning")."""
+    df.attrs.setdefault("komunikaty", []).append((level, text))
+    return df
+
+
+def parse_budowy(fingerprint: str, content: bytes) -> pd.DataFrame:
+    """Parsuj arkusz BUDOWY — kolumna WSPÓŁRZĘDNE.
+    Odrzucone wiersze w df.attrs["odrzucone"]."""
+    df = read_sheet_csv(content)
+
+    # Szukaj kolumny współrzędnych (obsługa polskich znaków / wariantów)
+    coord_col = find_column(df, COORD_COL_NEEDLES)
+    if coord_col is None:
+        coord_col = df.columns[-1] if len(df.columns) >= 3 else None
+
+    if coord_col is None:
+        return add_message(pd.DataFrame(), "error",
+                           "❌ Nie znaleziono kolumny ze współrzędnymi w arkuszu BUDOWY.")
+
+    coords = parse_coord_column(df[coord_col])
+    names = text_column(df, "NAZWA")
+    valid = coords["lat"].notna() & coords["lon"].notna()
+    result = pd.DataFrame({
+        "nazwa": names,
+        "kost": text_column(df, "KOST"),
+        "lat": coords["lat"],
+        "lon": coords["lon"],
+    })[valid].reset_index(drop=True)
+    rejected = rejected_rows(names, ~valid, "błędne współrzędne")
+    result.attrs["odrzucone"] = rejected
+    result.attrs["fingerprint"] = fingerprint
+    if rejected:
+        add_message(result, "warning",
+                    f"⚠️ Pominięto {len(rejected)} budów z błędnymi współrzędnymi: {_rejected_names(rejected)}")
+    return result
+
+
+def load_budowy(parse=parse_budowy) -> pd.DataFrame:
+    """Wczytaj arkusz BUDOWY z Google Sheets. parse(fingerprint, content) —
+    parser arkusza (UI podaje wersję z cache wg odcisku treści)."""
+    try:
+        fingerprint, content = sync_sheet("BUDOWY")
+        return parse(fingerprint, content)
+    except Exception as e:
+        return add_message(pd.DataFrame(), "error", f"❌ Nie można wczytać arkusza BUDOWY: {e}")
+
+
+def parse_warsztaty(fingerprint: str, content: bytes) -> pd.DataFrame:
+    """Parsuj arkusz WARSZTATY. Odrzucone wiersze w df.attrs["odrzucone"]."""
+    df = read_sheet_csv(content)
+
+    coord_col = find_column(df, COORD_COL_NEEDLES)
+    name_col = find_column(df, NAME_COL_NEEDLES)
+
+    if coord_col is None or name_col is None:
+        cols = list(df.columns)
+        if len(cols) >= 2:
+            if name_col is None:
+                name_col = cols[0]
+            if coord_col is None:
+                coord_col = cols[-1]
+        else:
+            return pd.DataFrame()
+
+    coords = parse_coord_column(df[coord_col])
+    names = text_column(df, name_col)
+    valid = coords["lat"].notna() & coords["lon"].notna()
+    result = pd.DataFrame({
+        "nazwa": names,
+        "lat": coords["lat"],
+        "lon": coords["lon"],
+    })[valid].reset_index(drop=True)
+    rejected = rejected_rows(names, ~valid, "błędne współrzędne")
+    result.attrs["odrzucone"] = rejected
+    result.attrs["fingerprint"] = fingerprint
+    if rejected:
+        add_message(result, "warning",
+                    f"⚠️ Pominięto {len(rejected)} warsztatów z błędnymi współrzędnymi: {_rejected_names(rejected)}")
+    return result
+
+
+def load_warsztaty(parse=parse_warsztaty) -> pd.DataFrame:
+    """Wczytaj arkusz WARSZTATY z Google Sheets (parse — jak w load_budowy)."""
+    try:
+        fingerprint, content = sync_sheet("WARSZTATY")
+        return parse(fingerprint, content)
+    except Exception:
+        return pd.DataFrame()
+
+
+# ── Ładowanie maszyn ─────────────────────────────────────────────────────────
+def parse_maszyny(fingerprint: str, content: bytes) -> pd.DataFrame:
+    """Parsuj listę maszyn."""
+    df = read_sheet_csv(content)
+    cols = list(df.columns)
+
+    # Szukaj kolumny KOST — najpierw dokładne dopasowanie, potem zawiera
+    kost_col = None
+    for c in cols:
+        if str(c).strip().upper() == "KOST":
+            kost_col = c
+            break
+    if kost_col is None:
+        for c in cols:
+            if "KOST" in str(c).upper() and "NAZWA" not in str(c).upper():
+                kost_col = c
+                break
+
+    # Szukaj kolumny "Ostatnie: Nazwa KOST" (lub warianty)
+    nazwa_kost_col = None
+    for c in cols:
+        cu = str(c).upper().strip()
+        if "NAZWA" in cu and "KOST" in cu:
+            nazwa_kost_col = c
+            break
+
+    # Szukaj kolumny z liczbą — "LICZBA" lub "INW"
+    count_col = None
+    for c in cols:
+        cu = str(c).upper()
+        if "LICZBA" in cu or "INW" in cu:
+            count_col = c
+            break
+
+    # Fallback: B=indeks 1, D=indeks 3
+    if kost_col is None and len(cols) >= 2:
+        kost_col = cols[1]
+    if count_col is None and len(cols) >= 4:
+        count_col = cols[3]
+
+    if kost_col is None or count_col is None:
+        return pd.DataFrame(columns=["KOST", "nazwa_kost", "ilosc"])
+
+    # Zbierz kolumny do wyniku
+    use_cols = [kost_col, count_col]
+    out_names = ["KOST", "ilosc"]
+    if nazwa_kost_col:
+        use_cols = [kost_col, nazwa_kost_col, count_col]
+        out_names = ["KOST", "nazwa_kost", "ilosc"]
+
+    result = df[use_cols].copy()
+    result.columns = out_names
+
+    result["KOST"] = result["KOST"].astype(str).str.strip()
+    # Normalizacja: "1250.0" → "1250" (pandas parsuje czysto-liczbowe kolumny jako float)
+    result["KOST"] = result["KOST"].str.replace(r'^(\d+)\.0$', r'\1', regex=True)
+
+    if "nazwa_kost" not in result.columns:
+        result["nazwa_kost"] = ""
+    else:
+        result["nazwa_kost"] = result["nazwa_kost"].astype(str).str.strip()
+        result.loc[result["nazwa_kost"] == "nan", "nazwa_kost"] = ""
+
+    # NIE filtruj pustych KOST — zostawiamy je, żeby potem uzupełnić cross-referencją
+    result["ilosc"] = pd.to_numeric(result["ilosc"], errors="coerce").fillna(0).astype(int)
+    # Filtruj wiersze, które mają zarówno pusty KOST jak i pustą nazwę
+    result = result[~((result["KOST"].isin(["", "nan"])) & (result["nazwa_kost"] == ""))]
+    result.attrs["fingerprint"] = fingerprint
+    return result
+
+
+def load_maszyny(sheet_name: str, parse=parse_maszyny) -> pd.DataFrame:
+    """Wczytaj listę maszyn z Google Sheets. Zwraca DataFrame z kolumnami KOST, nazwa_kost, ilosc."""
+    try:
+        fingerprint, content = sync_sheet(sheet_name)
+        return parse(fingerprint, content)
+    except Exception:
+        return pd.DataFrame(columns=["KOST", "nazwa_kost", "ilosc"])
+
+
+def normalize_kost(values: pd.Series) -> pd.Series:
+    """KOST → UPPER bez spacji; "1250.0" → "1250" (pandas parsuje liczby jako float)."""
+    return (values.astype(str).str.strip().str.upper()
+            .str.replace(r'^(\d+)\.0$', r'\1', regex=True))
+
+
+def fill_kost_from_names(maszyny_duze_df: pd.DataFrame, maszyny_male_df: pd.DataFrame) -> pd.DataFrame:
+    """Cross-referencja: uzupełnij puste KOST w DUZE na podstawie MALE.
+    DUZE ma wiele wierszy z pustym KOST ale z "Ostatnie: Nazwa KOST"
+    np. "S1 ODC1A BIERUŃ-OŚWI" → w MALE ten sam rekord ma KOST = "HTSA"."""
+    if (maszyny_male_df.empty or maszyny_duze_df.empty or
+            "nazwa_kost" not in maszyny_male_df.columns or
+            "nazwa_kost" not in maszyny_duze_df.columns):
+        return maszyny_duze_df
+    # Mapowanie: nazwa_kost → KOST (z MALE, gdzie KOST nie jest pusty; ostatni wygrywa)
+    male_valid = maszyny_male_df[
+        maszyny_male_df["KOST"].notna() &
+        (~maszyny_male_df["KOST"].isin(["", "nan"])) &
+        (maszyny_male_df["nazwa_kost"] != "")
+    ]
+    nazwa_to_kost = (male_valid.assign(_nk=male_valid["nazwa_kost"].str.upper())
+                     .drop_duplicates("_nk", keep="last")
+                     .set_index("_nk")["KOST"])
+    out = maszyny_duze_df.copy()
+    mask_empty = out["KOST"].isin(["", "nan"])
+    filled = out.loc[mask_empty, "nazwa_kost"].astype(str).str.upper().map(nazwa_to_kost)
+    out.loc[mask_empty, "KOST"] = filled.fillna(out.loc[mask_empty, "KOST"])
+    return out
+
+
+def build_machine_index(maszyny_male_df: pd.DataFrame, maszyny_duze_df: pd.DataFrame) -> dict:
+    """Jednorazowa agregacja: znormalizowany KOST → (maszyny_male, maszyny_duze)."""
+    totals = []
+    for df in (maszyny_male_df, maszyny_duze_df):
+        if df.empty:
+            totals.append(pd.Series(dtype="int64"))
+        else:
+            totals.append(df.groupby(normalize_kost(df["KOST"]))["ilosc"].sum())
+    both = pd.concat(totals, axis=1, keys=["male", "duze"]).fillna(0).astype("int64")
+    return {k: (int(m), int(d)) for k, m, d in zip(both.index, both["male"], both["duze"])}
+
+
+def machine_counts_for_sites(kost_values: pd.Series, machine_index: dict) -> pd.DataFrame:
+    """Liczba maszyn małych i dużych per budowa wg KOST (może być kilka po przecinku)
+    — złączenie słownikowe z build_machine_index zamiast skanowania list maszyn."""
+    cols = ["maszyny_male", "maszyny_duze"]
+    kosty = normalize_kost(kost_values.astype(str).str.split(",").explode())
+    kosty = kosty[~kosty.isin(["", "NAN", "NONE"])]
+    # Ten sam KOST podany dwa razy w jednej budowie liczony raz
+    pairs = pd.DataFrame({"site": kosty.index, "kost": kosty.to_numpy()}).drop_duplicates()
+    table = pd.DataFrame.from_dict(machine_index, orient="index", columns=cols)
+    joined = pairs.join(table, on="kost")
+    out = joined.groupby("site")[cols].sum().reindex(kost_values.index, fill_value=0)
+    out = out.fillna(0)
+    return out.astype("int64")
+
+
+def enrich_budowy(budowy_df: pd.DataFrame, maszyny_male_df: pd.DataFrame,
+                  maszyny_duze_df: pd.DataFrame) -> tuple:
+    """Wzbogać budowy o liczbę maszyn małych/dużych.
+    Zwraca (budowy_df, maszyny_male_df, maszyny_duze_df) — listy maszyn po
+    cross-referencji i odfiltrowaniu pustych KOST (wejście bez zmian)."""
+    budowy_df = budowy_df.copy()
+    maszyny_male_df = maszyny_male_df.copy()
+    maszyny_duze_df = maszyny_duze_df.copy()
+
+    maszyny_duze_df = fill_kost_from_names(maszyny_duze_df, maszyny_male_df)
+
+    # Teraz filtruj wiersze z pustym KOST (nie da się zmatchować)
+    if not maszyny_male_df.empty:
+        maszyny_male_df = maszyny_male_df[
+            maszyny_male_df["KOST"].notna() &
+            (~maszyny_male_df["KOST"].isin(["", "nan"]))
+        ].copy()
+    if not maszyny_duze_df.empty:
+        maszyny_duze_df = maszyny_duze_df[
+            maszyny_duze_df["KOST"].notna() &
+            (~maszyny_duze_df["KOST"].isin(["", "nan"]))
+        ].copy()
+
+    # Wzbogać budowy o liczbę maszyn — słownik KOST → (małe, duże)
+    if not budowy_df.empty and (not maszyny_male_df.empty or not maszyny_duze_df.empty):
+        machine_index = build_machine_index(maszyny_male_df, maszyny_duze_df)
+        budowy_df[["maszyny_male", "maszyny_duze"]] = machine_counts_for_sites(
+            budowy_df["kost"], machine_index
+        )
+    else:
+        budowy_df["maszyny_male"] = None
+        budowy_df["maszyny_duze"] = None
+    return budowy_df, maszyny_male_df, maszyny_duze_df
+
+
+def _join_nonempty(left: pd.Series, right: pd.Series) -> pd.Series:
+    """Złącz kolumny tekstowe spacją, pomijając puste części."""
+    joined = left.where(left.eq(""), left + " ") + right
+    return joined.where(right.ne(""), left)
+
+
+def load_mechanicy() -> pd.DataFrame:
+    """Wczytaj arkusz MECHANICY z Google Sheets (patrz parse_mechanicy)."""
+    try:
+        fingerprint, content = sync_sheet("MECHANICY")
+        return parse_mechanicy(fingerprint, content)
+    except Exception as e:
+        return add_message(pd.DataFrame(), "error", f"❌ Nie można wczytać arkusza MECHANICY: {e}")
+
+
+def parse_mechanicy(fingerprint: str, content: bytes) -> pd.DataFrame:
+    """Parsuj arkusz MECHANICY — współrzędne z kolumny, indeksu kodów lub cache.
+    Adresy spoza cache trafiają do geokodowania w tle (enqueue_geocode);
+    ich lista [(mechanik, adres)] jest w df.attrs["pending"],
+    odrzucone wiersze w df.attrs["odrzucone"], odcisk arkusza w df.attrs["fingerprint"].
+    Geokodowanie dotyczy tylko adresów spoza cache — po zmianie arkusza
+    w praktyce tylko nowych lub zmienionych wierszy."""
+    df = read_sheet_csv(content)
+
+    imie = text_column(df, "Imię")
+    nazwisko = text_column(df, "Nazwisko")
+    mechanik = imie + " " + nazwisko
+    kod = text_column(df, "Kod pocztowy")
+
+    # Opcjonalna kolumna WSPÓŁRZĘDNE (np. "50.123, 19.456") — dokładnie 2 liczby
+    coord_col = find_column(df, COORD_COL_NEEDLES)
+    if coord_col is not None:
+        coords = parse_coord_column(df[coord_col], strict=True)
+    else:
+        coords = pd.DataFrame({"lat": np.nan, "lon": np.nan}, index=df.index, dtype="float64")
+    has_coords = coords["lat"].notna() & coords["lon"].notna()
+
+    # A5: Budowanie adresu — puste / NaN części pomijane
+    def _part(col):
+        txt = text_column(df, col)
+        return txt.where(df[col].notna() & txt.str.lower().ne("nan"), "") if col in df.columns else txt
+    ulica = _part("Ulica")
+    adres = _join_nonempty(_join_nonempty(ulica, _part("Kod pocztowy")), _part("Miasto"))
+    # Współrzędne jako "adres" w danych
+    adres = adres.where(~has_coords, text_column(df, coord_col))
+
+    lat = coords["lat"].copy()
+    lon = coords["lon"].copy()
+    need_geo = ~has_coords & adres.ne("")
+
+    # 1. Indeks kodów pocztowych (offline), wg POSTAL_INDEX_POLICY
+    if POSTAL_INDEX_POLICY != "nigdy":
+        postal_rows = need_geo if POSTAL_INDEX_POLICY == "zawsze" else need_geo & ulica.eq("")
+        hits = kod[postal_rows].map(postal_code_lookup).dropna()
+        if not hits.empty:
+            lat.loc[hits.index] = [h[0] for h in hits]
+            lon.loc[hits.index] = [h[1] for h in hits]
+
+    # 2. Cache geokodowania (jedno zapytanie), 3. Nominatim w tle
+    need_geo &= lat.isna()
+    cached = geocode_cache_get_many(adres[need_geo].unique())
+    if cached:
+        hit_idx = need_geo & adres.isin(list(cached))
+        hits = adres[hit_idx].map(cached)
+        lat.loc[hits.index] = [h[0] for h in hits]
+        lon.loc[hits.index] = [h[1] for h in hits]
+    need_geo &= lat.isna()
+    status = adres[need_geo].map(geocode_status)
+    pending_mask = pd.Series(False, index=df.index)
+    pending_mask.loc[status.index] = status.ne("failed")
+    pending_list = list(zip(mechanik[pending_mask], adres[pending_mask]))
+    if pending_list:
+        enqueue_geocode(adres for _, adres in pending_list)
+
+    valid = lat.notna() & lon.notna()
+    result = pd.DataFrame({
+        "imie": imie,
+        "nazwisko": nazwisko,
+        "mechanik": mechanik,
+        "adres": adres,
+        "warsztat": text_column(df, "Warsztat"),
+        "lat": lat,
+        "lon": lon,
+    })[valid].reset_index(drop=True)
+
+    # A3: Pokaż ostrzeżenie o pominiętych mechanikach
+    rejected = (rejected_rows(mechanik, adres.eq("") & ~has_coords, "brak adresu i współrzędnych")
+                + rejected_rows(mechanik, ~valid & ~pending_mask & adres.ne(""), "geokodowanie nieudane"))
+    rejected.sort(key=lambda r: r["wiersz"])
+    if rejected:
+        labels = [f"{r['nazwa']} ({r['powod']})" for r in rejected]
+        add_message(result, "warning",
+                    f"⚠️ Pominięto {len(labels)} mechaników: {', '.join(labels[:5])}"
+                    + (f" i {len(labels)-5} więcej…" if len(labels) > 5 else ""))
+
+    result.attrs["pending"] = pending_list
+    result.attrs["odrzucone"] = rejected
+    result.attrs["fingerprint"] = fingerprint
+    return result
+
+
+# ── Haversine ────────────────────────────────────────────────────────────────
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Odległość w linii prostej (km) — wzór Haversine."""
+    R = 6371.0
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = (math.sin(dlat / 2) ** 2 +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+         math.sin(dlon / 2) ** 2)
+    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def haversine_km_np(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Haversine na tablicach NumPy (z broadcastingiem), wynik w km."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype="float64"))
+                              for x in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 6371.0 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+# ── Indeks przestrzenny (siatka) — k najbliższych / promień ─────────────────
+class PointIndex:
+    """Siatka komórek cell_deg × cell_deg nad punktami (lat, lon).
+    knn / radius przeszukują tylko komórki w rosnących pierścieniach wokół
+    zapytania, a dokładny dystans liczą wektorowo (haversine_km_np)."""
+
+    def __init__(self, lats, lons, cell_deg: float = 0.25):
+        self.lats = np.asarray(lats, dtype="float64")
+        self.lons = np.asarray(lons, dtype="float64")
+        self.cell_deg = cell_deg
+        self.cells = {}
+        if len(self.lats):
+            keys = np.floor(np.column_stack([self.lats, self.lons]) / cell_deg).astype("int64")
+            order = np.lexsort((keys[:, 1], keys[:, 0]))
+            sorted_keys = keys[order]
+            bounds = np.flatnonzero(np.any(np.diff(sorted_keys, axis=0) != 0, axis=1)) + 1
+            for chunk in np.split(order, bounds):
+                self.cells[(int(keys[chunk[0], 0]), int(keys[chunk[0], 1]))] = chunk
+            self.ci_min, self.cj_min = keys.min(axis=0)
+            self.ci_max, self.cj_max = keys.max(axis=0)
+            max_abs_lat = min(float(np.abs(self.lats).max()) + cell_deg, 89.0)
+        else:
+            max_abs_lat = 0.0
+        # Najmniejsza szerokość komórki w km (komórka zwęża się ku biegunom)
+        self.cell_km = cell_deg * 111.19 * math.cos(math.radians(max_abs_lat))
+
+    def __len__(self) -> int:
+        return len(self.lats)
+
+    def _ring(self, ci: int, cj: int, r: int) -> list:
+        if r == 0:
+            chunk = self.cells.get((ci, cj))
+            return [chunk] if chunk is not None else []
+        out = []
+        for di in range(-r, r + 1):
+            for dj in ((-r, r) if abs(di) != r else range(-r, r + 1)):
+                chunk = self.cells.get((ci + di, cj + dj))
+                if chunk is not None:
+                    out.append(chunk)
+        return out
+
+    def _max_ring(self, ci: int, cj: int) -> int:
+        return int(max(abs(ci - self.ci_min), abs(ci - self.ci_max),
+                       abs(cj - self.cj_min), abs(cj - self.cj_max)))
+
+    def knn(self, lat: float, lon: float, k: int = 1):
+        """k najbliższych punktów → (indeksy, dystanse_km), rosnąco wg dystansu."""
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype="int64"), np.empty(0)
+        ci, cj = int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+        max_r = self._max_ring(ci, cj)
+        found = []
+        n_found = 0
+        r = 0
+        while True:
+            for chunk in self._ring(ci, cj, r):
+                found.append(chunk)
+                n_found += len(chunk)
+            if n_found >= k:
+                idx = np.concatenate(found)
+                d = haversine_km_np(lat, lon, self.lats[idx], self.lons[idx])
+                kth = np.partition(d, k - 1)[k - 1]
+                # Punkty spoza przeszukanych pierścieni są dalej niż r komórek
+                if kth <= r * self.cell_km or r >= max_r:
+                    order = np.argsort(d, kind="stable")[:k]
+                    return idx[order], d[order]
+            r += 1
+
+    def radius(self, lat: float, lon: float, radius_km: float):
+        """Wszystkie punkty w promieniu radius_km → (indeksy, dystanse_km), rosnąco."""
+        if not len(self):
+            return np.empty(0, dtype="int64"), np.empty(0)
+        ci, cj = int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+        r_max = min(int(math.ceil(radius_km / self.cell_km)) if self.cell_km > 0 else 0,
+                    self._max_ring(ci, cj))
+        chunks = [c for r in range(r_max + 1) for c in self._ring(ci, cj, r)]
+        if not chunks:
+            return np.empty(0, dtype="int64"), np.empty(0)
+        idx = np.concatenate(chunks)
+        d = haversine_km_np(lat, lon, self.lats[idx], self.lons[idx])
+        keep = d <= radius_km
+        idx, d = idx[keep], d[keep]
+        order = np.argsort(d, kind="stable")
+        return idx[order], d[order]
+
+    def knn_many(self, lats, lons, k: int = 1):
+        """knn dla wielu zapytań → (indeksy [n×k], dystanse [n×k])."""
+        k = min(k, len(self))
+        lats, lons = np.asarray(lats, dtype="float64"), np.asarray(lons, dtype="float64")
+        out_idx = np.empty((len(lats), k), dtype="int64")
+        out_d = np.empty((len(lats), k))
+        for q, (lat, lon) in enumerate(zip(lats, lons)):
+            out_idx[q], out_d[q] = self.knn(lat, lon, k)
+        return out_idx, out_d
+
+
+# ── Sesja HTTP (keep-alive, pula połączeń per host) ─────────────────────────
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Współdzielona sesja requests — połączenia TCP/TLS są ponownie używane
+    między zapytaniami i wątkami (pula ≥ OSRM_MAX_IN_FLIGHT na host)."""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(OSRM_MAX_IN_FLIGHT, 10))
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _http_session = session
+    return _http_session
+
+
+# ── Kodowanie polilinii (Google Encoded Polyline, precyzja 1e-5) ────────────
+def encode_polyline(coords, precision: int = 5) -> str:
+    """Zakoduj listę [lat, lon] do zwartego stringa (format Google Polyline)."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lon = 0
+    for lat, lon in coords:
+        ilat, ilon = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (ilat - prev_lat, ilon - prev_lon):
+            v = ~(delta << 1) if delta < 0 else (delta << 1)
+            while v >= 0x20:
+                out.append(chr((0x20 | (v & 0x1F)) + 63))
+                v >>= 5
+            out.append(chr(v + 63))
+        prev_lat, prev_lon = ilat, ilon
+    return "".join(out)
+
+
+def decode_polyline(encoded: str, precision: int = 5) -> list:
+    """Odkoduj string Google Polyline do listy [lat, lon]."""
+    factor = 10 ** precision
+    coords = []
+    idx = lat = lon = 0
+    n = len(encoded)
+    while idx < n:
+        vals = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(encoded[idx]) - 63
+                idx += 1
+                result |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            vals.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += vals[0]
+        lon += vals[1]
+        coords.append([lat / factor, lon / factor])
+    return coords
+
+
+# ── Cache tras (SQLite obok CACHE_PATH) ─────────────────────────────────────
+_route_cache_local = threading.local()
+_route_cache_stats = {"hit": 0, "miss": 0}
+_route_cache_stats_lock = threading.Lock()
+
+
+def _route_cache_conn() -> sqlite3.Connection:
+    """Połączenie SQLite per wątek (fetch_routes_concurrent używa puli wątków)."""
+    conn = getattr(_route_cache_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(ROUTE_CACHE_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS route_cache ("
+            " key TEXT PRIMARY KEY,"
+            " distance_km REAL NOT NULL,"
+            " duration_min REAL NOT NULL,"
+            " polyline TEXT,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_route_cache_accessed ON route_cache(accessed_at)")
+        conn.commit()
+        _route_cache_local.conn = conn
+    return conn
+
+
+def route_cache_key(lat1: float, lon1: float, lat2: float, lon2: float) -> str:
+    """Klucz trasy — współrzędne zaokrąglone do ROUTE_CACHE_DECIMALS (~10 m)."""
+    d = ROUTE_CACHE_DECIMALS
+    return f"{lat1:.{d}f},{lon1:.{d}f};{lat2:.{d}f},{lon2:.{d}f}"
+
+
+def _route_cache_count(hit: int, miss: int) -> None:
+    with _route_cache_stats_lock:
+        _route_cache_stats["hit"] += hit
+        _route_cache_stats["miss"] += miss
+
+
+def route_cache_stats(reset: bool = False) -> dict:
+    """Liczniki trafień/chybień cache tras (od startu procesu lub ostatniego resetu)."""
+    with _route_cache_stats_lock:
+        stats = dict(_route_cache_stats)
+        if reset:
+            _route_cache_stats["hit"] = 0
+            _route_cache_stats["miss"] = 0
+    return stats
+
+
+def route_cache_get_many(keys, need_polyline: bool = False) -> dict:
+    """Odczytaj wiele tras z cache. Zwraca {key: (distance_km, duration_min, polyline|None)}.
+    Wpisy starsze niż ROUTE_CACHE_TTL_DAYS są pomijane (traktowane jak brak)."""
+    keys = list(keys)
+    found = {}
+    if not keys:
+        return found
+    now = time.time()
+    min_created = now - ROUTE_CACHE_TTL_DAYS * 86400
+    try:
+        conn = _route_cache_conn()
+        for start in range(0, len(keys), 500):  # limit zmiennych SQLite
+            batch = keys[start:start + 500]
+            marks = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT key, distance_km, duration_min, polyline FROM route_cache"
+                f" WHERE key IN ({marks}) AND created_at >= ?",
+                (*batch, min_created),
+            ).fetchall()
+            for key, dist, dur, enc in rows:
+                if need_polyline and not enc:
+                    continue
+                found[key] = (dist, dur, decode_polyline(enc) if enc else None)
+        if found:
+            conn.executemany("UPDATE route_cache SET accessed_at = ? WHERE key = ?",
+                             [(now, k) for k in found])
+            conn.commit()
+    except sqlite3.Error:
+        found = {}
+    _route_cache_count(len(found), len(keys) - len(found))
+    return found
+
+
+def route_cache_put_many(entries) -> None:
+    """Zapisz trasy do cache. entries: lista (key, distance_km, duration_min, polyline|None).
+    Wpis bez polilinii nie nadpisuje wcześniej zapisanej geometrii."""
+    entries = list(entries)
+    if not entries:
+        return
+    now = time.time()
+    try:
+        conn = _route_cache_conn()
+        conn.executemany(
+            "INSERT INTO route_cache (key, distance_km, duration_min, polyline, created_at, accessed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET"
+            "  distance_km = excluded.distance_km,"
+            "  duration_min = excluded.duration_min,"
+            "  polyline = COALESCE(excluded.polyline, route_cache.polyline),"
+            "  created_at = excluded.created_at,"
+            "  accessed_at = excluded.accessed_at",
+            [(key, dist, dur, encode_polyline(poly) if poly else None, now, now)
+             for key, dist, dur, poly in entries],
+        )
+        conn.commit()
+    except sqlite3.Error:
+        pass
+
+
+def route_cache_evict() -> int:
+    """Usuń wpisy przeterminowane (TTL) i najdawniej używane ponad ROUTE_CACHE_MAX_ENTRIES.
+    Zwraca liczbę usuniętych wpisów."""
+    try:
+        conn = _route_cache_conn()
+        min_created = time.time() - ROUTE_CACHE_TTL_DAYS * 86400
+        removed = conn.execute("DELETE FROM route_cache WHERE created_at < ?", (min_created,)).rowcount
+        excess = conn.execute("SELECT COUNT(*) FROM route_cache").fetchone()[0] - ROUTE_CACHE_MAX_ENTRIES
+        if excess > 0:
+            removed += conn.execute(
+                "DELETE FROM route_cache WHERE key IN ("
+                " SELECT key FROM route_cache ORDER BY accessed_at ASC LIMIT ?)",
+                (excess,),
+            ).rowcount
+        conn.commit()
+        return removed
+    except sqlite3.Error:
+        return 0
+
+
+# ── Backend routingu (route / table / nearest) ──────────────────────────────
+class RoutingBackend:
+    """Interfejs backendu routingu. Metody zwracają None, gdy backend nie dał
+    wyniku — wywołujący przechodzi wtedy na szacunek Haversine."""
+    name = "?"
+    source = "OSRM"      # etykieta wyników w kolumnie „Źródło”
+    offline = False      # True → wyniki to szacunki (bez zapytań, bez cache tras)
+    cache_routes = True  # wyniki do wspólnego cache tras (i nauki FallbackModel)
+
+    def health(self) -> bool:
+        raise NotImplementedError
+
+    def route(self, lat1: float, lon1: float, lat2: float, lon2: float, timeout: float):
+        """(distance_km, duration_min, lista [lat, lon]) lub None."""
+        raise NotImplementedError
+
+    def table(self, sources, destinations, timeout: float = OSRM_TIMEOUT):
+        """(dist_km, dur_min) — tablice (len(sources), len(destinations)), NaN bez wyniku; lub None."""
+        raise NotImplementedError
+
+    def nearest(self, lat: float, lon: float, timeout: float = OSRM_TIMEOUT):
+        """Najbliższy punkt sieci drogowej: (lat, lon, odległość_m) lub None."""
+        raise NotImplementedError
+
+    def many_to_one(self, origins, dest_lat: float, dest_lon: float):
+        """Wszystkie starty → jeden cel jednym przeszukaniem (odwrotnym od celu):
+        (dist_km[], dur_min[], geometry(i) → lista [lat, lon] lub None).
+        None — backend nie ma takiego zapytania (wywołujący używa table)."""
+        return None
+
+
+class OSRMBackend(RoutingBackend):
+    """osrm-backend pod base_url (własny serwer lub publiczne demo)."""
+
+    def __init__(self, base_url: str, profile: str = OSRM_PROFILE, name: str = "osrm"):
+        self.base_url = base_url.rstrip("/")
+        self.profile = profile
+        self.name = name
+
+    def _url(self, service: str, coords) -> str:
+        path = ";".join(f"{lon},{lat}" for lat, lon in coords)
+        return f"{self.base_url}/{service}/v1/{self.profile}/{path}"
+
+    def _get(self, url: str, timeout: float):
+        data = get_http_session().get(url, timeout=timeout).json()
+        return data if data.get("code") == "Ok" else None
+
+    def health(self) -> bool:
+        """Testowe zapytanie — sprawdza czy serwer odpowiada."""
+        url = self._url("route", [(50.065, 19.945), (50.0, 20.0)]) + "?overview=false"
+        for _ in range(2):  # 2 próby
+            try:
+                if self._get(url, timeout=8):
+                    return True
+            except Exception:
+                pass
+        return False
+
+    def route(self, lat1, lon1, lat2, lon2, timeout):
+        data = self._get(self._url("route", [(lat1, lon1), (lat2, lon2)])
+                         + "?overview=full&geometries=geojson", timeout)
+        if not data or not data.get("routes"):
+            return None
+        route = data["routes"][0]
+        polyline = [[c[1], c[0]] for c in route["geometry"]["coordinates"]]
+        return round(route["distance"] / 1000, 1), round(route["duration"] / 60, 1), polyline
+
+    def table(self, sources, destinations, timeout=OSRM_TIMEOUT):
+        n_s = len(sources)
+        url = (self._url("table", list(sources) + list(destinations))
+               + f"?sources={';'.join(str(i) for i in range(n_s))}"
+               + f"&destinations={';'.join(str(n_s + j) for j in range(len(destinations)))}"
+               + "&annotations=distance,duration")
+        data = self._get(url, timeout)
+        if not data:
+            return None
+        dist = np.array(data["distances"], dtype="float64")  # None → NaN
+        dur = np.array(data["durations"], dtype="float64")
+        return np.round(dist / 1000, 1), np.round(dur / 60, 1)
+
+    def nearest(self, lat, lon, timeout=OSRM_TIMEOUT):
+        data = self._get(self._url("nearest", [(lat, lon)]), timeout)
+        if not data or not data.get("waypoints"):
+            return None
+        wp = data["waypoints"][0]
+        return wp["location"][1], wp["location"][0], wp.get("distance", 0.0)
+
+
+class HaversineBackend(RoutingBackend):
+    """Offline: szacunek z linii prostej (kalibrowany z cache tras) — bez sieci, bez serwera."""
+    name = "haversine"
+    source = "szacunek"
+    offline = True
+    cache_routes = False
+
+    def health(self) -> bool:
+        return True
+
+    def route(self, lat1, lon1, lat2, lon2, timeout=None):
+        dist, dur = estimate_route_fallback(lat1, lon1, lat2, lon2)
+        return dist, dur, [[lat1, lon1], [lat2, lon2]]
+
+    def table(self, sources, destinations, timeout=None):
+        src = np.asarray(sources, dtype="float64").reshape(-1, 2)
+        dist = np.empty((len(src), len(destinations)))
+        dur = np.empty_like(dist)
+        for j, (d_lat, d_lon) in enumerate(destinations):
+            dist[:, j], dur[:, j] = estimate_routes_fallback(src[:, 0], src[:, 1], d_lat, d_lon)
+        return dist, dur
+
+    def nearest(self, lat, lon, timeout=None):
+        return lat, lon, 0.0
+
+
+# ── Offline: graf drogowy CSR z wyciągu OSM ─────────────────────────────────
+_ROAD_GRAPH_ARRAYS = ("lat", "lon", "indptr", "indices", "czas_s", "dlugosc_m",
+                      "r_indptr", "r_indices", "r_czas_s", "r_dlugosc_m")
+
+
+def _osm_oneway(tags: dict) -> int:
+    """1 — tylko zgodnie z kolejnością węzłów, -1 — tylko pod prąd, 0 — oba kierunki."""
+    val = tags.get("oneway", "")
+    if val in ("yes", "1", "true"):
+        return 1
+    if val == "-1":
+        return -1
+    if val == "no":
+        return 0
+    return 1 if tags.get("highway") == "motorway" or tags.get("junction") == "roundabout" else 0
+
+
+def _osm_speed(tags: dict) -> float:
+    """Prędkość (km/h): maxspeed (liczba) albo PREDKOSCI_DROG wg typu drogi."""
+    m = re.match(r"\s*(\d+)", tags.get("maxspeed", ""))
+    if m and int(m.group(1)) > 0:
+        return min(float(m.group(1)), 140.0)
+    return float(PREDKOSCI_DROG[tags["highway"]])
+
+
+def build_road_graph(osm_path: str, out_dir: str = ROAD_GRAPH_DIR) -> dict:
+    """Zbuduj graf drogowy z wyciągu OSM w formacie XML (.osm).
+    Drogi: highway ∈ PREDKOSCI_DROG, z uwzględnieniem jednokierunkowych.
+    Zostaje największa silnie spójna składowa (dojazd w obie strony z każdego węzła).
+    Zapis: tablice .npy (CSR w przód i wstecz) + graf.json — ładowane przez mmap.
+    Przygotowanie wyciągu (osmium-tool), np.:
+      osmium tags-filter poland-latest.osm.pbf w/highway -o drogi.osm
+    Uruchomienie: python -c "import mappa_core; mappa_core.build_road_graph('drogi.osm')"
+    Zwraca metadane grafu."""
+    # Przebieg 1: drogi → pary kolejnych węzłów (id OSM), prędkość, kierunek
+    seg_u, seg_v, seg_speed, seg_oneway = [], [], [], []
+    for _, elem in ET.iterparse(osm_path, events=("end",)):
+        if elem.tag == "way":
+            tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+            if tags.get("highway") in PREDKOSCI_DROG and tags.get("area") != "yes":
+                refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                if len(refs) > 1:
+                    speed, oneway = _osm_speed(tags), _osm_oneway(tags)
+                    seg_u.extend(refs[:-1])
+                    seg_v.extend(refs[1:])
+                    seg_speed.extend([speed] * (len(refs) - 1))
+                    seg_oneway.extend([oneway] * (len(refs) - 1))
+            elem.clear()
+        elif elem.tag in ("node", "relation"):
+            elem.clear()
+    seg_u = np.asarray(seg_u, dtype="int64")
+    seg_v = np.asarray(seg_v, dtype="int64")
+    seg_speed = np.asarray(seg_speed, dtype="float64")
+    seg_oneway = np.asarray(seg_oneway, dtype="int8")
+    osm_ids = np.unique(np.concatenate([seg_u, seg_v]))
+
+    # Przebieg 2: współrzędne tylko potrzebnych węzłów
+    lat = np.full(len(osm_ids), np.nan)
+    lon = np.full(len(osm_ids), np.nan)
+    for _, elem in ET.iterparse(osm_path, events=("end",)):
+        if elem.tag == "node":
+            node_id = int(elem.get("id"))
+            i = int(np.searchsorted(osm_ids, node_id))
+            if i < len(osm_ids) and osm_ids[i] == node_id:
+                lat[i], lon[i] = float(elem.get("lat")), float(elem.get("lon"))
+        if elem.tag in ("node", "way", "relation"):
+            elem.clear()
+
+    u = np.searchsorted(osm_ids, seg_u)
+    v = np.searchsorted(osm_ids, seg_v)
+    ok = ~(np.isnan(lat[u]) | np.isnan(lat[v])) & (u != v)
+    u, v, seg_speed, seg_oneway = u[ok], v[ok], seg_speed[ok], seg_oneway[ok]
+    length_m = haversine_km_np(lat[u], lon[u], lat[v], lon[v]) * 1000
+    time_s = np.maximum(length_m / (seg_speed / 3.6), 0.01)  # 0 = brak krawędzi w csgraph
+
+    fwd, bwd = seg_oneway >= 0, seg_oneway <= 0
+    src = np.concatenate([u[fwd], v[bwd]])
+    dst = np.concatenate([v[fwd], u[bwd]])
+    t = np.concatenate([time_s[fwd], time_s[bwd]])
+    d = np.concatenate([length_m[fwd], length_m[bwd]])
+
+    # Największa silnie spójna składowa
+    n = len(osm_ids)
+    g = sparse.csr_matrix((t, (src, dst)), shape=(n, n))
+    _, labels = csgraph.connected_components(g, directed=True, connection="strong")
+    main = labels == np.bincount(labels).argmax()
+    remap = np.cumsum(main) - 1
+    keep = main[src] & main[dst]
+    src, dst, t, d = remap[src[keep]], remap[dst[keep]], t[keep], d[keep]
+    lat, lon = lat[main], lon[main]
+    n = int(main.sum())
+
+    # Krawędzie równoległe → najszybsza
+    order = np.lexsort((t, dst, src))
+    src, dst, t, d = src[order], dst[order], t[order], d[order]
+    first = np.ones(len(src), dtype=bool)
+    first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+    src, dst, t, d = src[first], dst[first], t[first], d[first]
+
+    def _csr(a, b):
+        o = np.lexsort((b, a))
+        indptr = np.zeros(n + 1, dtype="int32")
+        np.cumsum(np.bincount(a, minlength=n), out=indptr[1:])
+        return indptr, b[o].astype("int32"), t[o].astype("float64"), d[o].astype("float32")
+
+    arrays = dict(zip(("indptr", "indices", "czas_s", "dlugosc_m"), _csr(src, dst)))
+    arrays.update(zip(("r_indptr", "r_indices", "r_czas_s", "r_dlugosc_m"), _csr(dst, src)))
+    arrays["lat"], arrays["lon"] = lat.astype("float64"), lon.astype("float64")
+    os.makedirs(out_dir, exist_ok=True)
+    for name in _ROAD_GRAPH_ARRAYS:
+        np.save(os.path.join(out_dir, f"{name}.npy"), arrays[name])
+    meta = {"wezly": n, "krawedzie": int(len(src)), "zrodlo": os.path.basename(osm_path),
+            "utworzono": time.strftime("%Y-%m-%d %H:%M")}
+    with open(os.path.join(out_dir, "graf.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return meta
+
+
+class RoadGraph:
+    """Graf drogowy CSR (w przód i wstecz) ładowany przez mmap — start bez
+    wczytywania całego pliku. Wagi: czas [s] (trasa najszybsza), dystans [m]
+    liczony wzdłuż znalezionej trasy."""
+
+    def __init__(self, graph_dir: str = ROAD_GRAPH_DIR):
+        with open(os.path.join(graph_dir, "graf.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        a = {name: np.load(os.path.join(graph_dir, f"{name}.npy"), mmap_mode="r")
+             for name in _ROAD_GRAPH_ARRAYS}
+        self.n = len(a["lat"])
+        self.lat, self.lon = a["lat"], a["lon"]
+        shape = (self.n, self.n)
+        self.fwd_time = sparse.csr_matrix((a["czas_s"], a["indices"], a["indptr"]), shape=shape, copy=False)
+        self.fwd_len = sparse.csr_matrix((a["dlugosc_m"], a["indices"], a["indptr"]), shape=shape, copy=False)
+        self.bwd_time = sparse.csr_matrix((a["r_czas_s"], a["r_indices"], a["r_indptr"]), shape=shape, copy=False)
+        self.bwd_len = sparse.csr_matrix((a["r_dlugosc_m"], a["r_indices"], a["r_indptr"]), shape=shape, copy=False)
+        self._index = None
+
+    @property
+    def index(self) -> PointIndex:
+        if self._index is None:
+            self._index = PointIndex(np.asarray(self.lat), np.asarray(self.lon), cell_deg=0.02)
+        return self._index
+
+    def snap(self, lat: float, lon: float) -> tuple:
+        """Najbliższy węzeł grafu → (węzeł, odległość_km)."""
+        idx, dist = self.index.knn(lat, lon, k=1)
+        return int(idx[0]), float(dist[0])
+
+    def shortest_path(self, source: int, target: int):
+        """Dwukierunkowy Dijkstra (czas) → (czas_s, dystans_m, lista węzłów) lub None."""
+        if source == target:
+            return 0.0, 0.0, [source]
+        sides = [
+            (self.fwd_time, {source: 0.0}, {source: -1}, [(0.0, source)], set()),
+            (self.bwd_time, {target: 0.0}, {target: -1}, [(0.0, target)], set()),
+        ]
+        best, meet = np.inf, -1
+        while sides[0][3] and sides[1][3]:
+            if sides[0][3][0][0] + sides[1][3][0][0] >= best:
+                break
+            k = 0 if sides[0][3][0][0] <= sides[1][3][0][0] else 1
+            graph, dist, pred, heap, done = sides[k]
+            other_dist = sides[1 - k][1]
+            du, u = heapq.heappop(heap)
+            if u in done:
+                continue
+            done.add(u)
+            lo, hi = graph.indptr[u], graph.indptr[u + 1]
+            for v, w in zip(graph.indices[lo:hi].tolist(), graph.data[lo:hi].tolist()):
+                nd = du + w
+                if nd < dist.get(v, np.inf):
+                    dist[v] = nd
+                    pred[v] = u
+                    heapq.heappush(heap, (nd, v))
+                if v in other_dist and nd + other_dist[v] < best:
+                    best, meet = nd + other_dist[v], v
+        if meet < 0:
+            return None
+        path, node = [], meet
+        while node != -1:
+            path.append(node)
+            node = sides[0][2][node]
+        path.reverse()
+        node = sides[1][2][meet]
+        while node != -1:
+            path.append(node)
+            node = sides[1][2][node]
+        p = np.asarray(path)
+        length = float(np.asarray(self.fwd_len[p[:-1], p[1:]]).sum()) if len(p) > 1 else 0.0
+        return best, length, path
+
+    def _tree_lengths(self, pred: np.ndarray, targets: np.ndarray, lengths) -> np.ndarray:
+        """Dystans [m] od korzenia drzewa najkrótszych ścieżek (wg czasu) do targets.
+        Sumowanie długości krawędzi po poddrzewie przodków (pointer jumping)."""
+        frontier = targets[targets >= 0]
+        seen = np.zeros(self.n, dtype=bool)
+        seen[frontier] = True
+        while len(frontier):
+            frontier = pred[frontier]
+            frontier = np.unique(frontier[frontier >= 0])
+            frontier = frontier[~seen[frontier]]
+            seen[frontier] = True
+        sub = np.flatnonzero(seen)
+        parent = pred[sub]
+        has_parent = parent >= 0
+        acc = np.zeros(len(sub))
+        acc[has_parent] = np.asarray(lengths[parent[has_parent], sub[has_parent]]).ravel()
+        anc = np.full(len(sub), -1)
+        anc[has_parent] = np.searchsorted(sub, parent[has_parent])
+        while (anc >= 0).any():
+            m = anc >= 0
+            new_acc = acc.copy()
+            new_acc[m] += acc[anc[m]]
+            new_anc = np.full(len(sub), -1)
+            new_anc[m] = anc[anc[m]]
+            acc, anc = new_acc, new_anc
+        out = np.full(len(targets), np.nan)
+        ok = targets >= 0
+        out[ok] = acc[np.searchsorted(sub, targets[ok])]
+        return out
+
+    @staticmethod
+    def path_to_root(pred: np.ndarray, node: int) -> list:
+        """Ścieżka węzłów z node do korzenia drzewa (tablica poprzedników)."""
+        path = [node]
+        while pred[node] >= 0:
+            node = int(pred[node])
+            path.append(node)
+        return path
+
+    def one_to_many(self, source: int, targets, reverse: bool = False):
+        """Jedno przeszukanie z węzła source do wszystkich targets.
+        reverse=True — po grafie odwróconym (czasy DO source).
+        Zwraca (czas_s[], dystans_m[], tablica poprzedników)."""
+        graph, lengths = (self.bwd_time, self.bwd_len) if reverse else (self.fwd_time, self.fwd_len)
+        targets = np.asarray(targets, dtype="int64")
+        times, pred = csgraph.dijkstra(graph, directed=True, indices=source, return_predecessors=True)
+        pred = np.where(pred < 0, -1, pred)
+        t = times[targets]
+        d = self._tree_lengths(pred, np.where(np.isfinite(t), targets, -1), lengths)
+        return t, d, pred
+
+
+class RoadGraphBackend(RoutingBackend):
+    """Routing offline po grafie drogowym z wyciągu OSM (bez sieci).
+    Punkty są dociągane do najbliższego węzła; dojazd do węzła liczony
+    po prostej z prędkością ROAD_SNAP_SPEED_KMH. Wyniki nie trafiają do cache
+    tras — ten należy do OSRM (klucze bez backendu, nauka FallbackModel)."""
+    source = "graf"
+    cache_routes = False
+
+    def __init__(self, graph_dir: str = ROAD_GRAPH_DIR):
+        self.graph = RoadGraph(graph_dir)
+        self.name = f"graf offline ({self.graph.meta.get('zrodlo', '?')})"
+
+    def health(self) -> bool:
+        return self.graph.n > 0
+
+    def _snap_many(self, points):
+        snapped = [self.graph.snap(lat, lon) for lat, lon in points]
+        return (np.array([n for n, _ in snapped], dtype="int64"),
+                np.array([km for _, km in snapped], dtype="float64"))
+
+    def route(self, lat1, lon1, lat2, lon2, timeout=None):
+        (a, b), (ka, kb) = self._snap_many([(lat1, lon1), (lat2, lon2)])
+        found = self.graph.shortest_path(int(a), int(b))
+        if found is None:
+            return None
+        time_s, length_m, path = found
+        off_km = float(ka + kb)
+        polyline = ([[lat1, lon1]]
+                    + np.column_stack([self.graph.lat[path], self.graph.lon[path]]).tolist()
+                    + [[lat2, lon2]])
+        return (round(float(length_m) / 1000 + off_km, 1),
+                round(float(time_s) / 60 + off_km / ROAD_SNAP_SPEED_KMH * 60, 1), polyline)
+
+    def table(self, sources, destinations, timeout=None):
+        s_nodes, s_km = self._snap_many(sources)
+        d_nodes, d_km = self._snap_many(destinations)
+        dist = np.empty((len(sources), len(destinations)))
+        dur = np.empty_like(dist)
+        # Przeszukań tyle, ile ma mniejsza strona: z każdego startu w przód
+        # albo z każdego celu po grafie odwróconym
+        if len(sources) <= len(destinations):
+            for i, node in enumerate(s_nodes):
+                t, d, _ = self.graph.one_to_many(int(node), d_nodes)
+                dist[i], dur[i] = d, t
+        else:
+            for j, node in enumerate(d_nodes):
+                t, d, _ = self.graph.one_to_many(int(node), s_nodes, reverse=True)
+                dist[:, j], dur[:, j] = d, t
+        off_km = s_km[:, None] + d_km[None, :]
+        return (np.round(dist / 1000 + off_km, 1),
+                np.round(dur / 60 + off_km / ROAD_SNAP_SPEED_KMH * 60, 1))
+
+    def many_to_one(self, origins, dest_lat, dest_lon):
+        """Jedno przeszukanie po grafie odwróconym od celu. Poprzednik węzła
+        w tym drzewie = następny węzeł w stronę celu, więc geometria dowolnego
+        startu odtwarza się na żądanie, bez kolejnych przeszukań."""
+        o_nodes, o_km = self._snap_many(origins)
+        dest_node, dest_km = self.graph.snap(dest_lat, dest_lon)
+        t, d, pred = self.graph.one_to_many(dest_node, o_nodes, reverse=True)
+        off_km = o_km + dest_km
+        dist = np.round(d / 1000 + off_km, 1)
+        dur = np.round(t / 60 + off_km / ROAD_SNAP_SPEED_KMH * 60, 1)
+
+        def geometry(i: int):
+            if not np.isfinite(t[i]):
+                return None
+            path = self.graph.path_to_root(pred, int(o_nodes[i]))
+            return ([[float(origins[i][0]), float(origins[i][1])]]
+                    + np.column_stack([self.graph.lat[path], self.graph.lon[path]]).tolist()
+                    + [[dest_lat, dest_lon]])
+
+        return dist, dur, geometry
+
+    def nearest(self, lat, lon, timeout=None):
+        node, km = self.graph.snap(lat, lon)
+        return float(self.graph.lat[node]), float(self.graph.lon[node]), km * 1000
+
+
+def road_graph_available(graph_dir: str = ROAD_GRAPH_DIR) -> bool:
+    return os.path.exists(os.path.join(graph_dir, "graf.json"))
+
+
+def make_routing_backend(kind: str = ROUTING_BACKEND, url: str = OSRM_URL) -> RoutingBackend:
+    """Backend wg nazwy: "osrm-demo", "osrm" (url), "graf" (offline) lub "haversine"."""
+    if kind == "haversine":
+        return HaversineBackend()
+    if kind == "graf":
+        return RoadGraphBackend()
+    if kind == "osrm":
+        return OSRMBackend(url, name=f"osrm ({url})")
+    if kind == "osrm-demo":
+        return OSRMBackend(OSRM_DEMO_URL, name="osrm-demo")
+    raise ValueError(f"Nieznany backend routingu: {kind!r} (osrm-demo | osrm | graf | haversine)")
+
+
+_routing_backend = None      # skonfigurowany (MAPPA_ROUTING) — zawsze podstawowy
+_graph_backend = None        # graf offline — zastępczo, gdy OSRM nie odpowiada
+_routing_down = False        # wynik ostatniego check_osrm_available (backend podstawowy)
+_routing_backend_lock = threading.Lock()
+
+
+def configured_routing_backend() -> RoutingBackend:
+    """Backend skonfigurowany dla wdrożenia (tworzony raz na proces)."""
+    global _routing_backend
+    if _routing_backend is None:
+        with _routing_backend_lock:
+            if _routing_backend is None:
+                _routing_backend = make_routing_backend()
+    return _routing_backend
+
+
+def get_routing_backend() -> RoutingBackend:
+    """Backend dla bieżących zapytań: skonfigurowany, a gdy ostatnie sprawdzenie
+    (check_osrm_available) wykazało, że nie odpowiada — graf offline, jeśli jest."""
+    if _routing_down and _graph_backend is not None:
+        return _graph_backend
+    return configured_routing_backend()
+
+
+# ── Zdrowie routingu: opóźnienia, adaptacyjny timeout, bezpiecznik ─────────
+class RoutingHealth:
+    """Stan zapytań do backendu routingu w procesie (wspólny dla wątków).
+    - opóźnienia: ostatnie ROUTING_LATENCY_WINDOW zapytań osobno dla route/table
+      (table — na współrzędną zapytania; timeout liczony jako opóźnienie ≥ limitu),
+    - timeout: p95 × ROUTING_TIMEOUT_P95_FACTOR (× rozmiar bloku /table) zamiast
+      stałych 10–15 s; zapytanie próbne zawsze z pełnym limitem domyślnym,
+    - bezpiecznik: po BREAKER_FAILURES błędach z rzędu zapytania nie idą do
+      serwera (od razu szacunek); po BREAKER_COOLDOWN_S przepuszcza jedno
+      próbne — sukces zamyka bezpiecznik, błąd otwiera go ponownie."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {"route": deque(maxlen=ROUTING_LATENCY_WINDOW),
+                         "table": deque(maxlen=ROUTING_LATENCY_WINDOW)}
+        self.failures = 0
+        self.opened_at = None   # czas otwarcia bezpiecznika (None — zamknięty)
+        self.probing = 0        # numer trwającego zapytania próbnego (0 — brak)
+        self._probe_seq = 0
+
+    def allow(self):
+        """Przepustka na zapytanie do serwera: None — nie wysyłaj (użyj szacunku),
+        0 — zwykłe zapytanie, > 0 — numer zapytania próbnego (półotwarty).
+        Przepustkę przekazuje się do timeout() i record()."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            if self.probing or time.monotonic() - self.opened_at < BREAKER_COOLDOWN_S:
+                return None
+            self._probe_seq += 1
+            self.probing = self._probe_seq
+            return self.probing
+
+    def record(self, kind: str, latency_s: float, ok: bool, size: int = 1,
+               timeout_s: float = None, ticket: int = 0) -> None:
+        """Wynik zapytania o rozmiarze size (/table — liczba współrzędnych).
+        timeout_s — zapytanie przekroczyło ten limit: do okna opóźnień trafia
+        co najmniej on, żeby adaptacyjny timeout mógł też rosnąć. Stan próbny
+        kończy tylko wynik zapytania z przepustką próbną (ticket z allow())."""
+        with self._lock:
+            if ticket and ticket == self.probing:
+                self.probing = 0
+            if ok or timeout_s is not None:
+                self._latency[kind].append(max(latency_s, timeout_s or 0.0) / size)
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= BREAKER_FAILURES:
+                    self.opened_at = time.monotonic()
+
+    def percentile(self, kind: str, q: float):
+        with self._lock:
+            samples = list(self._latency[kind])
+        return float(np.percentile(samples, q)) if samples else None
+
+    def timeout(self, kind: str, default: float, size: int = 1, ticket: int = 0) -> float:
+        """Timeout zapytania o rozmiarze size: p95 × size × współczynnik, w granicach
+        [ROUTING_TIMEOUT_MIN_S, default]. Zapytanie próbne (ticket > 0) — default."""
+        if ticket:
+            return default
+        with self._lock:
+            samples = list(self._latency[kind])
+        if len(samples) < ROUTING_LATENCY_MIN_SAMPLES:
+            return default
+        p95 = float(np.percentile(samples, 95))
+        return min(default, max(ROUTING_TIMEOUT_MIN_S, p95 * size * ROUTING_TIMEOUT_P95_FACTOR))
+
+    def status(self) -> dict:
+        """Stan do wyświetlenia: bezpiecznik, błędy z rzędu, p50/p95 (ms), timeouty (s)."""
+        with self._lock:
+            if self.opened_at is None:
+                stan = "zamknięty"
+            elif time.monotonic() - self.opened_at < BREAKER_COOLDOWN_S:
+                stan = "otwarty"
+            else:
+                stan = "półotwarty"
+            failures = self.failures
+        out = {"bezpiecznik": stan, "bledy_z_rzedu": failures}
+        # /table: opóźnienia na współrzędną, timeout dla pełnego bloku (OSRM_TABLE_MAX_COORDS)
+        for kind, default, size, unit in (("route", OSRM_REQUEST_DEADLINE, 1, "ms"),
+                                          ("table", OSRM_TIMEOUT, OSRM_TABLE_MAX_COORDS, "ms_na_punkt")):
+            for q in (50, 95):
+                p = self.percentile(kind, q)
+                out[f"{kind}_p{q}_{unit}"] = None if p is None else round(p * 1000, 1)
+            out[f"{kind}_timeout_s"] = round(self.timeout(kind, default, size), 2)
+        return out
+
+
+_routing_health = {}   # nazwa backendu → RoutingHealth (osobne opóźnienia i bezpiecznik)
+_routing_health_lock = threading.Lock()
+
+
+def get_routing_health(backend: RoutingBackend = None) -> RoutingHealth:
+    """Stan zapytań danego backendu (domyślnie skonfigurowanego głównego) —
+    opóźnienia grafu nie wpływają na timeout OSRM i odwrotnie."""
+    name = (backend or configured_routing_backend()).name
+    with _routing_health_lock:
+        if name not in _routing_health:
+            _routing_health[name] = RoutingHealth()
+        return _routing_health[name]
+
+
+def budget_left(deadline) -> float:
+    """Sekundy do końca budżetu analizy (deadline — czas monotoniczny lub None = bez limitu)."""
+    return float("inf") if deadline is None else deadline - time.monotonic()
+
+
+# ── C7: Sprawdzenie dostępności OSRM ─────────────────────────────────────────
+def check_osrm_available() -> bool:
+    """Czy routing odpowiada. Zawsze sprawdzany jest backend skonfigurowany —
+    gdy OSRM nie odpowiada, a na dysku jest graf drogowy (ROAD_GRAPH_DIR),
+    zapytania idą do grafu offline do następnego udanego sprawdzenia.
+    Backend szacunkowy (haversine) — zawsze False: wyniki są szacunkami."""
+    global _routing_down, _graph_backend
+    backend = configured_routing_backend()
+    if backend.offline:
+        return False
+    if backend.health():
+        _routing_down = False
+        return True
+    if isinstance(backend, RoadGraphBackend) or not road_graph_available():
+        _routing_down = True
+        return False
+    with _routing_backend_lock:
+        if _graph_backend is None:
+            _graph_backend = RoadGraphBackend()
+    _routing_down = True
+    return _graph_backend.health()
+
+
+# ── OSRM Routing (z geometrią trasy) ────────────────────────────────────────
+def get_osrm_route(lat1: float, lon1: float, lat2: float, lon2: float,
+                   use_fallback: bool = False, deadline_s: float = OSRM_REQUEST_DEADLINE,
+                   deadline=None):
+    """Pobierz dystans (km), czas (min) i geometrię trasy z backendu routingu.
+    A4: Retry 1× przy timeout, w ramach łącznego limitu deadline_s i budżetu
+    analizy (deadline — czas monotoniczny, None = bez limitu); timeout próby
+    adaptacyjny (RoutingHealth). Otwarty bezpiecznik, wyczerpany budżet lub
+    use_fallback=True → Haversine. Wyniki OSRM trafiają do cache tras.
+    Zwraca: (distance_km, duration_min, list_of_[lat,lon])"""
+    backend = get_routing_backend()
+    if not use_fallback and not backend.offline:
+        key = route_cache_key(lat1, lon1, lat2, lon2)
+        cached = route_cache_get_many([key], need_polyline=True).get(key) if backend.cache_routes else None
+        if cached:
+            return cached
+        health = get_routing_health(backend)
+        max_retries = 2  # A4: 1 próba dodatkowa
+        until = time.monotonic() + min(deadline_s, budget_left(deadline))
+        for attempt in range(max_retries):
+            remaining = until - time.monotonic()
+            ticket = health.allow() if remaining > 0 else None
+            if ticket is None:
+                break
+            started = time.monotonic()
+            timeout = min(remaining, health.timeout("route", deadline_s, ticket=ticket))
+            try:
+                result = backend.route(lat1, lon1, lat2, lon2, timeout=timeout)
+            except requests.exceptions.Timeout:
+                health.record("route", time.monotonic() - started, ok=False, timeout_s=timeout, ticket=ticket)
+                if attempt < max_retries - 1:
+                    time.sleep(0.5)  # krótka pauza przed retry
+                continue
+            except Exception:
+                health.record("route", time.monotonic() - started, ok=False, ticket=ticket)
+                break  # inne błędy — nie retry'uj
+            health.record("route", time.monotonic() - started, ok=True, ticket=ticket)
+            if result is not None:
+                if backend.cache_routes:
+                    route_cache_put_many([(key, *result)])
+                return result
+    # Fallback: szacunek z linii prostej (model kalibrowany z cache tras)
+    dist, dur = estimate_route_fallback(lat1, lon1, lat2, lon2)
+    polyline = [[lat1, lon1], [lat2, lon2]]
+    return dist, dur, polyline
+
+
+def estimate_routes_fallback(lats, lons, dest_lat: float, dest_lon: float):
+    """Przybliżenie drogowe bez OSRM dla wielu startów — model kalibrowany
+    z cache tras (fallback_model); bez danych: Haversine × 1.3, ~60 km/h.
+    Zwraca: (distance_km[], duration_min[])"""
+    lats = np.asarray(lats, dtype="float64")
+    lons = np.asarray(lons, dtype="float64")
+    dist, dur = fallback_model().predict(lats, lons, np.full_like(lats, dest_lat), np.full_like(lons, dest_lon))
+    return np.round(dist, 1), np.round(dur, 1)
+
+
+def estimate_route_fallback(lat1: float, lon1: float, lat2: float, lon2: float):
+    """Przybliżenie drogowe bez OSRM dla jednej pary.
+    Zwraca: (distance_km, duration_min)"""
+    dist, dur = estimate_routes_fallback([lat1], [lon1], lat2, lon2)
+    return float(dist[0]), float(dur[0])
+
+
+# ── Kalibrowany szacunek tras (uczony na cache prawdziwych tras) ────────────
+def route_cache_samples() -> pd.DataFrame:
+    """Aktualne trasy z cache: lat1, lon1, lat2, lon2 (z klucza), dystans_km, czas_min."""
+    try:
+        rows = _route_cache_conn().execute(
+            "SELECT key, distance_km, duration_min FROM route_cache WHERE created_at >= ?",
+            (time.time() - ROUTE_CACHE_TTL_DAYS * 86400,),
+        ).fetchall()
+    except sqlite3.Error:
+        rows = []
+    cols = ["lat1", "lon1", "lat2", "lon2"]
+    if not rows:
+        return pd.DataFrame(columns=cols + ["dystans_km", "czas_min"], dtype="float64")
+    keys, dist, dur = zip(*rows)
+    df = pd.Series(keys).str.split(r"[,;]", expand=True).astype("float64")
+    df.columns = cols
+    df["dystans_km"] = np.asarray(dist, dtype="float64")
+    df["czas_min"] = np.asarray(dur, dtype="float64")
+    return df
+
+
+def _relative_error_pct(pred, true) -> np.ndarray:
+    return np.abs(pred - true) / np.maximum(true, 0.1) * 100
+
+
+class FallbackModel:
+    """Szacunek dystansu i czasu z odległości w linii prostej.
+    log(dystans / linia prosta) i log(prędkość) = efekt przedziału odległości
+    (FALLBACK_BANDS_KM, mediana) + efekt regionu (siatka FALLBACK_REGION_DEG
+    wg środka odcinka, średnia reszt ściągana do 0: suma / (n + FALLBACK_SHRINK)).
+    Bez danych — stałe FALLBACK_DETOUR i FALLBACK_SPEED_KMH (dawny szacunek)."""
+
+    def __init__(self):
+        n_bands = len(FALLBACK_BANDS_KM) + 1
+        self.band_detour = np.full(n_bands, math.log(FALLBACK_DETOUR))
+        self.band_speed = np.full(n_bands, math.log(FALLBACK_SPEED_KMH))
+        self.region_detour = {}
+        self.region_speed = {}
+        self.band_error = None  # (błąd dystansu, błąd czasu) per przedział — z próby testowej
+        self.evaluation = None  # trafność na odłożonych trasach (evaluate)
+        self.n_routes = 0
+        self.fitted_at = time.monotonic()
+
+    @staticmethod
+    def _features(lat1, lon1, lat2, lon2):
+        line_km = haversine_km_np(lat1, lon1, lat2, lon2)
+        band = np.digitize(line_km, FALLBACK_BANDS_KM)
+        region = (np.floor((np.asarray(lat1) + lat2) / 2 / FALLBACK_REGION_DEG) * 10000
+                  + np.floor((np.asarray(lon1) + lon2) / 2 / FALLBACK_REGION_DEG)).astype("int64")
+        return line_km, band, region
+
+    @classmethod
+    def fit(cls, samples: pd.DataFrame) -> "FallbackModel":
+        model = cls()
+        line_km, band, region = cls._features(*(samples[c].to_numpy() for c in ("lat1", "lon1", "lat2", "lon2")))
+        dist, dur = samples["dystans_km"].to_numpy(), samples["czas_min"].to_numpy()
+        ok = (line_km >= 0.5) & (dist > 0) & (dur > 0)  # krótkie odcinki — iloraz niestabilny
+        line_km, band, region, dist, dur = line_km[ok], band[ok], region[ok], dist[ok], dur[ok]
+        log_detour = np.log(dist / line_km)
+        log_speed = np.log(dist / (dur / 60))
+        for b in range(len(model.band_detour)):
+            in_band = band == b
+            if in_band.sum() >= 5:
+                model.band_detour[b] = np.median(log_detour[in_band])
+                model.band_speed[b] = np.median(log_speed[in_band])
+        residuals = pd.DataFrame({
+            "region": region,
+            "detour": log_detour - model.band_detour[band],
+            "speed": log_speed - model.band_speed[band],
+        }).groupby("region").agg(["sum", "count"])
+        for col, target in (("detour", model.region_detour), ("speed", model.region_speed)):
+            shrunk = residuals[(col, "sum")] / (residuals[(col, "count")] + FALLBACK_SHRINK)
+            target.update(shrunk.to_dict())
+        model.n_routes = int(ok.sum())
+        return model
+
+    def predict(self, lat1, lon1, lat2, lon2) -> tuple:
+        """(dystans_km[], czas_min[]) — bez zaokrągleń."""
+        line_km, band, region = self._features(lat1, lon1, lat2, lon2)
+        regions = pd.Series(region)
+        detour = self.band_detour[band] + regions.map(self.region_detour).fillna(0.0).to_numpy()
+        speed = self.band_speed[band] + regions.map(self.region_speed).fillna(0.0).to_numpy()
+        dist = line_km * np.exp(detour)
+        return dist, dist / np.exp(speed) * 60
+
+    def evaluate(self, samples: pd.DataFrame) -> dict:
+        """Trafność na trasach spoza uczenia: mediana i p80 błędu względnego (%)
+        dystansu i czasu, obok dawnego szacunku (× FALLBACK_DETOUR, FALLBACK_SPEED_KMH)."""
+        coords = [samples[c].to_numpy() for c in ("lat1", "lon1", "lat2", "lon2")]
+        dist, dur = samples["dystans_km"].to_numpy(), samples["czas_min"].to_numpy()
+        p_dist, p_dur = self.predict(*coords)
+        b_dist = haversine_km_np(*coords) * FALLBACK_DETOUR
+        b_dur = b_dist / FALLBACK_SPEED_KMH * 60
+        err = _relative_error_pct
+        out = {"trasy_testowe": len(samples)}
+        for name, pred, base, true in (("dystans", p_dist, b_dist, dist), ("czas", p_dur, b_dur, dur)):
+            e, e_base = err(pred, true), err(base, true)
+            out[f"{name}_blad_mediana_pct"] = round(float(np.median(e)), 1)
+            out[f"{name}_blad_p80_pct"] = round(float(np.percentile(e, 80)), 1)
+            out[f"{name}_bazowy_mediana_pct"] = round(float(np.median(e_base)), 1)
+        _, band, _ = self._features(*coords)
+        overall = (float(np.percentile(err(p_dist, dist), 80)), float(np.percentile(err(p_dur, dur), 80)))
+        self.band_error = [
+            (float(np.percentile(err(p_dist[band == b], dist[band == b]), 80)),
+             float(np.percentile(err(p_dur[band == b], dur[band == b]), 80)))
+            if (band == b).sum() >= 10 else overall
+            for b in range(len(self.band_detour))
+        ]
+        return out
+
+    def confidence(self, line_km) -> list:
+        """Opis pewności szacunku per trasa: "±12% km, ±18% min" (p80 błędu na
+        odłożonych trasach w tym przedziale odległości)."""
+        band = np.digitize(np.asarray(line_km, dtype="float64"), FALLBACK_BANDS_KM)
+        if self.band_error is None:
+            return [f"bez kalibracji (×{FALLBACK_DETOUR}, {FALLBACK_SPEED_KMH:.0f} km/h)"] * len(band)
+        return [f"±{self.band_error[b][0]:.0f}% km, ±{self.band_error[b][1]:.0f}% min" for b in band]
+
+
+_fallback_model = None
+_fallback_model_lock = threading.Lock()   # chroni _fallback_model i wątek uczenia
+_fallback_fit_lock = threading.Lock()     # jedno uczenie naraz
+_fallback_refit_worker = None
+
+
+def _fit_fallback_model() -> FallbackModel:
+    """Naucz model na cache tras (poza blokadą modelu — trwa przy dużym cache).
+    Trafność mierzona na FALLBACK_HOLDOUT tras odłożonych przy uczeniu;
+    model używany dalej — uczony na wszystkich."""
+    samples = route_cache_samples()
+    if len(samples) < FALLBACK_MIN_ROUTES:
+        return FallbackModel()
+    holdout = np.random.default_rng(0).random(len(samples)) < FALLBACK_HOLDOUT
+    trial = FallbackModel.fit(samples[~holdout])
+    evaluation = trial.evaluate(samples[holdout])
+    model = FallbackModel.fit(samples)
+    model.band_error = trial.band_error
+    model.evaluation = evaluation
+    return model
+
+
+def _refit_fallback_model(stale: FallbackModel) -> None:
+    """Ponowne uczenie w tle; do końca zapytania korzystają ze starego modelu.
+    Błąd uczenia — stary model zostaje na kolejne FALLBACK_MODEL_TTL_S."""
+    global _fallback_model
+    try:
+        with _fallback_fit_lock:
+            model = _fit_fallback_model()
+    except Exception:
+        stale.fitted_at = time.monotonic()
+        return
+    with _fallback_model_lock:
+        if _fallback_model is stale:
+            _fallback_model = model
+
+
+def fallback_model(refit: bool = False) -> FallbackModel:
+    """Model szacunku dla procesu — uczony z cache tras przy pierwszym użyciu
+    (albo refit=True) i ponownie w tle co FALLBACK_MODEL_TTL_S; w trakcie
+    uczenia w tle zwracany jest dotychczasowy model."""
+    global _fallback_model, _fallback_refit_worker
+    with _fallback_model_lock:
+        model = _fallback_model
+        if (not refit and model is not None
+                and time.monotonic() - model.fitted_at > FALLBACK_MODEL_TTL_S
+                and (_fallback_refit_worker is None or not _fallback_refit_worker.is_alive())):
+            _fallback_refit_worker = threading.Thread(target=_refit_fallback_model, args=(model,),
+                                                      name="mappa-fallback-refit", daemon=True)
+            _fallback_refit_worker.start()
+    if model is not None and not refit:
+        return model
+    with _fallback_fit_lock:
+        with _fallback_model_lock:
+            if not refit and _fallback_model is not None:
+                return _fallback_model  # inny wątek nauczył model w międzyczasie
+        model = _fit_fallback_model()
+        with _fallback_model_lock:
+            _fallback_model = model
+    return model
+
+
+# ── Równoległe pobieranie tras ──────────────────────────────────────────────
+def fetch_routes_concurrent(pairs, use_fallback: bool = False,
+                            max_in_flight: int = OSRM_MAX_IN_FLIGHT,
+                            deadline_s: float = OSRM_REQUEST_DEADLINE,
+                            on_progress=None, deadline=None):
+    """Pobierz wiele tras get_osrm_route równolegle (pula wątków, wspólna sesja HTTP).
+    pairs: lista (lat1, lon1, lat2, lon2). on_progress(done, total) wywoływane
+    w wątku wywołującym, w kolejności ukończenia zapytań.
+    Zwraca listę wyników get_osrm_route w kolejności wejściowej."""
+    results = [None] * len(pairs)
+    if not pairs:
+        return results
+    total = len(pairs)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_in_flight, total))) as pool:
+        futures = {
+            pool.submit(get_osrm_route, lat1, lon1, lat2, lon2,
+                        use_fallback=use_fallback, deadline_s=deadline_s, deadline=deadline): i
+            for i, (lat1, lon1, lat2, lon2) in enumerate(pairs)
+        }
+        for done, fut in enumerate(as_completed(futures), start=1):
+            i = futures[fut]
+            try:
+                results[i] = fut.result()
+            except Exception:
+                lat1, lon1, lat2, lon2 = pairs[i]
+                dist, dur = estimate_route_fallback(lat1, lon1, lat2, lon2)
+                results[i] = (dist, dur, [[lat1, lon1], [lat2, lon2]])
+            if on_progress is not None:
+                on_progress(done, total)
+    return results
+
+
+# ── OSRM Table (macierz: wiele startów → jeden cel) ─────────────────────────
+def _osrm_table_block(sources, destinations, deadline=None, backend=None):
+    """Jedno zapytanie /table backendu routingu: sources × destinations (listy (lat, lon)).
+    Zwraca (dist_km, dur_min) jako tablice (len(sources), len(destinations)),
+    NaN tam, gdzie backend nie zwrócił wyniku; None przy błędzie zapytania,
+    otwartym bezpieczniku lub wyczerpanym budżecie (deadline)."""
+    backend = backend or get_routing_backend()
+    health = get_routing_health(backend)
+    size = len(sources) + len(destinations)  # timeout rośnie z rozmiarem bloku
+    max_retries = 2
+    for attempt in range(max_retries):
+        remaining = budget_left(deadline)
+        ticket = health.allow() if remaining > 0 else None
+        if ticket is None:
+            break
+        started = time.monotonic()
+        timeout = min(remaining, health.timeout("table", OSRM_TIMEOUT, size, ticket=ticket))
+        try:
+            result = backend.table(sources, destinations, timeout=timeout)
+        except requests.exceptions.Timeout:
+            health.record("table", time.monotonic() - started, ok=False, size=size, timeout_s=timeout, ticket=ticket)
+            if attempt < max_retries - 1:
+                time.sleep(0.5)
+            continue
+        except Exception:
+            health.record("table", time.monotonic() - started, ok=False, size=size, ticket=ticket)
+            break
+        health.record("table", time.monotonic() - started, ok=True, size=size, ticket=ticket)
+        return result
+    return None
+
+
+def get_osrm_matrix(origins, destinations, use_fallback: bool = False,
+                    max_in_flight: int = OSRM_MAX_IN_FLIGHT, on_progress=None, deadline=None):
+    """Macierz dystansów (km) i czasów (min): origins × destinations (listy (lat, lon)).
+    Pary z cache tras nie idą do OSRM; reszta — bloki /table (≤ OSRM_TABLE_MAX_COORDS
+    współrzędnych) wysyłane równolegle (graf offline — bez cache tras). Brak wyniku (także po budżecie deadline)
+    → fallback Haversine.
+    Zwraca (dist, dur, estimated) — tablice (len(origins), len(destinations))."""
+    n_o, n_d = len(origins), len(destinations)
+    dist = np.full((n_o, n_d), np.nan)
+    dur = np.full((n_o, n_d), np.nan)
+    if n_o == 0 or n_d == 0:
+        return dist, dur, np.zeros((n_o, n_d), dtype=bool)
+
+    backend = get_routing_backend()
+    if not use_fallback and not backend.offline:
+        if backend.cache_routes:
+            keys = [[route_cache_key(o_lat, o_lon, d_lat, d_lon) for d_lat, d_lon in destinations]
+                    for o_lat, o_lon in origins]
+            cached = route_cache_get_many([k for row in keys for k in row])
+            for i, row in enumerate(keys):
+                for j, key in enumerate(row):
+                    if key in cached:
+                        dist[i, j], dur[i, j] = cached[key][:2]
+
+        # Bloki: tylko wiersze/kolumny z brakami, po połowie limitu współrzędnych
+        half = OSRM_TABLE_MAX_COORDS // 2
+        missing = np.isnan(dist)
+        rows = np.flatnonzero(missing.any(axis=1))
+        cols = np.flatnonzero(missing.any(axis=0))
+        blocks = [(rows[r:r + half], cols[c:c + half])
+                  for r in range(0, len(rows), half)
+                  for c in range(0, len(cols), half)]
+        blocks = [(r, c) for r, c in blocks if missing[np.ix_(r, c)].any()]
+        fresh = []
+        if blocks:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_in_flight, len(blocks)))) as pool:
+                futures = {
+                    pool.submit(_osrm_table_block, [origins[i] for i in r],
+                                [destinations[j] for j in c], deadline, backend): (r, c)
+                    for r, c in blocks
+                }
+                for done, fut in enumerate(as_completed(futures), start=1):
+                    r, c = futures[fut]
+                    res = fut.result()
+                    if res is not None:
+                        b_dist, b_dur = res
+                        ok = ~np.isnan(b_dist) & ~np.isnan(b_dur) & missing[np.ix_(r, c)]
+                        for bi, bj in zip(*np.nonzero(ok)):
+                            i, j = r[bi], c[bj]
+                            dist[i, j], dur[i, j] = b_dist[bi, bj], b_dur[bi, bj]
+                            if backend.cache_routes:
+                                fresh.append((keys[i][j], float(dist[i, j]), float(dur[i, j]), None))
+                    if on_progress:
+                        on_progress(done, len(blocks))
+        route_cache_put_many(fresh)
+
+    estimated = np.isnan(dist) | np.isnan(dur)
+    if estimated.any():
+        o = np.asarray(origins, dtype="float64").reshape(-1, 2)
+        for j in np.flatnonzero(estimated.any(axis=0)):
+            i = np.flatnonzero(estimated[:, j])
+            d_lat, d_lon = destinations[j]
+            e_dist, e_dur = estimate_routes_fallback(o[i, 0], o[i, 1], d_lat, d_lon)
+            dist[i, j], dur[i, j] = e_dist, e_dur
+    return dist, dur, estimated
+
+
+def get_osrm_table(origins, dest_lat: float, dest_lon: float,
+                   use_fallback: bool = False, deadline=None):
+    """Dystanse (km) i czasy (min) z wielu punktów startowych do jednego celu.
+    Jedno zapytanie OSRM /table na paczkę (≤ OSRM_TABLE_MAX_COORDS współrzędnych),
+    zamiast osobnego /route dla każdej pary. Bez geometrii.
+    origins: lista (lat, lon). Zwraca listę (distance_km, duration_min, estimated)
+    w tej samej kolejności; pozycje bez wyniku OSRM → fallback Haversine
+    (estimated=True)."""
+    dist, dur, estimated = get_osrm_matrix(origins, [(dest_lat, dest_lon)], use_fallback,
+                                           deadline=deadline)
+    return [(float(d), float(t), bool(e))
+            for d, t, e in zip(dist[:, 0], dur[:, 0], estimated[:, 0])]
+
+
+def get_many_to_one(origins, dest_lat: float, dest_lon: float, use_fallback: bool = False,
+                    deadline=None):
+    """Analiza jednego celu: wszystkie starty → cel.
+    Backend z natywnym many_to_one (graf offline) — jedno przeszukanie odwrotne
+    od celu, geometria odtwarzana na żądanie z tablicy poprzedników.
+    Pozostałe — get_osrm_table (cache tras + /table paczkami, w budżecie deadline),
+    bez geometrii. Zwraca (lista (distance_km, duration_min, estimated), geometry(i) lub None)."""
+    backend = get_routing_backend()
+    if not use_fallback and origins:
+        try:
+            native = backend.many_to_one(origins, dest_lat, dest_lon)
+        except Exception:
+            native = None
+        if native is not None:
+            dist, dur, geometry = native
+            results = [(float(d), float(t), False) for d, t in zip(dist, dur)]
+            missing = [i for i, (d, t, _) in enumerate(results) if not (np.isfinite(d) and np.isfinite(t))]
+            if missing:
+                pts = np.asarray([origins[i] for i in missing], dtype="float64")
+                e_dist, e_dur = estimate_routes_fallback(pts[:, 0], pts[:, 1], dest_lat, dest_lon)
+                for i, d, t in zip(missing, e_dist.tolist(), e_dur.tolist()):
+                    results[i] = (d, t, True)
+            return results, geometry
+    return get_osrm_table(origins, dest_lat, dest_lon, use_fallback=use_fallback, deadline=deadline), None
+
+
+# ── Koszty dojazdu i macierz kosztów (tryb wsadowy) ─────────────────────────
+def travel_costs(dist_km, dur_min, koszt_za_km: float) -> dict:
+    """Koszty dojazdu (skalary lub tablice): paliwo, Rbh mechanika i samochód
+    (czas zaokrąglony w górę do 0.25 h) oraz suma."""
+    dist_km = np.asarray(dist_km, dtype="float64")
+    h_ceil = np.ceil(np.asarray(dur_min, dtype="float64") / 15) * 0.25  # zaokr. w górę do 0.25h (15 min)
+    paliwo = np.round(dist_km * koszt_za_km, 2)
+    rbh = np.round(h_ceil * STAWKA_RBH_MECHANIKA, 2)
+    samochod = np.round(h_ceil * STAWKA_SAMOCHODU, 2)
+    return {
+        "paliwo": paliwo,
+        "rbh": rbh,
+        "samochod": samochod,
+        "suma": np.round(paliwo + rbh + samochod, 2),
+    }
+
+
+def cost_matrix_key(mechanicy_df: pd.DataFrame, budowy_df: pd.DataFrame, koszt_za_km: float) -> str:
+    """Odcisk danych wejściowych macierzy — czy zapisana macierz jest aktualna."""
+    h = hashlib.sha1()
+    h.update(pd.util.hash_pandas_object(
+        mechanicy_df[["mechanik", "warsztat", "lat", "lon"]], index=False).to_numpy().tobytes())
+    h.update(pd.util.hash_pandas_object(
+        budowy_df[["nazwa", "lat", "lon"]], index=False).to_numpy().tobytes())
+    h.update(f"{koszt_za_km:.4f}|{STAWKA_RBH_MECHANIKA}|{STAWKA_SAMOCHODU}".encode())
+    return h.hexdigest()
+
+
+def compute_cost_matrix(mechanicy_df: pd.DataFrame, budowy_df: pd.DataFrame,
+                        koszt_za_km: float, use_fallback: bool = False,
+                        on_progress=None) -> pd.DataFrame:
+    """Pełna macierz: każdy mechanik × każda budowa — dystans/czas po drogach
+    (cache tras + równoległe /table) i pełny rozkład kosztów. Format długi,
+    jeden wiersz na parę; attrs["klucz"] = cost_matrix_key(...)."""
+    origins = list(zip(mechanicy_df["lat"].astype(float), mechanicy_df["lon"].astype(float)))
+    destinations = list(zip(budowy_df["lat"].astype(float), budowy_df["lon"].astype(float)))
+    source = get_routing_backend().source
+    dist, dur, estimated = get_osrm_matrix(origins, destinations, use_fallback,
+                                           on_progress=on_progress)
+    n_o, n_d = dist.shape
+    costs = travel_costs(dist.ravel(), dur.ravel(), koszt_za_km)
+    df = pd.DataFrame({
+        "budowa": np.tile(budowy_df["nazwa"].astype(str).to_numpy(), n_o),
+        "mechanik": np.repeat(mechanicy_df["mechanik"].astype(str).to_numpy(), n_d),
+        "warsztat": np.repeat(mechanicy_df["warsztat"].astype(str).to_numpy(), n_d),
+        "dystans_km": dist.ravel(),
+        "czas_min": dur.ravel(),
+        "koszt_paliwa": costs["paliwo"],
+        "koszt_rbh": costs["rbh"],
+        "koszt_samochodu": costs["samochod"],
+        "suma": costs["suma"],
+        "szacunek": estimated.ravel(),
+        "zrodlo": np.where(estimated.ravel(), "szacunek", source),
+    })
+    df["budowa"] = df["budowa"].astype("category")
+    df.attrs["klucz"] = cost_matrix_key(mechanicy_df, budowy_df, koszt_za_km)
+    df.attrs["ksztalt"] = [n_o, n_d]  # wiersz = i_mechanika * n_d + j_budowy
+    df.attrs["utworzono"] = time.strftime("%Y-%m-%d %H:%M")
+    return df
+
+
+def save_cost_matrix(df: pd.DataFrame, path: str = COST_MATRIX_PATH) -> None:
+    """Zapisz macierz do Parquet (attrs trafiają do metadanych pliku)."""
+    tmp = path + ".tmp"
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def read_cost_matrix(path: str, mtime: float) -> pd.DataFrame:
+    """Odczyt Parquet; mtime — klucz cache w UI (zmiana pliku = nowy odczyt)."""
+    return pd.read_parquet(path)
+
+
+def load_cost_matrix(path: str = COST_MATRIX_PATH, read=read_cost_matrix):
+    """Wczytaj zapisaną macierz lub None (read — jak parse w load_budowy)."""
+    try:
+        return read(path, os.path.getmtime(path))
+    except (OSError, ValueError, ImportError):
+        return None
+
+
+COST_MATRIX_LABELS = {
+    "mechanik": "Mechanik",
+    "warsztat": "Warsztat",
+    "dystans_km": "Dystans (km)",
+    "czas_min": "Czas (min)",
+    "koszt_paliwa": "Koszt paliwa (PLN)",
+    "koszt_rbh": f"Rbh mechanika [{STAWKA_RBH_MECHANIKA:.0f} PLN/h]",
+    "koszt_samochodu": f"Koszt samochodu [{STAWKA_SAMOCHODU:.0f} PLN/h]",
+    "suma": "SUMA kosztów (PLN)",
+    "szacunek": "Szacunek",
+    "zrodlo": "Źródło",
+}
+
+
+def matrix_sources(rows: pd.DataFrame) -> np.ndarray:
+    """Kolumna „Źródło” dla wierszy macierzy kosztów (pliki sprzed kolumny zrodlo — OSRM)."""
+    if "zrodlo" in rows.columns:
+        return rows["zrodlo"].astype(str).to_numpy()
+    return np.where(rows["szacunek"].to_numpy(), "szacunek", "OSRM")
+
+
+def best_per_site(matrix_df: pd.DataFrame, by: str = "suma") -> pd.DataFrame:
+    """Najtańszy (wg kolumny by) mechanik dla każdej budowy z macierzy kosztów."""
+    best = matrix_df.loc[matrix_df.groupby("budowa", observed=True)[by].idxmin()]
+    return pd.DataFrame({
+        "Budowa": best["budowa"].astype(str).to_numpy(),
+        "Najlepszy mechanik": best["mechanik"].to_numpy(),
+        "Warsztat": best["warsztat"].to_numpy(),
+        "Dystans (km)": best["dystans_km"].to_numpy(),
+        "Czas (min)": best["czas_min"].to_numpy(),
+        "SUMA kosztów (PLN)": best["suma"].to_numpy(),
+        "Źródło": matrix_sources(best),
+    })
+
+
+# ── Optymalny przydział mechaników do budów ─────────────────────────────────
+def solve_assignment(cost, capacity=1, groups=None, group_quota=None) -> np.ndarray:
+    """Przydział minimalizujący łączny koszt: każda budowa (kolumna) dostaje
+    co najwyżej jednego mechanika (wiersz), mechanik — maks. `capacity` budów.
+    Obsadzanych jest tyle budów, ile pozwalają limity.
+    groups (etykieta warsztatu dla każdego wiersza) + group_quota {warsztat: limit}
+    — maks. liczba przydziałów z danego warsztatu.
+    Bez limitów warsztatów: algorytm węgierski (linear_sum_assignment na wierszach
+    powielonych `capacity` razy). Z limitami: przepływ o min. koszcie jako
+    program liniowy (HiGHS, simpleks dualny).
+    Zwraca tablicę par (wiersz, kolumna)."""
+    cost = np.asarray(cost, dtype="float64")
+    n_m, n_s = cost.shape
+    if n_m == 0 or n_s == 0:
+        return np.empty((0, 2), dtype=int)
+    capacity = np.broadcast_to(np.asarray(capacity, dtype=int), (n_m,))
+    quota = {g: int(q) for g, q in (group_quota or {}).items() if q is not None and q > 0}
+
+    if groups is None or not quota:
+        rows = np.repeat(np.arange(n_m), capacity)
+        r, c = linear_sum_assignment(cost[rows])
+        return np.column_stack([rows[r], c])
+
+    # Krawędzie kandydujące: K najtańszych mechaników dla każdej budowy
+    # i K najtańszych budów dla każdego mechanika (reszta rzadko wchodzi do
+    # optimum, a zmniejsza LP o rząd wielkości). Ponownie na wszystkich
+    # krawędziach tylko wtedy, gdy obsadzono mniej budów, niż pozwalają limity
+    # (przycięty graf odciął mechaników z wolnym limitem).
+    groups = np.asarray(groups)
+    k_s, k_m = min(ASSIGN_CANDIDATES_K, n_m), min(ASSIGN_CANDIDATES_K, n_s)
+    cand = np.zeros((n_m, n_s), dtype=bool)
+    np.put_along_axis(cand, np.argpartition(cost, k_s - 1, axis=0)[:k_s], True, axis=0)
+    np.put_along_axis(cand, np.argpartition(cost, k_m - 1, axis=1)[:, :k_m], True, axis=1)
+    pairs, unstaffed = _solve_assignment_lp(cost, cand, capacity, groups, quota)
+    limited = np.isin(groups, list(quota))
+    max_staffed = min(n_s, int(capacity[~limited].sum()) + sum(
+        min(q, int(capacity[groups == g].sum())) for g, q in quota.items()))
+    if n_s - unstaffed < max_staffed and not cand.all():
+        pairs, _ = _solve_assignment_lp(cost, np.ones_like(cand), capacity, groups, quota)
+    return pairs
+
+
+def _solve_assignment_lp(cost, cand, capacity, groups, quota) -> tuple:
+    """Przepływ o min. koszcie jako LP na krawędziach `cand` (maska mechanik × budowa).
+    Zwraca (pary (wiersz, kolumna), liczba nieobsadzonych budów)."""
+    n_m, n_s = cost.shape
+    # Zmienne: x[m, s] (spłaszczone wierszami) + u[s] = „budowa nieobsadzona”.
+    # Kara za u większa niż koszt dowolnego przetasowania przydziałów →
+    # najpierw maksymalna liczba obsadzonych budów, potem minimalny koszt.
+    e_m, e_s = np.nonzero(cand)
+    n = len(e_m)
+    var = np.arange(n)
+    penalty = float(np.nanmax(cost)) * (n_s + 1) + 1.0
+    c = np.concatenate([cost[e_m, e_s], np.full(n_s, penalty)])
+    a_mech = sparse.csr_matrix((np.ones(n), (e_m, var)), shape=(n_m, n + n_s))
+    a_site = sparse.hstack([
+        sparse.csr_matrix((np.ones(n), (e_s, var)), shape=(n_s, n)),
+        sparse.identity(n_s, format="csr"),
+    ]).tocsr()
+    a_ub, b_ub = [a_mech], [capacity]
+    limited = [g for g in quota if (groups == g).any()]
+    if limited:
+        g_idx = {g: k for k, g in enumerate(limited)}
+        sel = np.array([g_idx.get(g, -1) for g in groups])[e_m]
+        keep = sel >= 0
+        a_ub.append(sparse.csr_matrix((np.ones(keep.sum()), (sel[keep], var[keep])),
+                                      shape=(len(limited), n + n_s)))
+        b_ub.append([quota[g] for g in limited])
+    # Macierz ograniczeń przepływu jest całkowicie unimodularna — wierzchołek
+    # z simpleksu (HiGHS) jest od razu rozwiązaniem całkowitym.
+    res = linprog(c, A_ub=sparse.vstack(a_ub).tocsr(), b_ub=np.concatenate(b_ub),
+                  A_eq=a_site, b_eq=np.ones(n_s), bounds=(0, 1), method="highs-ds")
+    if res.x is None:
+        return np.empty((0, 2), dtype=int), n_s
+    chosen = np.flatnonzero(res.x[:n] > 0.5)
+    return np.column_stack([e_m[chosen], e_s[chosen]]), int((res.x[n:] > 0.5).sum())
+
+
+def assignment_from_matrix(matrix_df: pd.DataFrame, mechanicy_df: pd.DataFrame,
+                           budowy_df: pd.DataFrame, max_sites_per_mech: int = 1,
+                           workshop_quota: int = 0) -> pd.DataFrame:
+    """Optymalny przydział (min. łączna SUMA kosztów) na macierzy kosztów.
+    mechanicy_df / budowy_df — te same dane (i kolejność), z których policzono
+    macierz. workshop_quota > 0 — ten sam limit przydziałów dla każdego warsztatu."""
+    n_o, n_d = matrix_df.attrs.get("ksztalt", (len(mechanicy_df), len(budowy_df)))
+    cost = matrix_df["suma"].to_numpy(dtype="float64").reshape(n_o, n_d)
+    groups = mechanicy_df["warsztat"].astype(str).to_numpy()
+    quota = {g: workshop_quota for g in np.unique(groups)} if workshop_quota > 0 else None
+    pairs = solve_assignment(cost, capacity=max_sites_per_mech, groups=groups, group_quota=quota)
+    rows = matrix_df.iloc[pairs[:, 0] * n_d + pairs[:, 1]]
+    out = pd.DataFrame({
+        "Budowa": rows["budowa"].astype(str).to_numpy(),
+        "Mechanik": rows["mechanik"].to_numpy(),
+        "Warsztat": rows["warsztat"].to_numpy(),
+        "Dystans (km)": rows["dystans_km"].to_numpy(),
+        "Czas (min)": rows["czas_min"].to_numpy(),
+        "SUMA kosztów (PLN)": rows["suma"].to_numpy(),
+        "Źródło": matrix_sources(rows),
+        "_mech_lat": mechanicy_df["lat"].to_numpy(dtype="float64")[pairs[:, 0]],
+        "_mech_lon": mechanicy_df["lon"].to_numpy(dtype="float64")[pairs[:, 0]],
+        "_bud_lat": budowy_df["lat"].to_numpy(dtype="float64")[pairs[:, 1]],
+        "_bud_lon": budowy_df["lon"].to_numpy(dtype="float64")[pairs[:, 1]],
+    })
+    return out.sort_values("Budowa").reset_index(drop=True)
+
+
+# ── Trasy dzienne (wiele budów na mechanika) ────────────────────────────────
+def service_minutes(maszyny_male, maszyny_duze) -> np.ndarray:
+    """Czas pracy na budowie (min) z liczby maszyn małych i dużych."""
+    male = pd.to_numeric(pd.Series(maszyny_male, dtype="object"), errors="coerce").fillna(0).to_numpy()
+    duze = pd.to_numeric(pd.Series(maszyny_duze, dtype="object"), errors="coerce").fillna(0).to_numpy()
+    return male * MINUTY_MASZYNA_MALA + duze * MINUTY_MASZYNA_DUZA
+
+
+class TourPlanner:
+    """Trasy dzienne: mechanicy (węzły 0..H-1 — dom) obsługują budowy
+    (węzły H..H+S-1) w oknie czasowym budów i limicie zmiany.
+    Budowa: nearest neighbour równolegle dla wszystkich mechaników, potem
+    2-opt i Or-opt w trasach, relokacja budów między trasami i dołożenie
+    nieobsadzonych budów. Cel: łączny czas jazdy. Czasy w minutach od północy."""
+
+    def __init__(self, dur, n_homes: int, service, day_start: float,
+                 window_start: float, window_end: float, shift_max: float):
+        self.dur = np.asarray(dur, dtype="float64")
+        self.h = n_homes
+        self.service = np.concatenate([np.zeros(n_homes), np.asarray(service, dtype="float64")])
+        self.day_start = day_start
+        self.window_start = window_start
+        self.window_end = window_end
+        self.shift_max = shift_max
+
+    def finish_time(self, home: int, seq) -> float:
+        """Powrót do domu po obsłużeniu seq (np.inf — trasa niewykonalna)."""
+        t, prev = self.day_start, home
+        for node in seq:
+            t = max(t + self.dur[prev, node], self.window_start) + self.service[node]
+            if t > self.window_end:
+                return np.inf
+            prev = node
+        t += self.dur[prev, home]
+        return t if t - self.day_start <= self.shift_max else np.inf
+
+    def travel(self, home: int, seq) -> float:
+        if not seq:
+            return 0.0
+        path = [home, *seq, home]
+        return float(self.dur[path[:-1], path[1:]].sum())
+
+    def construct(self) -> tuple:
+        """Równoległy nearest neighbour: w każdym kroku najkrótszy wykonalny
+        dojazd z końca dowolnej trasy do nieodwiedzonej budowy."""
+        tours = [[] for _ in range(self.h)]
+        todo = set(range(self.h, len(self.dur)))
+        while todo:
+            best = None
+            for m, tour in enumerate(tours):
+                last = tour[-1] if tour else m
+                for node in sorted(todo, key=lambda n: self.dur[last, n]):
+                    if np.isfinite(self.finish_time(m, tour + [node])):
+                        if best is None or self.dur[last, node] < best[0]:
+                            best = (self.dur[last, node], m, node)
+                        break
+            if best is None:
+                break
+            _, m, node = best
+            tours[m].append(node)
+            todo.discard(node)
+        return tours, todo
+
+    def _improve_tour(self, home: int, seq: list) -> list:
+        """2-opt (odwrócenie fragmentu) + Or-opt (przeniesienie 1–3 budów)."""
+        best, best_cost = seq, self.travel(home, seq)
+        improved = True
+        while improved:
+            improved = False
+            n = len(best)
+            candidates = (
+                [best[:i] + best[i:j + 1][::-1] + best[j + 1:]
+                 for i in range(n - 1) for j in range(i + 1, n)]
+                + [(lambda rest, seg, k: rest[:k] + seg + rest[k:])(
+                    best[:i] + best[i + L:], best[i:i + L], k)
+                   for L in (1, 2, 3) for i in range(n - L + 1)
+                   for k in range(n - L + 1) if k != i]
+            )
+            for cand in candidates:
+                cost = self.travel(home, cand)
+                if cost < best_cost - 1e-9 and np.isfinite(self.finish_time(home, cand)):
+                    best, best_cost, improved = cand, cost, True
+                    break
+        return best
+
+    def _best_insertion(self, tours, node, skip=None):
+        """Najtańsze wykonalne wstawienie budowy: (przyrost, mechanik, pozycja)."""
+        best = None
+        for m, tour in enumerate(tours):
+            if m == skip:
+                continue
+            base = self.travel(m, tour)
+            for k in range(len(tour) + 1):
+                cand = tour[:k] + [node] + tour[k:]
+                delta = self.travel(m, cand) - base
+                if (best is None or delta < best[0]) and np.isfinite(self.finish_time(m, cand)):
+                    best = (delta, m, k)
+        return best
+
+    def solve(self, max_rounds: int = 5) -> tuple:
+        """Zwraca (trasy — lista sekwencji węzłów dla każdego mechanika, nieobsadzone budowy)."""
+        tours, todo = self.construct()
+        for _ in range(max_rounds):
+            changed = False
+            tours = [self._improve_tour(m, t) for m, t in enumerate(tours)]
+            # Relokacja budowy do innej trasy, jeśli skraca łączną jazdę
+            for m in range(self.h):
+                for node in list(tours[m]):
+                    rest = [x for x in tours[m] if x != node]
+                    gain = self.travel(m, tours[m]) - self.travel(m, rest)
+                    ins = self._best_insertion(tours, node, skip=m)
+                    if ins is not None and ins[0] < gain - 1e-9:
+                        _, m2, k = ins
+                        tours[m] = rest
+                        tours[m2].insert(k, node)
+                        changed = True
+            # Nieobsadzone budowy — wstaw, jeśli po poprawkach jest miejsce
+            for node in sorted(todo):
+                ins = self._best_insertion(tours, node)
+                if ins is not None:
+                    _, m2, k = ins
+                    tours[m2].insert(k, node)
+                    todo.discard(node)
+                    changed = True
+            if not changed:
+                break
+        tours = [self._improve_tour(m, t) for m, t in enumerate(tours)]
+        return tours, sorted(todo)
+
+
+def plan_daily_tours(mechanicy_df: pd.DataFrame, budowy_df: pd.DataFrame,
+                     koszt_za_km: float, day_start: float = 7 * 60,
+                     window_start: float = 7 * 60, window_end: float = 15 * 60,
+                     shift_max: float = 10 * 60, use_fallback: bool = False) -> tuple:
+    """Trasy dzienne dla mechaników przez wybrane budowy.
+    Macierz czasów/dystansów z get_osrm_matrix (cache tras), czas obsługi z liczby
+    maszyn, koszt trasy — istniejąca formuła travel_costs na sumie jazdy.
+    Zwraca (tabela tras, lista tras do mapy, nieobsadzone budowy)."""
+    homes = list(zip(mechanicy_df["lat"].astype(float), mechanicy_df["lon"].astype(float)))
+    sites = list(zip(budowy_df["lat"].astype(float), budowy_df["lon"].astype(float)))
+    points = homes + sites
+    h = len(homes)
+    # Tylko bloki używane przez planer: domy → budowy, budowy → budowy, budowy → domy
+    # (dom → inny dom nigdy nie wchodzi do trasy — bez zapytań o H×H)
+    dist = np.full((len(points), len(points)), np.inf)
+    dur = np.full((len(points), len(points)), np.inf)
+    home, site = slice(None, h), slice(h, None)
+    for rows, cols, origins, destinations in ((home, site, homes, sites),
+                                              (site, site, sites, sites),
+                                              (site, home, sites, homes)):
+        dist[rows, cols], dur[rows, cols], _ = get_osrm_matrix(origins, destinations, use_fallback)
+    np.fill_diagonal(dist, 0)
+    np.fill_diagonal(dur, 0)
+    service = service_minutes(budowy_df.get("maszyny_male", pd.Series(0, index=budowy_df.index)),
+                              budowy_df.get("maszyny_duze", pd.Series(0, index=budowy_df.index)))
+    planner = TourPlanner(dur, h, service, day_start, window_start, window_end, shift_max)
+    tours, todo = planner.solve()
+
+    names = budowy_df["nazwa"].astype(str).to_numpy()
+    rows, tour_routes = [], []
+    for m, seq in enumerate(tours):
+        if not seq:
+            continue
+        path = [m, *seq, m]
+        km = float(dist[path[:-1], path[1:]].sum())
+        drive = float(dur[path[:-1], path[1:]].sum())
+        costs = travel_costs(km, drive, koszt_za_km)
+        end = planner.finish_time(m, seq)
+        rows.append({
+            "Mechanik": mechanicy_df["mechanik"].iloc[m],
+            "Warsztat": mechanicy_df["warsztat"].iloc[m],
+            "Kolejność": " → ".join(names[n - h] for n in seq),
+            "Budowy": len(seq),
+            "Dystans (km)": round(km, 1),
+            "Jazda (min)": round(drive, 1),
+            "Praca (min)": round(float(planner.service[seq].sum()), 0),
+            "Powrót": f"{int(end // 60):02d}:{int(end % 60):02d}",
+            "Koszt paliwa (PLN)": float(costs["paliwo"]),
+            f"Rbh mechanika [{STAWKA_RBH_MECHANIKA:.0f} PLN/h]": float(costs["rbh"]),
+            f"Koszt samochodu [{STAWKA_SAMOCHODU:.0f} PLN/h]": float(costs["samochod"]),
+            "SUMA kosztów (PLN)": float(costs["suma"]),
+        })
+        tour_routes.append({
+            "label": mechanicy_df["mechanik"].iloc[m],
+            "stops": [points[n] for n in path],
+            "names": ["🏠"] + [names[n - h] for n in seq] + ["🏠"],
+        })
+
+    # Geometria odcinków (cache tras, równolegle) → jedna uproszczona polilinia na trasę
+    legs = [(a_lat, a_lon, b_lat, b_lon)
+            for tr in tour_routes
+            for (a_lat, a_lon), (b_lat, b_lon) in zip(tr["stops"][:-1], tr["stops"][1:])]
+    geometries = fetch_routes_concurrent(legs, use_fallback=use_fallback)
+    k = 0
+    for tr in tour_routes:
+        coords = []
+        for _ in range(len(tr["stops"]) - 1):
+            coords.extend(geometries[k][2] or [])
+            k += 1
+        tr["polyline"] = compact_polyline(coords)
+    return pd.DataFrame(rows), tour_routes, [names[n - h] for n in todo]
+
+
+# ── Pre-filtr kandydatów (linia prosta) ─────────────────────────────────────
+def select_route_candidates(lats, lons, dest_lat: float, dest_lon: float,
+                            top_k: int = PREFILTER_TOP_K,
+                            radius_km: float = PREFILTER_RADIUS_KM) -> np.ndarray:
+    """Maska kandydatów do liczenia po drogach: top_k najbliższych w linii prostej
+    oraz wszyscy w promieniu radius_km od celu (PointIndex)."""
+    index = PointIndex(lats, lons)
+    mask = np.zeros(len(index), dtype=bool)
+    knn_idx, _ = index.knn(dest_lat, dest_lon, k=top_k)
+    rad_idx, _ = index.radius(dest_lat, dest_lon, radius_km)
+    mask[knn_idx] = True
+    mask[rad_idx] = True
+    return mask
+
+
+# ── Porównanie budów (najbliższy mechanik w linii prostej) ─────────────────
+def compare_sites_nearest(budowy_df: pd.DataFrame, mechanicy_df: pd.DataFrame) -> pd.DataFrame:
+    """Dla każdej budowy najbliższy mechanik (Haversine) — przez PointIndex,
+    bez pętli po parach (budowa, mechanik)."""
+    index = PointIndex(mechanicy_df["lat"].to_numpy(), mechanicy_df["lon"].to_numpy())
+    idx, dist = index.knn_many(budowy_df["lat"].to_numpy(), budowy_df["lon"].to_numpy(), k=1)
+    best = idx[:, 0]
+    return pd.DataFrame({
+        "Budowa": budowy_df["nazwa"].to_numpy(),
+        "Najlepszy mechanik": mechanicy_df["mechanik"].to_numpy()[best],
+        "Warsztat": mechanicy_df["warsztat"].to_numpy()[best],
+        "Dystans (km, linia prosta)": np.round(dist[:, 0], 1),
+    })
+
+
+
+
+# ── Upraszczanie geometrii tras ──────────────────────────────────────────────
+def simplify_tolerance_m(zoom: int = ROUTE_SIMPLIFY_ZOOM, lat: float = 52.0) -> float:
+    """Tolerancja uproszczenia [m] = rozmiar jednego piksela mapy na danym zoomie."""
+    return 156543.03 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+
+def simplify_polyline(coords, tolerance_m: float) -> np.ndarray:
+    """Douglas-Peucker na [lat, lon] (rzut równoodległościowy wokół trasy).
+    Zwraca tablicę (n, 2) z zachowanymi wierzchołkami (zawsze początek i koniec)."""
+    pts = np.asarray(coords, dtype=float).reshape(-1, 2)
+    n = len(pts)
+    if n < 3 or tolerance_m <= 0:
+        return pts
+    kx = 111320.0 * math.cos(math.radians(float(pts[:, 0].mean())))
+    xy = np.column_stack([pts[:, 1] * kx, pts[:, 0] * 110540.0])
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        a, b = xy[i], xy[j]
+        seg = b - a
+        seg_len = math.hypot(seg[0], seg[1])
+        rel = xy[i + 1:j] - a
+        if seg_len < 1e-9:
+            d = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            d = np.abs(rel[:, 0] * seg[1] - rel[:, 1] * seg[0]) / seg_len
+        k = int(np.argmax(d))
+        if d[k] > tolerance_m:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return pts[keep]
+
+
+def compact_polyline(coords, zoom: int = ROUTE_SIMPLIFY_ZOOM):
+    """Uprość geometrię pod zoom mapy i zakoduj do stringa (session_state / HTML)."""
+    if not coords or len(coords) < 2:
+        return None
+    pts = simplify_polyline(coords, simplify_tolerance_m(zoom, float(coords[0][0])))
+    return encode_polyline(pts.tolist())
+
+
+# ── Analiza dojazdów do jednego celu ─────────────────────────────────────────
+def analyze_destination(mechanicy_df: pd.DataFrame, warsztaty_df, dest_lat: float, dest_lon: float,
+                        koszt_za_km: float, use_fallback: bool = False, fast_mode: bool = False,
+                        top_k: int = PREFILTER_TOP_K, radius_km: float = PREFILTER_RADIUS_KM,
+                        geometry_top_n: int = MAP_ROUTES_TOP_N, on_progress=None,
+                        budget_s: float = ANALYSIS_BUDGET_S) -> tuple:
+    """Mechanicy + warsztaty → cel: dystans, czas i koszty, posortowane wg dystansu.
+    Zwraca (result_df, routes_for_map) — pełna geometria tylko dla geometry_top_n
+    najlepszych (0 = bez geometrii, np. raporty wsadowe); result_df pusty, gdy brak startów.
+    on_progress(done, total) — postęp pobierania geometrii. Routing w budżecie
+    budget_s — po nim reszta szacunkowo (result_df.attrs["budzet_wyczerpany"])."""
+    deadline = time.monotonic() + budget_s
+    source = get_routing_backend().source  # etykieta wyników spoza szacunku
+    # Punkty startowe: mechanicy + warsztaty → (etykieta, warsztat, lat, lon, is_workshop)
+    origins = list(zip(mechanicy_df["mechanik"], mechanicy_df["warsztat"],
+                       mechanicy_df["lat"], mechanicy_df["lon"], [False] * len(mechanicy_df)))
+    if warsztaty_df is not None and not warsztaty_df.empty:
+        origins += [(f"🔧 {nazwa}", nazwa, lat, lon, True) for nazwa, lat, lon
+                    in zip(warsztaty_df["nazwa"], warsztaty_df["lat"], warsztaty_df["lon"])]
+    if not origins:
+        return pd.DataFrame(), []
+
+    # Tryb szybki: po drogach tylko top K + promień, reszta szacunkowo
+    o_lats = np.array([o[2] for o in origins], dtype="float64")
+    o_lons = np.array([o[3] for o in origins], dtype="float64")
+    if fast_mode:
+        routed = select_route_candidates(o_lats, o_lons, dest_lat, dest_lon,
+                                         top_k=int(top_k), radius_km=float(radius_km))
+    else:
+        routed = np.ones(len(origins), dtype=bool)
+
+    # Dystanse i czasy — wszystkie starty → cel: jedno przeszukanie odwrotne
+    # (graf offline) albo /table paczkami zamiast N× /route
+    routed_idx = np.flatnonzero(routed)
+    routed_matrix, route_geometry = get_many_to_one(
+        list(zip(o_lats[routed_idx], o_lons[routed_idx])), dest_lat, dest_lon,
+        use_fallback=use_fallback, deadline=deadline,
+    )
+    matrix = [None] * len(origins)
+    for i, res in zip(routed_idx, routed_matrix):
+        matrix[i] = res
+    est_idx = np.flatnonzero(~routed)
+    if len(est_idx):
+        est_dist, est_dur = estimate_routes_fallback(o_lats[est_idx], o_lons[est_idx], dest_lat, dest_lon)
+        for i, d, t in zip(est_idx, est_dist.tolist(), est_dur.tolist()):
+            matrix[i] = (d, t, True)
+
+    # Pewność szacunku (p80 błędu modelu na odłożonych trasach) — dla pozycji szacowanych
+    confidence = fallback_model().confidence(haversine_km_np(o_lats, o_lons, dest_lat, dest_lon))
+
+    results = []
+    for (label, warsztat, origin_lat, origin_lon, is_ws), (dist_km, dur_min, estimated), conf in zip(
+            origins, matrix, confidence):
+        costs = travel_costs(dist_km, dur_min, koszt_za_km)
+        results.append({
+            "Mechanik": label,
+            "Warsztat": warsztat,
+            "Dystans (km)": dist_km,
+            "Czas (min)": dur_min,
+            "Koszt paliwa (PLN)": float(costs["paliwo"]),
+            f"Rbh mechanika [{STAWKA_RBH_MECHANIKA:.0f} PLN/h]": float(costs["rbh"]),
+            f"Koszt samochodu [{STAWKA_SAMOCHODU:.0f} PLN/h]": float(costs["samochod"]),
+            "SUMA kosztów (PLN)": float(costs["suma"]),
+            "Źródło": "szacunek" if estimated else source,
+            "Pewność szacunku": conf if estimated else "",
+            "_lat": origin_lat,
+            "_lon": origin_lon,
+            "_polyline": None,
+            "_is_workshop": is_ws,
+        })
+    result_df = pd.DataFrame(results).sort_values("Dystans (km)").reset_index(drop=True)
+
+    # Pełna geometria tylko dla tras rysowanych na mapie (top N)
+    n_geom = min(geometry_top_n, len(result_df))
+    top_df = result_df.head(n_geom)
+    if n_geom == 0:
+        geometries = []
+    elif route_geometry is not None:
+        # Geometria z drzewa poprzedników tego samego przeszukania
+        routed_pos = {(o_lats[i], o_lons[i]): k for k, i in enumerate(routed_idx)}
+        geometries = []
+        for r_lat, r_lon, src in zip(top_df["_lat"], top_df["_lon"], top_df["Źródło"]):
+            k = routed_pos.get((r_lat, r_lon))
+            geom = route_geometry(k) if k is not None and src != "szacunek" else None
+            geometries.append((None, None, geom or [[r_lat, r_lon], [dest_lat, dest_lon]]))
+    else:
+        geometries = fetch_routes_concurrent(
+            [(r_lat, r_lon, dest_lat, dest_lon) for r_lat, r_lon in zip(top_df["_lat"], top_df["_lon"])],
+            use_fallback=use_fallback, on_progress=on_progress, deadline=deadline,
+        )
+    routes_for_map = []
+    polylines = [None] * len(result_df)
+    for i in range(n_geom):
+        row = result_df.iloc[i]
+        # Uproszczony, zakodowany string (session_state / HTML mapy)
+        polyline = compact_polyline(geometries[i][2])
+        polylines[i] = polyline
+        if polyline:
+            routes_for_map.append({
+                "polyline": polyline,
+                "label": row["Mechanik"],
+                "dist": row["Dystans (km)"],
+                "dur": row["Czas (min)"],
+                "is_best": i == 0,
+                "is_workshop": row.get("_is_workshop", False),
+            })
+    result_df["_polyline"] = polylines
+    result_df.attrs["budzet_wyczerpany"] = budget_left(deadline) <= 0
+    route_cache_evict()
+    return result_df, routes_for_map
+
+
+# ── Raporty CSV (format MAPPA_Raporty) ──────────────────────────────────────
+def report_frame(result_df: pd.DataFrame) -> pd.DataFrame:
+    """Kolumny raportu: bez pól technicznych (_lat, _polyline, …), zaokrąglone."""
+    df = result_df.drop(columns=[c for c in result_df.columns if str(c).startswith("_")])
+    for col in df.columns:
+        if col in ("Dystans (km)", "Czas (min)"):
+            df[col] = df[col].round(1)
+        elif "PLN" in str(col):
+            df[col] = df[col].round(2)
+    return df
+
+
+def report_csv(result_df: pd.DataFrame) -> bytes:
+    """Raport jak w MAPPA_Raporty: UTF-8 z BOM, średnik, przecinek dziesiętny (Excel PL)."""
+    return report_frame(result_df).to_csv(index=False, sep=";", decimal=",").encode("utf-8-sig")
+
+
+def report_filename(target_name: str, when=None) -> str:
+    """raport_<CEL>_<RRRR-MM-DD_GG-MM>.csv — nazwa celu bez spacji i separatorów ścieżek."""
+    safe = re.sub(r'[\s/\\:*?"<>|]+', "_", str(target_name).strip()) or "analiza"
+    return f"raport_{safe}_{(when or datetime.now()):%Y-%m-%d_%H-%M}.csv"
+
+
+def write_report(result_df: pd.DataFrame, target_name: str, out_dir: str = REPORTS_DIR, when=None) -> str:
+    """Zapisz raport CSV do katalogu out_dir; zwraca ścieżkę pliku."""
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, report_filename(target_name, when))
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(report_csv(result_df))
+    os.replace(tmp, path)
+    return path
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Lokalny serwer-atrapa OSRM — do testów i benchmarków MAPPA bez sieci
+====================================================================
+Odpowiada jak osrm-backend na /route, /table i /nearest (format JSON OSRM).
+Dystans = linia prosta × 1.3, czas przy ~60 km/h, geometria — odcinek
+podzielony na kilkadziesiąt punktów. Tylko biblioteka standardowa.
+
+Uruchomienie:  python osrm_mock.py --port 5000 [--opoznienie-ms 50]
+Aplikacja:     MAPPA_ROUTING=osrm MAPPA_OSRM_URL=http://localhost:5000 streamlit run app.py
+"""
+
+import argparse
+import json
+import math
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+DETOUR = 1.3       # współczynnik „krętości” dróg
+SPEED_KMH = 60.0
+ROUTE_POINTS = 50  # punktów geometrii na trasę
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Odległość po kuli ziemskiej (km)."""
+    r = 6371.0
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * r * math.asin(math.sqrt(a))
+
+
+def _parse_coords(segment: str) -> list:
+    """"lon,lat;lon,lat" → [(lat, lon), ...]."""
+    coords = []
+    for pair in segment.split(";"):
+        lon, lat = pair.split(",")
+        coords.append((float(lat), float(lon)))
+    return coords
+
+
+def _leg(a, b) -> tuple:
+    """(dystans_m, czas_s) między punktami (lat, lon)."""
+    meters = haversine_km(a[0], a[1], b[0], b[1]) * DETOUR * 1000
+    return meters, meters / (SPEED_KMH / 3.6)
+
+
+def route_response(coords: list) -> dict:
+    meters = seconds = 0.0
+    geometry = []
+    for a, b in zip(coords[:-1], coords[1:]):
+        m, s = _leg(a, b)
+        meters += m
+        seconds += s
+        geometry.extend(
+            [a[1] + (b[1] - a[1]) * k / ROUTE_POINTS, a[0] + (b[0] - a[0]) * k / ROUTE_POINTS]
+            for k in range(ROUTE_POINTS)
+        )
+    geometry.append([coords[-1][1], coords[-1][0]])
+    return {
+        "code": "Ok",
+        "routes": [{"distance": meters, "duration": seconds,
+                    "geometry": {"type": "LineString", "coordinates": geometry}}],
+        "waypoints": [{"location": [lon, lat]} for lat, lon in coords],
+    }
+
+
+def table_response(coords: list, query: dict) -> dict:
+    def indices(name):
+        raw = query.get(name, ["all"])[0]
+        return list(range(len(coords))) if raw == "all" else [int(i) for i in raw.split(";")]
+
+    sources, destinations = indices("sources"), indices("destinations")
+    legs = [[_leg(coords[i], coords[j]) for j in destinations] for i in sources]
+    return {
+        "code": "Ok",
+        "distances": [[m for m, _ in row] for row in legs],
+        "durations": [[s for _, s in row] for row in legs],
+    }
+
+
+def nearest_response(coords: list) -> dict:
+    lat, lon = coords[0]
+    return {"code": "Ok", "waypoints": [{"location": [lon, lat], "distance": 0.0, "name": ""}]}
+
+
+class OSRMMockHandler(BaseHTTPRequestHandler):
+    delay_s = 0.0
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")  # service / v1 / profile / coords
+        try:
+            service, coords = parts[0], _parse_coords(parts[3])
+            if service == "route":
+                body = route_response(coords)
+            elif service == "table":
+                body = table_response(coords, parse_qs(url.query))
+            elif service == "nearest":
+                body = nearest_response(coords)
+            else:
+                body = {"code": "InvalidService", "message": service}
+        except (IndexError, ValueError) as exc:
+            body = {"code": "InvalidQuery", "message": str(exc)}
+        if self.delay_s:
+            time.sleep(self.delay_s)
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(200 if body["code"] == "Ok" else 400)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def make_server(host: str = "127.0.0.1", port: int = 5000, delay_ms: float = 0.0) -> ThreadingHTTPServer:
+    """Serwer gotowy do serve_forever() (port=0 — wolny port, patrz server_address)."""
+    handler = type("Handler", (OSRMMockHandler,), {"delay_s": delay_ms / 1000.0})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Atrapa OSRM (route/table/nearest)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--opoznienie-ms", type=float, default=0.0,
+                        help="sztuczne opóźnienie każdej odpowiedzi (symulacja sieci)")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port, args.opoznienie_ms)
+    print(f"Atrapa OSRM: http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Wspólne ustawienia testów MAPPA
+===============================
+Testy rdzenia (mappa_core) — bez Streamlit i bez sieci; routing przez
+osrm_mock.py. Uruchomienie z katalogu repozytorium:  python -m pytest -q
+(pytest nie jest w requirements.txt — to zależności aplikacji).
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mappa_core as core  # noqa: E402
+
+
+@pytest.fixture
+def route_cache(tmp_path, monkeypatch):
+    """Pusty cache tras w katalogu tymczasowym (zamiast cache_trasy.sqlite)."""
+    monkeypatch.setattr(core, "ROUTE_CACHE_PATH", str(tmp_path / "cache_trasy.sqlite"))
+    monkeypatch.setattr(core._route_cache_local, "conn", None, raising=False)
+    yield core.ROUTE_CACHE_PATH
+    conn = getattr(core._route_cache_local, "conn", None)
+    if conn is not None:
+        conn.close()
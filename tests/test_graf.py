@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Graf drogowy offline — budowa z wyciągu OSM i przeszukiwania wobec csgraph.dijkstra."""
+
+import numpy as np
+import pytest
+from scipy.sparse import csgraph
+
+import mappa_core as core
+
+N = 6  # siatka N × N skrzyżowań
+
+
+def _osm_xml() -> str:
+    """Siatka dróg różnych typów, część jednokierunkowych (także oneway=-1),
+    chodnik (pomijany) i jednokierunkowy ślepy odcinek (poza silnie spójną składową)."""
+    rng = np.random.default_rng(7)
+
+    def node_id(i, j):
+        return 1 + i * N + j
+
+    nodes = [(node_id(i, j), 50.0 + i * 0.01 + rng.uniform(-2e-3, 2e-3),
+              19.0 + j * 0.015 + rng.uniform(-2e-3, 2e-3)) for i in range(N) for j in range(N)]
+    nodes.append((900, 50.2, 19.2))
+    types = ["primary", "residential", "secondary", "tertiary", "unclassified", "service"]
+    ways = []
+    for i in range(N):
+        tags = {"highway": types[i]}
+        if i == 2:
+            tags["oneway"] = "yes"
+        if i == 4:
+            tags["oneway"] = "-1"
+        ways.append(([node_id(i, j) for j in range(N)], tags))
+    for j in range(N):
+        ways.append(([node_id(i, j) for i in range(N)], {"highway": types[-1 - j], "maxspeed": "45"}))
+    ways.append(([node_id(0, 0), node_id(N - 1, N - 1)], {"highway": "footway"}))
+    ways.append(([node_id(0, 0), 900], {"highway": "residential", "oneway": "yes"}))
+    out = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+    out += [f'  <node id="{n}" lat="{lat:.7f}" lon="{lon:.7f}"/>' for n, lat, lon in nodes]
+    for w, (refs, tags) in enumerate(ways, start=1):
+        out.append(f'  <way id="{w}">')
+        out += [f'    <nd ref="{r}"/>' for r in refs]
+        out += [f'    <tag k="{k}" v="{v}"/>' for k, v in tags.items()]
+        out.append("  </way>")
+    out.append("</osm>")
+    return "\n".join(out)
+
+
+@pytest.fixture(scope="module")
+def graph_dir(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("graf")
+    osm = tmp / "drogi.osm"
+    osm.write_text(_osm_xml(), encoding="utf-8")
+    core.build_road_graph(str(osm), str(tmp / "graf"))
+    return str(tmp / "graf")
+
+
+@pytest.fixture(scope="module")
+def graph(graph_dir):
+    return core.RoadGraph(graph_dir)
+
+
+@pytest.fixture(scope="module")
+def all_pairs(graph):
+    return csgraph.dijkstra(graph.fwd_time, directed=True)
+
+
+def _path_length(graph, path) -> float:
+    return float(sum(graph.fwd_len[a, b] for a, b in zip(path[:-1], path[1:])))
+
+
+def test_build_keeps_strong_component_and_oneways(graph):
+    assert graph.meta["wezly"] == graph.n == N * N  # ślepy odcinek do węzła 900 odpada
+    fwd = graph.fwd_time.toarray()
+    assert (graph.bwd_time.toarray() == fwd.T).all()
+    assert (graph.bwd_len.toarray() == graph.fwd_len.toarray().T).all()
+    # Węzły po id OSM: wiersz i siatki to węzły i*N .. i*N+N-1
+    row2, row4 = 2 * N, 4 * N
+    assert fwd[row2, row2 + 1] > 0 and fwd[row2 + 1, row2] == 0       # oneway=yes
+    assert fwd[row4, row4 + 1] == 0 and fwd[row4 + 1, row4] > 0       # oneway=-1
+    assert fwd[0, N * N - 1] == 0                                      # chodnik pominięty
+    assert fwd[N, N + 1] > 0 and fwd[N + 1, N] > 0                     # dwukierunkowa
+
+
+def test_shortest_path_matches_dijkstra(graph, all_pairs):
+    fwd = graph.fwd_time.toarray()
+    for s in range(graph.n):
+        for t in range(graph.n):
+            time_s, length_m, path = graph.shortest_path(s, t)
+            assert time_s == pytest.approx(all_pairs[s, t])
+            assert path[0] == s and path[-1] == t
+            assert all(fwd[a, b] > 0 for a, b in zip(path[:-1], path[1:]))
+            assert sum(fwd[a, b] for a, b in zip(path[:-1], path[1:])) == pytest.approx(time_s)
+            assert length_m == pytest.approx(_path_length(graph, path), rel=1e-5)
+
+
+@pytest.mark.parametrize("source", [0, 7, 2 * N + 3, N * N - 1])
+def test_one_to_many_forward_and_reverse(graph, all_pairs, source):
+    targets = np.arange(graph.n)
+    t, d, pred = graph.one_to_many(source, targets)
+    assert t == pytest.approx(all_pairs[source])
+    for target in targets:
+        path = graph.path_to_root(pred, int(target))[::-1]
+        assert path[0] == source
+        assert d[target] == pytest.approx(_path_length(graph, path), rel=1e-5)
+    t, d, pred = graph.one_to_many(source, targets, reverse=True)
+    assert t == pytest.approx(all_pairs[:, source])
+    for origin in targets:
+        path = graph.path_to_root(pred, int(origin))  # w drzewie odwróconym: origin → source
+        assert path[-1] == source
+        assert d[origin] == pytest.approx(_path_length(graph, path), rel=1e-5)
+
+
+def test_snap_returns_nearest_node(graph):
+    lats, lons = np.asarray(graph.lat), np.asarray(graph.lon)
+    for lat, lon in [(50.013, 19.021), (49.9, 18.9), (50.06, 19.08)]:
+        node, km = graph.snap(lat, lon)
+        brute = core.haversine_km_np(lat, lon, lats, lons)
+        assert km == pytest.approx(brute.min()) and brute[node] == pytest.approx(brute.min())
+
+
+def test_backend_table_and_many_to_one(graph_dir, all_pairs):
+    """Punkty w węzłach grafu (dojazd 0 km): /table w obu wariantach przeszukań
+    i many_to_one (jedno przeszukanie od celu) dają te same czasy co dijkstra."""
+    backend = core.RoadGraphBackend(graph_dir)
+    graph = backend.graph
+    points = list(zip(np.asarray(graph.lat).tolist(), np.asarray(graph.lon).tolist()))
+    few, many = [0, 9, 30], list(range(0, graph.n, 2))
+    for src, dst in ((few, many), (many, few)):
+        dist, dur = backend.table([points[i] for i in src], [points[j] for j in dst])
+        assert dur == pytest.approx(np.round(all_pairs[np.ix_(src, dst)] / 60, 1))
+    dest = 2 * N + 3
+    dist, dur, geometry = backend.many_to_one(points, *points[dest])
+    assert dur == pytest.approx(np.round(all_pairs[:, dest] / 60, 1))
+    t_dist, _ = backend.table(points, [points[dest]])
+    assert dist == pytest.approx(t_dist[:, 0])
+    fwd = graph.fwd_time.toarray()
+    for i in (0, 5, N * N - 1):
+        line = geometry(i)
+        assert line[0] == list(points[i]) and line[-1] == list(points[dest])
+        nodes = [points.index(tuple(p)) for p in line[1:-1]]
+        assert nodes[0] == i and nodes[-1] == dest
+        assert all(fwd[a, b] > 0 for a, b in zip(nodes[:-1], nodes[1:]))
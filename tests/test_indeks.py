@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Siatka PointIndex — knn i promień wobec pełnego przeglądu (haversine)."""
+
+import math
+
+import numpy as np
+import pytest
+
+import mappa_core as core
+
+
+def test_haversine_np_matches_scalar():
+    rng = np.random.default_rng(0)
+    a = rng.uniform([49.0, 14.0], [55.0, 24.0], size=(50, 2))
+    b = rng.uniform([49.0, 14.0], [55.0, 24.0], size=(50, 2))
+    vec = core.haversine_km_np(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+    for (lat1, lon1), (lat2, lon2), d in zip(a, b, vec):
+        p1, p2 = math.radians(lat1), math.radians(lat2)
+        h = (math.sin((p2 - p1) / 2) ** 2
+             + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+        assert d == pytest.approx(2 * 6371.0 * math.asin(math.sqrt(h)), rel=1e-9)
+
+
+@pytest.fixture(scope="module")
+def points():
+    """Skupiska i rozproszone punkty (jak mechanicy w miastach i na wsiach)."""
+    rng = np.random.default_rng(1)
+    centers = rng.uniform([49.5, 15.0], [54.5, 23.5], size=(6, 2))
+    clustered = np.concatenate([c + rng.normal(0, 0.05, size=(80, 2)) for c in centers])
+    scattered = rng.uniform([49.0, 14.0], [55.0, 24.0], size=(120, 2))
+    return np.concatenate([clustered, scattered])
+
+
+QUERIES = [(52.23, 21.01), (50.06, 19.94), (54.35, 18.65), (49.0, 14.0), (56.5, 25.0), (45.0, 10.0)]
+
+
+@pytest.mark.parametrize("cell_deg", [0.02, 0.25, 1.0])
+@pytest.mark.parametrize("k", [1, 5, 40])
+def test_knn_matches_brute_force(points, cell_deg, k):
+    index = core.PointIndex(points[:, 0], points[:, 1], cell_deg=cell_deg)
+    for lat, lon in QUERIES:
+        idx, dist = index.knn(lat, lon, k)
+        brute = core.haversine_km_np(lat, lon, points[:, 0], points[:, 1])
+        assert dist == pytest.approx(np.sort(brute)[:k])
+        assert brute[idx] == pytest.approx(dist)
+        assert len(set(idx.tolist())) == k
+
+
+@pytest.mark.parametrize("cell_deg", [0.02, 0.25])
+@pytest.mark.parametrize("radius_km", [0.5, 10, 80, 2000])
+def test_radius_matches_brute_force(points, cell_deg, radius_km):
+    index = core.PointIndex(points[:, 0], points[:, 1], cell_deg=cell_deg)
+    for lat, lon in QUERIES:
+        idx, dist = index.radius(lat, lon, radius_km)
+        brute = core.haversine_km_np(lat, lon, points[:, 0], points[:, 1])
+        assert sorted(idx.tolist()) == np.flatnonzero(brute <= radius_km).tolist()
+        assert (np.diff(dist) >= 0).all() and brute[idx] == pytest.approx(dist)
+
+
+def test_empty_and_small_index():
+    empty = core.PointIndex([], [])
+    assert len(empty.knn(52.0, 21.0, 3)[0]) == 0 and len(empty.radius(52.0, 21.0, 50)[0]) == 0
+    two = core.PointIndex([52.0, 50.0], [21.0, 19.0])
+    idx, _ = two.knn(51.9, 20.9, k=5)
+    assert idx.tolist() == [0, 1]
+    idx, _ = two.knn_many([50.1, 52.1], [19.1, 21.1], k=1)
+    assert idx[:, 0].tolist() == [1, 0]
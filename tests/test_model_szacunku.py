@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Model szacunku (FallbackModel) — uczenie na syntetycznych trasach i odświeżanie w tle."""
+
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import mappa_core as core
+
+DETOUR = [1.6, 1.4, 1.3, 1.25, 1.2]    # prawdziwa krętość per przedział FALLBACK_BANDS_KM
+SPEED = [30.0, 45.0, 65.0, 80.0, 90.0]  # prawdziwa prędkość (km/h) per przedział
+COORDS = ("lat1", "lon1", "lat2", "lon2")
+
+
+def _routes(n: int, seed: int = 0, noise: float = 0.03, region_detour: float = 1.0,
+            local: float = 0.05) -> pd.DataFrame:
+    """Losowe trasy w Polsce; region 50–50.5°N, 19.5–20°E ma dodatkową krętość
+    region_detour — część `local` tras to krótkie odcinki wewnątrz niego."""
+    rng = np.random.default_rng(seed)
+    lat1 = rng.uniform(49.5, 54.0, n)
+    lon1 = rng.uniform(15.0, 23.0, n)
+    km = np.exp(rng.uniform(np.log(1.0), np.log(250.0), n))
+    angle = rng.uniform(0, 2 * np.pi, n)
+    lat2 = lat1 + km * np.cos(angle) / 111.19
+    lon2 = lon1 + km * np.sin(angle) / (111.19 * np.cos(np.radians(lat1)))
+    local = rng.random(n) < local
+    lat1[local], lon1[local] = rng.uniform(50.05, 50.45, local.sum()), rng.uniform(19.55, 19.95, local.sum())
+    lat2[local], lon2[local] = lat1[local] + 0.02, lon1[local] + 0.02
+    line = core.haversine_km_np(lat1, lon1, lat2, lon2)
+    band = np.digitize(line, core.FALLBACK_BANDS_KM)
+    mid_lat, mid_lon = (lat1 + lat2) / 2, (lon1 + lon2) / 2
+    in_region = (mid_lat >= 50.0) & (mid_lat < 50.5) & (mid_lon >= 19.5) & (mid_lon < 20.0)
+    dist = line * np.asarray(DETOUR)[band] * np.where(in_region, region_detour, 1.0)
+    dist *= np.exp(rng.normal(0, noise, n))
+    dur = dist / np.asarray(SPEED)[band] * 60 * np.exp(rng.normal(0, noise, n))
+    return pd.DataFrame({"lat1": lat1, "lon1": lon1, "lat2": lat2, "lon2": lon2,
+                         "dystans_km": dist, "czas_min": dur})
+
+
+def test_without_data_uses_fixed_detour_and_speed():
+    model = core.FallbackModel()
+    dist, dur = model.predict([52.0], [21.0], [52.5], [21.5])
+    line = core.haversine_km_np(52.0, 21.0, 52.5, 21.5)
+    assert dist[0] == pytest.approx(line * core.FALLBACK_DETOUR)
+    assert dur[0] == pytest.approx(dist[0] / core.FALLBACK_SPEED_KMH * 60)
+    assert model.confidence([10.0])[0].startswith("bez kalibracji")
+
+
+def test_fit_recovers_band_detour_and_speed():
+    model = core.FallbackModel.fit(_routes(4000))
+    assert np.exp(model.band_detour) == pytest.approx(DETOUR, rel=0.02)
+    assert np.exp(model.band_speed) == pytest.approx(SPEED, rel=0.02)
+    test = _routes(500, seed=1, noise=0.0)
+    dist, dur = model.predict(*(test[c].to_numpy() for c in COORDS))
+    assert dist == pytest.approx(test["dystans_km"].to_numpy(), rel=0.05)
+    assert dur == pytest.approx(test["czas_min"].to_numpy(), rel=0.05)
+
+
+def test_region_effect_is_learned_and_shrunk():
+    """Poprawka regionu = średnia reszt ściągnięta do 0: n / (n + FALLBACK_SHRINK)
+    — przy wielu trasach w regionie przybliża szacunek do prawdy, przy kilku prawie znika."""
+    region = core.FallbackModel._features(np.array([50.25]), 19.75, 50.27, 19.77)[2][0]
+    test = _routes(300, seed=3, noise=0.0, region_detour=1.3, local=1.0)
+    coords = [test[c].to_numpy() for c in COORDS]
+    errors = {}
+    for share in (0.1, 0.0):
+        train = _routes(4000, region_detour=1.3, local=share)
+        n = int((core.FallbackModel._features(*(train[c].to_numpy() for c in COORDS))[2] == region).sum())
+        model = core.FallbackModel.fit(train)
+        shrunk = np.exp(model.region_detour[region])
+        assert shrunk == pytest.approx(1.3 ** (n / (n + core.FALLBACK_SHRINK)), rel=0.03)
+        errors[share] = np.median(np.abs(model.predict(*coords)[0] / test["dystans_km"] - 1))
+    assert errors[0.1] < 0.05 < errors[0.0]
+
+
+def test_evaluate_beats_fixed_estimate_and_sets_confidence():
+    train, test = _routes(3000), _routes(600, seed=2)
+    model = core.FallbackModel.fit(train)
+    out = model.evaluate(test)
+    assert out["trasy_testowe"] == 600
+    assert out["dystans_blad_mediana_pct"] < out["dystans_bazowy_mediana_pct"]
+    assert out["czas_blad_mediana_pct"] < out["czas_bazowy_mediana_pct"]
+    assert len(model.band_error) == len(core.FALLBACK_BANDS_KM) + 1
+    assert model.confidence([3.0, 300.0])[0].startswith("±")
+
+
+def _fill_cache(routes: pd.DataFrame) -> None:
+    core.route_cache_put_many(
+        (core.route_cache_key(r.lat1, r.lon1, r.lat2, r.lon2), r.dystans_km, r.czas_min, None)
+        for r in routes.itertuples())
+
+
+def test_fallback_model_from_route_cache(route_cache, monkeypatch):
+    monkeypatch.setattr(core, "_fallback_model", None)
+    assert core.fallback_model().n_routes == 0  # pusty cache — bez kalibracji
+    _fill_cache(_routes(core.FALLBACK_MIN_ROUTES * 4))
+    assert core.fallback_model().n_routes == 0  # do upływu FALLBACK_MODEL_TTL_S — ten sam model
+    model = core.fallback_model(refit=True)
+    assert model.n_routes > core.FALLBACK_MIN_ROUTES and model.evaluation["trasy_testowe"] > 0
+    assert core.fallback_model() is model
+
+
+def test_stale_model_is_served_while_refitting_in_background(route_cache, monkeypatch):
+    old = core.FallbackModel()
+    old.fitted_at -= core.FALLBACK_MODEL_TTL_S + 1
+    monkeypatch.setattr(core, "_fallback_model", old)
+    monkeypatch.setattr(core, "_fallback_refit_worker", None)
+    release, fitted = threading.Event(), core.FallbackModel()
+    started = []
+
+    def slow_fit():
+        started.append(1)
+        release.wait(5)
+        return fitted
+
+    monkeypatch.setattr(core, "_fit_fallback_model", slow_fit)
+    assert all(core.fallback_model() is old for _ in range(20))  # bez czekania na uczenie
+    release.set()
+    core._fallback_refit_worker.join(5)
+    assert len(started) == 1  # jedno uczenie mimo wielu wywołań
+    assert core.fallback_model() is fitted
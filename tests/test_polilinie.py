@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Kodowanie polilinii (Google Encoded Polyline) i upraszczanie geometrii tras."""
+
+import numpy as np
+import pytest
+
+import mappa_core as core
+
+
+def test_encode_matches_reference_example():
+    """Przykład z dokumentacji formatu Google Polyline."""
+    coords = [[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]]
+    encoded = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    assert core.encode_polyline(coords) == encoded
+    assert np.asarray(core.decode_polyline(encoded)) == pytest.approx(np.asarray(coords))
+
+
+@pytest.mark.parametrize("precision", [5, 6])
+def test_round_trip(precision):
+    rng = np.random.default_rng(precision)
+    coords = np.cumsum(rng.normal(0, 0.01, size=(500, 2)), axis=0) + [52.0, 19.0]
+    coords[100:110] = coords[99]  # powtórzone punkty (delta 0)
+    coords[200, 1] = -179.99999   # duże skoki w obie strony
+    decoded = core.decode_polyline(core.encode_polyline(coords.tolist(), precision), precision)
+    assert len(decoded) == len(coords)
+    assert np.abs(np.asarray(decoded) - coords).max() <= 0.5 / 10 ** precision + 1e-12
+
+
+def test_empty():
+    assert core.encode_polyline([]) == "" and core.decode_polyline("") == []
+
+
+def test_simplify_keeps_shape_within_tolerance():
+    """Douglas-Peucker: końce zachowane, każdy usunięty punkt najwyżej tolerancję
+    od uproszczonej linii, punkty współliniowe usunięte."""
+    t = np.linspace(0, 1, 400)
+    coords = np.column_stack([52.0 + 0.2 * t, 19.0 + 0.3 * t + 0.01 * np.sin(12 * t)])
+    tol = core.simplify_tolerance_m(12)
+    out = core.simplify_polyline(coords, tol)
+    assert 2 < len(out) < len(coords) // 4
+    assert (out[0] == coords[0]).all() and (out[-1] == coords[-1]).all()
+    kx = 111320.0 * np.cos(np.radians(coords[:, 0].mean()))
+    xy = np.column_stack([coords[:, 1] * kx, coords[:, 0] * 110540.0])
+    kept = np.column_stack([out[:, 1] * kx, out[:, 0] * 110540.0])
+    for p in xy:
+        a, b = kept[:-1], kept[1:]
+        seg = b - a
+        s = np.clip(((p - a) * seg).sum(axis=1) / np.maximum((seg ** 2).sum(axis=1), 1e-12), 0, 1)
+        assert np.hypot(*(a + s[:, None] * seg - p).T).min() <= tol + 1e-6
+    line = np.column_stack([np.linspace(52, 53, 50), np.linspace(19, 20, 50)])
+    assert len(core.simplify_polyline(line, 1.0)) == 2
+
+
+def test_compact_polyline_decodes_to_simplified_route():
+    coords = [[52.0 + k * 1e-4, 19.0 + (k % 7) * 1e-5] for k in range(300)]
+    decoded = core.decode_polyline(core.compact_polyline(coords))
+    assert np.asarray(decoded)[[0, -1]] == pytest.approx(np.asarray(coords)[[0, -1]])
+    assert len(decoded) < len(coords)
+    assert core.compact_polyline(coords[:1]) is None
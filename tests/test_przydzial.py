@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Optymalny przydział mechaników do budów — porównanie z pełnym przeglądem i MILP."""
+
+import itertools
+
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.optimize import Bounds, LinearConstraint, milp
+
+import mappa_core as core
+
+
+def _check(pairs, n_s, capacity, groups, quota):
+    """Przydział spełnia ograniczenia → (liczba obsadzonych budów)."""
+    assert len(set(pairs[:, 1].tolist())) == len(pairs), "budowa z dwoma mechanikami"
+    load = np.bincount(pairs[:, 0], minlength=len(capacity))
+    assert (load <= capacity).all()
+    for g, q in (quota or {}).items():
+        assert (groups[pairs[:, 0]] == g).sum() <= q
+    return len(pairs)
+
+
+def _brute_force(cost, capacity, groups, quota):
+    """Pełny przegląd: najpierw najwięcej obsadzonych budów, potem najniższy koszt."""
+    n_m, n_s = cost.shape
+    best = (-1, np.inf)
+    for choice in itertools.product(range(-1, n_m), repeat=n_s):
+        rows = np.array([m for m in choice if m >= 0], dtype=int)
+        if (np.bincount(rows, minlength=n_m) > capacity).any():
+            continue
+        if any((groups[rows] == g).sum() > q for g, q in (quota or {}).items()):
+            continue
+        total = sum(cost[m, s] for s, m in enumerate(choice) if m >= 0)
+        if (len(rows), -total) > (best[0], -best[1]):
+            best = (len(rows), total)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("capacity, quota", [(1, None), (2, None), (2, {"A": 1, "B": 2}), (1, {"A": 1})])
+def test_matches_brute_force(seed, capacity, quota):
+    rng = np.random.default_rng(seed)
+    cost = rng.uniform(10, 100, size=(4, 5))
+    groups = np.array(["A", "A", "B", "C"])
+    cap = np.full(4, capacity)
+    pairs = core.solve_assignment(cost, capacity=capacity, groups=groups, group_quota=quota)
+    staffed = _check(pairs, 5, cap, groups, quota)
+    best_staffed, best_cost = _brute_force(cost, cap, groups, quota)
+    assert staffed == best_staffed
+    assert cost[pairs[:, 0], pairs[:, 1]].sum() == pytest.approx(best_cost)
+
+
+def _milp_optimum(cost, capacity, groups, quota):
+    """Ten sam model (x[m, s] + kara za nieobsadzoną budowę) jako MILP — pełny graf."""
+    n_m, n_s = cost.shape
+    n = n_m * n_s
+    penalty = cost.max() * (n_s + 1) + 1.0
+    c = np.concatenate([cost.ravel(), np.full(n_s, penalty)])
+    rows = np.repeat(np.arange(n_m), n_s)
+    cols = np.tile(np.arange(n_s), n_m)
+    a_mech = sparse.csr_matrix((np.ones(n), (rows, np.arange(n))), shape=(n_m, n + n_s))
+    a_site = sparse.hstack([sparse.csr_matrix((np.ones(n), (cols, np.arange(n))), shape=(n_s, n)),
+                            sparse.identity(n_s)])
+    labels = sorted(quota)
+    g_rows = np.array([labels.index(groups[m]) if groups[m] in quota else -1 for m in rows])
+    keep = g_rows >= 0
+    a_grp = sparse.csr_matrix((np.ones(keep.sum()), (g_rows[keep], np.flatnonzero(keep))),
+                              shape=(len(labels), n + n_s))
+    res = milp(c, integrality=np.ones(n + n_s), bounds=Bounds(0, 1), constraints=[
+        LinearConstraint(a_mech, -np.inf, capacity),
+        LinearConstraint(a_site, 1, 1),
+        LinearConstraint(a_grp, -np.inf, [quota[g] for g in labels]),
+    ])
+    x = np.round(res.x).astype(bool)
+    return n_s - int(x[n:].sum()), float(cost.ravel()[x[:n]].sum())
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_pruned_lp_matches_milp(seed):
+    """Więcej mechaników i budów niż ASSIGN_CANDIDATES_K — LP na przyciętym grafie
+    (z ewentualnym ponownym rozwiązaniem) daje optimum pełnego modelu."""
+    rng = np.random.default_rng(seed)
+    n_m, n_s = 70, 90
+    cost = rng.uniform(10, 500, size=(n_m, n_s))
+    groups = rng.choice(["W1", "W2", "W3", "W4"], size=n_m)
+    capacity = rng.integers(1, 3, size=n_m)
+    quota = {"W1": 5, "W2": 30, "W3": 12}
+    pairs = core.solve_assignment(cost, capacity=capacity, groups=groups, group_quota=quota)
+    staffed = _check(pairs, n_s, capacity, groups, quota)
+    best_staffed, best_cost = _milp_optimum(cost, capacity, groups, quota)
+    assert staffed == best_staffed
+    assert cost[pairs[:, 0], pairs[:, 1]].sum() == pytest.approx(best_cost)
+
+
+def test_pruned_graph_cut_off_free_mechanic():
+    """Budowy 40+ mają K najtańszych mechaników w warsztacie z limitem, a warsztat
+    bez limitu ma K najtańszych budów gdzie indziej — przycięty graf obsadziłby
+    41 z 80 budów; przydział musi sięgnąć po wszystkie krawędzie."""
+    k = core.ASSIGN_CANDIDATES_K
+    n_s = 2 * k
+    cost = np.full((2 * k, n_s), 1000.0)
+    cost[:k, k:] = 1.0     # warsztat A (limit 1) — tani dla budów k..2k-1
+    cost[k:, :k] = 1.0     # warsztat B (bez limitu) — tani dla budów 0..k-1
+    cost[k:, k:] = 100.0
+    groups = np.array(["A"] * k + ["B"] * k)
+    capacity = np.array([1] * k + [2] * k)
+    pairs = core.solve_assignment(cost, capacity=capacity, groups=groups, group_quota={"A": 1})
+    assert _check(pairs, n_s, capacity, groups, {"A": 1}) == n_s
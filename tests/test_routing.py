@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Zapytania routingu przez atrapę OSRM: wyniki, cache tras, bezpiecznik i timeouty."""
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import mappa_core as core
+import osrm_mock
+
+KRAKOW, KATOWICE, TARNOW = (50.0614, 19.9366), (50.2649, 19.0238), (50.0121, 20.9858)
+
+
+@pytest.fixture
+def osrm(route_cache, monkeypatch):
+    """Atrapa OSRM na wolnym porcie jako backend skonfigurowany; świeży stan zdrowia."""
+    server = osrm_mock.make_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    backend = core.OSRMBackend(f"http://127.0.0.1:{server.server_address[1]}", name="osrm (test)")
+    monkeypatch.setattr(core, "_routing_backend", backend)
+    monkeypatch.setattr(core, "_routing_down", False)
+    monkeypatch.setattr(core, "_routing_health", {})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _expected(a, b):
+    meters, seconds = osrm_mock._leg(a, b)
+    return round(meters / 1000, 1), round(seconds / 60, 1)
+
+
+def test_route_from_server_then_from_cache(osrm):
+    dist, dur, line = core.get_osrm_route(*KRAKOW, *KATOWICE)
+    assert (dist, dur) == _expected(KRAKOW, KATOWICE) and len(line) > 2
+    core.route_cache_stats(reset=True)
+    osrm.shutdown()  # drugie zapytanie — bez serwera
+    assert core.get_osrm_route(*KRAKOW, *KATOWICE)[:2] == (dist, dur)
+    assert core.route_cache_stats()["hit"] == 1
+
+
+def test_matrix_matches_server_and_fills_cache(osrm):
+    origins, destinations = [KRAKOW, KATOWICE, TARNOW], [KATOWICE, TARNOW]
+    dist, dur, estimated = core.get_osrm_matrix(origins, destinations)
+    assert not estimated.any()
+    for i, a in enumerate(origins):
+        for j, b in enumerate(destinations):
+            assert (dist[i, j], dur[i, j]) == pytest.approx(_expected(a, b), abs=0.051)
+    keys = [core.route_cache_key(*a, *b) for a in origins for b in destinations]
+    assert len(core.route_cache_get_many(keys)) == len(keys)
+
+
+def test_breaker_opens_on_timeouts_and_closes_after_probe(osrm, monkeypatch):
+    monkeypatch.setattr(core, "BREAKER_COOLDOWN_S", 1.5)  # > pauza 0.5 s po timeoucie
+    osrm.RequestHandlerClass.delay_s = 0.5
+    health = core.get_routing_health()
+    while health.status()["bezpiecznik"] == "zamknięty":
+        _, _, line = core.get_osrm_route(*KRAKOW, *TARNOW, deadline_s=0.1)
+        assert len(line) == 2  # timeout → szacunek
+    assert health.failures >= core.BREAKER_FAILURES
+    started = time.monotonic()
+    assert len(core.get_osrm_route(*KRAKOW, *TARNOW)[2]) == 2  # otwarty — bez zapytania
+    assert time.monotonic() - started < 0.1
+    osrm.RequestHandlerClass.delay_s = 0.0
+    time.sleep(1.6)
+    assert health.status()["bezpiecznik"] == "półotwarty"
+    assert len(core.get_osrm_route(*KRAKOW, *TARNOW)[2]) > 2  # próbne zapytanie przechodzi
+    assert health.status()["bezpiecznik"] == "zamknięty" and health.failures == 0
+
+
+def test_only_probe_result_ends_half_open_state(monkeypatch):
+    health = core.RoutingHealth()
+    monkeypatch.setattr(core, "BREAKER_COOLDOWN_S", 0.0)
+    assert health.allow() == 0
+    for _ in range(core.BREAKER_FAILURES):
+        health.record("route", 0.1, ok=False)
+    probe = health.allow()
+    assert probe > 0 and health.allow() is None  # jedno zapytanie próbne naraz
+    health.record("route", 0.1, ok=False)         # spóźniony wynik zwykłego zapytania
+    assert health.allow() is None
+    assert health.timeout("route", 9.0, ticket=probe) == 9.0
+    health.record("route", 0.1, ok=True, ticket=probe)
+    assert health.allow() == 0 and health.status()["bezpiecznik"] == "zamknięty"
+
+
+def test_adaptive_timeout_follows_latency():
+    health = core.RoutingHealth()
+    assert health.timeout("route", 10.0) == 10.0  # za mało próbek
+    for latency in np.linspace(0.1, 0.5, core.ROUTING_LATENCY_MIN_SAMPLES):
+        health.record("route", latency, ok=True)
+    p95 = np.percentile(np.linspace(0.1, 0.5, core.ROUTING_LATENCY_MIN_SAMPLES), 95)
+    assert health.timeout("route", 10.0) == pytest.approx(
+        max(core.ROUTING_TIMEOUT_MIN_S, p95 * core.ROUTING_TIMEOUT_P95_FACTOR))
+    for _ in range(core.ROUTING_LATENCY_WINDOW):  # przekroczenia limitu podnoszą timeout
+        health.record("route", 0.1, ok=False, timeout_s=4.0)
+    assert health.timeout("route", 10.0) == 10.0
+    health.record("table", 0.02 * 50, ok=True, size=50)
+    assert health.percentile("table", 50) == pytest.approx(0.02)
+
+
+def test_health_is_kept_per_backend(osrm):
+    assert core.get_routing_health() is core.get_routing_health(core.configured_routing_backend())
+    assert core.get_routing_health(core.HaversineBackend()) is not core.get_routing_health()
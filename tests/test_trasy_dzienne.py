@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Trasy dzienne (TourPlanner) — wykonalność i porównanie z pełnym przeglądem."""
+
+import itertools
+
+import numpy as np
+import pytest
+
+import mappa_core as core
+
+
+def _planner(seed, n_homes, n_sites, service, window_end, shift_max):
+    """Losowe punkty na płaszczyźnie 60 × 60; czas jazdy (min) = odległość euklidesowa."""
+    rng = np.random.default_rng(seed)
+    pts = rng.uniform(0, 60, size=(n_homes + n_sites, 2))
+    dur = np.linalg.norm(pts[:, None] - pts[None], axis=2)
+    return core.TourPlanner(dur, n_homes, rng.integers(*service, size=n_sites),
+                            day_start=420, window_start=420, window_end=window_end,
+                            shift_max=shift_max)
+
+
+def _brute_force(p):
+    """Pełny przegląd przydziałów i kolejności: (najwięcej obsłużonych budów, najkrótsza jazda)."""
+    sites = range(p.h, len(p.dur))
+    best = (-1, np.inf)
+    for choice in itertools.product(range(-1, p.h), repeat=len(sites)):
+        served, total = 0, 0.0
+        for m in range(p.h):
+            mine = [s for s, c in zip(sites, choice) if c == m]
+            travel = [p.travel(m, list(seq)) for seq in itertools.permutations(mine)
+                      if np.isfinite(p.finish_time(m, list(seq)))]
+            if not travel:
+                break
+            served, total = served + len(mine), total + min(travel)
+        else:
+            if (served, -total) > (best[0], -best[1]):
+                best = (served, total)
+    return best
+
+
+def test_finish_time_waits_for_window_and_checks_limits():
+    dur = np.array([[0, 30, 50], [30, 0, 20], [50, 20, 0]], dtype=float)
+    p = core.TourPlanner(dur, 1, [60, 60], day_start=360, window_start=420,
+                         window_end=600, shift_max=600)
+    # wyjazd 6:00, dojazd 6:30 → czekanie do 7:00, 60 min, +20, 60 min → 9:20, powrót +50
+    assert p.finish_time(0, [1, 2]) == 360 + 30 + 30 + 60 + 20 + 60 + 50
+    p.window_end = 500
+    assert p.finish_time(0, [1, 2]) == np.inf
+    p.window_end, p.shift_max = 600, 200
+    assert p.finish_time(0, [1, 2]) == np.inf
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_single_mechanic_order_is_optimal(seed):
+    """Jeden mechanik, limity niewiążące — 2-opt + Or-opt znajduje najkrótszą kolejność."""
+    p = _planner(seed, 1, 6, (10, 30), window_end=1e9, shift_max=1e9)
+    tours, todo = p.solve()
+    assert todo == [] and sorted(tours[0]) == list(range(1, 7))
+    assert p.travel(0, tours[0]) == pytest.approx(_brute_force(p)[1])
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("n_homes", [2, 3])
+def test_tours_feasible_and_serve_as_many_sites_as_possible(seed, n_homes):
+    """Wiążące okno budów (7–15) i zmiana 10 h — trasy wykonalne, każda budowa
+    najwyżej raz, obsłużonych tyle, ile w optimum; nieobsadzonej nie da się wstawić."""
+    p = _planner(seed, n_homes, 5, (90, 200), window_end=900, shift_max=600)
+    tours, todo = p.solve()
+    visited = [node for tour in tours for node in tour]
+    assert sorted(visited + todo) == list(range(n_homes, n_homes + 5))
+    assert all(np.isfinite(p.finish_time(m, tour)) for m, tour in enumerate(tours))
+    assert len(visited) == _brute_force(p)[0]
+    assert all(p._best_insertion(tours, node) is None for node in todo)